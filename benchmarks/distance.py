@@ -0,0 +1,66 @@
+"""
+Сравнение скорости расчёта расстояний: geopy по одной паре против
+векторного Geocode.calculate_distances.
+
+Запуск из корня проекта:
+    python -m benchmarks.distance
+"""
+import time
+
+import numpy as np
+
+from geocode_api import Geocode
+
+SIZES = (100, 10_000, 1_000_000)
+# geopy на миллионе точек считает минуты, поэтому замеряем на выборке
+# и пересчитываем время на полный размер.
+GEOPY_SAMPLE = 10_000
+
+
+def random_points(size, rng):
+    """Возвращает случайные точки в окрестностях Москвы."""
+    return np.column_stack([
+        rng.uniform(55.5, 56.0, size),
+        rng.uniform(37.3, 37.9, size),
+    ])
+
+
+def measure(func):
+    """Возвращает время выполнения функции, с."""
+    started_at = time.perf_counter()
+    func()
+
+    return time.perf_counter() - started_at
+
+
+def main():
+    geocode = Geocode('')
+    rng = np.random.default_rng(0)
+    origin = (55.7522, 37.6156)
+
+    print(f'{"points":>10} {"geopy, s":>12} {"numpy, s":>12} '
+          f'{"speedup":>10} {"max error":>10}')
+
+    for size in SIZES:
+        points = random_points(size, rng)
+        sample = points[:GEOPY_SAMPLE]
+        sample_pairs = [tuple(point) for point in sample]
+
+        geopy_time = measure(
+            lambda: [geocode.calculate_distance(origin, point)
+                     for point in sample_pairs]
+        ) * size / len(sample)
+        numpy_time = measure(
+            lambda: geocode.calculate_distances(origin, points)
+        )
+
+        exact = geocode.calculate_distances(origin, sample, geodesic=True)
+        fast = geocode.calculate_distances(origin, sample)
+        max_error = np.max(np.abs(fast - exact) / exact)
+
+        print(f'{size:>10} {geopy_time:>12.4f} {numpy_time:>12.4f} '
+              f'{geopy_time / numpy_time:>9.0f}x {max_error:>10.2%}')
+
+
+if __name__ == '__main__':
+    main()
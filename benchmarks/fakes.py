@@ -0,0 +1,637 @@
+"""
+Поддельные Moltin, геокодер Яндекса и Bot API Telegram для замеров.
+
+Каждый сервер работает в фоновом потоке этого же процесса, отвечает с
+задержкой latency секунд (плюс случайная до jitter) и с вероятностью
+error_rate возвращает ошибку: 503 у Moltin и Яндекса, 429 с retry_after
+у Telegram. Сервер считает запросы по эндпоинтам в поле calls.
+"""
+import hashlib
+import itertools
+import json
+import random
+import re
+import sys
+import threading
+import time
+import uuid
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+from slugify import slugify
+
+
+class FakeRequestHandler(BaseHTTPRequestHandler):
+    """Передаёт запрос в маршруты FakeServer."""
+
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        self.server.handle_request_for(self)
+
+    def do_POST(self):
+        self.server.handle_request_for(self)
+
+    def do_PUT(self):
+        self.server.handle_request_for(self)
+
+    def do_DELETE(self):
+        self.server.handle_request_for(self)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FakeServer(ThreadingHTTPServer):
+    """HTTP-сервер с маршрутами, задержкой и случайными ошибками."""
+
+    daemon_threads = True
+
+    def __init__(self, latency=0.0, jitter=0.0, error_rate=0.0):
+        super().__init__(('127.0.0.1', 0), FakeRequestHandler)
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.calls = Counter()
+        self.routes = []
+        self.lock = threading.Lock()
+        self.__random = random.Random(0)
+
+    def __repr__(self):
+        return '<{} {}>'.format(self.__class__.__name__.upper(), self.url)
+
+    def handle_error(self, request, client_address):
+        # Клиент закрыл keep-alive соединение: это не ошибка сервера.
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+    @property
+    def url(self):
+        return 'http://{}:{}'.format(*self.server_address)
+
+    def route(self, method, pattern, handler):
+        """Добавляет маршрут: handler(request, *groups) -> (код, тело)."""
+        name = pattern.replace('([^/]+)', '{id}').replace('[^/]+', '{token}')
+        self.routes.append((method, re.compile(f'^{pattern}$'), handler,
+                            f'{method} {name}'))
+
+    def start(self):
+        """Запускает сервер в фоновом потоке."""
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+        return self
+
+    def stop(self):
+        """Останавливает сервер."""
+        self.shutdown()
+        self.server_close()
+
+    def error_response(self):
+        """Возвращает код и тело ответа при внедрённой ошибке."""
+        return 503, {'errors': [{'status': 503, 'title': 'Fake outage'}]}
+
+    def handle_request_for(self, request):
+        split_url = urlsplit(request.path)
+        length = int(request.headers.get('Content-Length') or 0)
+        request.body = request.rfile.read(length) if length else b''
+        request.query = {
+            name: values[0]
+            for name, values in parse_qs(split_url.query).items()
+        }
+
+        for method, pattern, handler, name in self.routes:
+            if method != request.command:
+                continue
+            if match := pattern.match(split_url.path):
+                break
+        else:
+            return self.send(request, 404, {'errors': [{'status': 404}]})
+
+        with self.lock:
+            self.calls[name] += 1
+            delay = self.latency + self.__random.uniform(0, self.jitter)
+            is_error = self.__random.random() < self.error_rate
+
+        if delay:
+            time.sleep(delay)
+
+        if is_error:
+            status, body = self.error_response()
+        else:
+            with self.lock:
+                status, body = handler(request, *match.groups())
+
+        self.send(request, status, body)
+
+    @staticmethod
+    def send(request, status, body):
+        content = json.dumps(body, ensure_ascii=False).encode('utf-8')
+        request.send_response(status)
+        request.send_header('Content-Type', 'application/json')
+        request.send_header('Content-Length', str(len(content)))
+        request.end_headers()
+        request.wfile.write(content)
+
+
+def json_body(request):
+    """Разбирает тело запроса как JSON, пустое тело — как {}."""
+    if not request.body:
+        return {}
+
+    try:
+        return json.loads(request.body)
+    except ValueError:
+        return {}
+
+
+def paginate(request, items):
+    """Отдаёт страницу списка по page[limit] и page[offset], как Moltin."""
+    limit = int(request.query.get('page[limit]', 100))
+    offset = int(request.query.get('page[offset]', 0))
+    path = urlsplit(request.path).path
+    base_url = f'{request.server.url}{path}'
+
+    links = {
+        'current': f'{base_url}?page[limit]={limit}&page[offset]={offset}',
+    }
+    if offset + limit < len(items):
+        links['next'] = (f'{base_url}?page[limit]={limit}'
+                         f'&page[offset]={offset + limit}')
+
+    return 200, {
+        'data': items[offset:offset + limit],
+        'links': links,
+        'meta': {'results': {'total': len(items)}},
+    }
+
+
+def cart_items_response(items):
+    """Отдаёт товары корзины со стоимостью в meta, как Moltin."""
+    amount = sum(item['unit_price']['amount'] * item['quantity']
+                 for item in items)
+    currency = items[0]['unit_price']['currency'] if items else 'RUB'
+    price = {
+        'amount': amount,
+        'currency': currency,
+        'formatted': '{:,.2f} {}'.format(amount / 100, currency),
+    }
+
+    return {
+        'data': items,
+        'meta': {
+            'display_price': {'with_tax': price, 'without_tax': price},
+        },
+    }
+
+
+class FakeMoltin(FakeServer):
+    """Moltin с товарами, файлами, корзинами и записями Flow в памяти."""
+
+    def __init__(self, menu_items=(), addresses=(), **kwargs):
+        super().__init__(**kwargs)
+        self.products = {}
+        self.files = {}
+        self.flows = {}
+        self.entries = {}
+        self.carts = {}
+
+        for menu_item in menu_items:
+            self.add_menu_item(menu_item)
+        if addresses:
+            self.add_flow('Pizzeria')
+            for address in addresses:
+                self.add_entry('pizzeria', {
+                    'address': address['address']['full'],
+                    'alias': address['alias'],
+                    'longitude': float(address['coordinates']['lon']),
+                    'latitude': float(address['coordinates']['lat']),
+                })
+
+        self.route('POST', '/oauth/access_token', self.access_token)
+        self.route('GET', '/v2/carts/([^/]+)', self.get_cart)
+        self.route('POST', '/v2/carts', self.create_cart)
+        self.route('GET', '/v2/carts/([^/]+)/items', self.get_cart_items)
+        self.route('POST', '/v2/carts/([^/]+)/items', self.add_cart_item)
+        self.route('DELETE', '/v2/carts/([^/]+)/items/([^/]+)',
+                   self.remove_cart_item)
+        self.route('GET', '/v2/products', self.get_products)
+        self.route('POST', '/v2/products', self.create_product)
+        self.route('GET', '/v2/products/([^/]+)', self.get_product)
+        self.route('PUT', '/v2/products/([^/]+)', self.update_product)
+        self.route('DELETE', '/v2/products/([^/]+)', self.delete_product)
+        self.route('POST', '/v2/products/([^/]+)/relationships/main-image',
+                   self.set_main_image)
+        self.route('GET', '/v2/files', self.get_files)
+        self.route('POST', '/v2/files', self.create_file)
+        self.route('GET', '/v2/files/([^/]+)', self.get_file)
+        self.route('DELETE', '/v2/files/([^/]+)', self.delete_file)
+        self.route('POST', '/v2/customers', self.create_customer)
+        self.route('GET', '/v2/flows', self.get_flows)
+        self.route('POST', '/v2/flows', self.create_flow)
+        self.route('POST', '/v2/fields', self.create_field)
+        self.route('GET', '/v2/flows/([^/]+)/entries', self.get_entries)
+        self.route('POST', '/v2/flows/([^/]+)/entries', self.create_entry)
+        self.route('PUT', '/v2/flows/([^/]+)/entries/([^/]+)',
+                   self.update_entry)
+        self.route('DELETE', '/v2/flows/([^/]+)/entries/([^/]+)',
+                   self.delete_entry)
+
+    def add_menu_item(self, menu_item):
+        """Добавляет товар с изображением из элемента menu.json."""
+        file_id = self.add_file(menu_item['product_image']['url'])
+        product = self.add_product(menu_item['name'],
+                                   menu_item['description'],
+                                   menu_item['price'])
+        product['relationships'] = {
+            'main_image': {'data': {'type': 'main_image', 'id': file_id}},
+        }
+
+        return product
+
+    def add_product(self, name, description, price, currency='RUB'):
+        product_id = str(uuid.uuid4())
+        self.products[product_id] = {
+            'id': product_id,
+            'type': 'product',
+            'name': name,
+            'slug': slugify(name),
+            'description': description,
+            'price': [{'amount': price,
+                       'currency': currency,
+                       'includes_tax': True}],
+            'relationships': {},
+        }
+
+        return self.products[product_id]
+
+    def add_file(self, file_url):
+        file_id = str(uuid.uuid4())
+        self.files[file_id] = {
+            'id': file_id,
+            'type': 'file',
+            'link': {'href': file_url},
+        }
+
+        return file_id
+
+    def add_flow(self, name):
+        slug = slugify(name)
+        self.flows[slug] = {'id': str(uuid.uuid4()), 'name': name,
+                            'slug': slug}
+        self.entries.setdefault(slug, {})
+
+        return self.flows[slug]
+
+    def add_entry(self, slug, fields):
+        entry_id = str(uuid.uuid4())
+        self.entries.setdefault(slug, {})[entry_id] = dict(fields,
+                                                            id=entry_id)
+
+        return self.entries[slug][entry_id]
+
+    def access_token(self, request):
+        return 200, {
+            'access_token': uuid.uuid4().hex,
+            'token_type': 'Bearer',
+            'expires_in': 3600,
+            'expires': int(time.time()) + 3600,
+        }
+
+    def get_cart(self, request, cart_id):
+        self.carts.setdefault(cart_id, [])
+        return 200, {'data': {'id': cart_id, 'type': 'cart'}}
+
+    def create_cart(self, request):
+        cart_id = str(json_body(request).get('data', {}).get('id'))
+        self.carts.setdefault(cart_id, [])
+        return 201, {'data': {'id': cart_id, 'type': 'cart'}}
+
+    def get_cart_items(self, request, cart_id):
+        return 200, cart_items_response(self.carts.setdefault(cart_id, []))
+
+    def add_cart_item(self, request, cart_id):
+        data = json_body(request).get('data', {})
+        product = self.products.get(data.get('id'))
+        if product is None:
+            return 404, {'errors': [{'status': 404}]}
+
+        items = self.carts.setdefault(cart_id, [])
+        for item in items:
+            if item['product_id'] == product['id']:
+                item['quantity'] += int(data.get('quantity', 1))
+                break
+        else:
+            items.append({
+                'id': str(uuid.uuid4()),
+                'type': 'cart_item',
+                'product_id': product['id'],
+                'name': product['name'],
+                'quantity': int(data.get('quantity', 1)),
+                'unit_price': dict(product['price'][0]),
+            })
+
+        return 201, cart_items_response(items)
+
+    def remove_cart_item(self, request, cart_id, item_id):
+        items = [item for item in self.carts.get(cart_id, [])
+                 if item['id'] != item_id]
+        self.carts[cart_id] = items
+
+        return 200, cart_items_response(items)
+
+    def get_products(self, request):
+        return paginate(request, list(self.products.values()))
+
+    def create_product(self, request):
+        data = json_body(request).get('data', {})
+        price = (data.get('price') or [{}])[0]
+        product = self.add_product(data.get('name'),
+                                   data.get('description'),
+                                   price.get('amount'),
+                                   price.get('currency', 'RUB'))
+
+        return 201, {'data': product}
+
+    def get_product(self, request, product_id):
+        if product := self.products.get(product_id):
+            return 200, {'data': product}
+
+        return 404, {'errors': [{'status': 404}]}
+
+    def update_product(self, request, product_id):
+        if product_id not in self.products:
+            return 404, {'errors': [{'status': 404}]}
+
+        data = json_body(request).get('data', {})
+        self.products[product_id].update(
+            (name, value) for name, value in data.items()
+            if name in ('name', 'slug', 'description', 'price')
+        )
+
+        return 200, {'data': self.products[product_id]}
+
+    def delete_product(self, request, product_id):
+        self.products.pop(product_id, None)
+        return 204, {}
+
+    def set_main_image(self, request, product_id):
+        data = json_body(request).get('data', {})
+        self.products[product_id]['relationships'] = {
+            'main_image': {'data': {'type': 'main_image',
+                                    'id': data.get('id')}},
+        }
+
+        return 200, {'data': [data]}
+
+    def get_files(self, request):
+        return paginate(request, list(self.files.values()))
+
+    def create_file(self, request):
+        # Достаточно найти ссылку в multipart-теле запроса.
+        found = re.search(rb'(https?://[^\r\n]+)', request.body)
+        file_url = found.group(1).decode('utf-8') if found else ''
+
+        return 201, {'data': self.files[self.add_file(file_url)]}
+
+    def get_file(self, request, file_id):
+        if remote_file := self.files.get(file_id):
+            return 200, {'data': remote_file}
+
+        return 404, {'errors': [{'status': 404}]}
+
+    def delete_file(self, request, file_id):
+        self.files.pop(file_id, None)
+        return 204, {}
+
+    def create_customer(self, request):
+        data = json_body(request).get('data', {})
+        return 201, {'data': dict(data, id=str(uuid.uuid4()))}
+
+    def get_flows(self, request):
+        return 200, {'data': list(self.flows.values())}
+
+    def create_flow(self, request):
+        data = json_body(request).get('data', {})
+        return 201, {'data': self.add_flow(data.get('name'))}
+
+    def create_field(self, request):
+        data = json_body(request).get('data', {})
+        return 201, {'data': dict(data, id=str(uuid.uuid4()))}
+
+    def get_entries(self, request, slug):
+        return paginate(request, list(self.entries.get(slug, {}).values()))
+
+    def create_entry(self, request, slug):
+        data = json_body(request).get('data', {})
+        fields = {name: value for name, value in data.items()
+                  if name != 'type'}
+
+        return 201, {'data': self.add_entry(slug, fields)}
+
+    def update_entry(self, request, slug, entry_id):
+        entries = self.entries.get(slug, {})
+        if entry_id not in entries:
+            return 404, {'errors': [{'status': 404}]}
+
+        data = json_body(request).get('data', {})
+        entries[entry_id].update(
+            (name, value) for name, value in data.items()
+            if name not in ('id', 'type')
+        )
+
+        return 200, {'data': entries[entry_id]}
+
+    def delete_entry(self, request, slug, entry_id):
+        self.entries.get(slug, {}).pop(entry_id, None)
+        return 204, {}
+
+
+class FakeYandexGeocoder(FakeServer):
+    """
+    Геокодер Яндекса.
+
+    Любому адресу, кроме содержащих unknown_marker, ставит в соответствие
+    постоянную точку в окрестностях Москвы.
+    """
+
+    def __init__(self, unknown_marker='???', **kwargs):
+        super().__init__(**kwargs)
+        self.unknown_marker = unknown_marker
+        self.route('GET', '/1.x', self.geocode)
+
+    @property
+    def base_url(self):
+        return f'{self.url}/1.x'
+
+    def geocode(self, request):
+        address = request.query.get('geocode', '')
+        found_places = []
+
+        if address and self.unknown_marker not in address:
+            digest = hashlib.sha1(address.encode('utf-8')).digest()
+            lat = 55.55 + digest[0] / 255 * 0.4
+            lon = 37.35 + digest[1] / 255 * 0.5
+            found_places.append({
+                'GeoObject': {
+                    'name': address,
+                    'Point': {'pos': f'{lon:.6f} {lat:.6f}'},
+                },
+            })
+
+        return 200, {
+            'response': {
+                'GeoObjectCollection': {'featureMember': found_places},
+            },
+        }
+
+
+class FakeTelegram(FakeServer):
+    """
+    Bot API Telegram.
+
+    Запоминает последнее сообщение бота в каждом чате, чтобы генератор
+    нагрузки мог нажимать кнопки под ним.
+    """
+
+    TOKEN = '123456:FAKE-TOKEN-FOR-BENCHMARKS-ONLY-000000'
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.messages = {}
+        self.__message_ids = itertools.count(1)
+        self.__file_ids = itertools.count(1)
+
+        self.route('POST', r'/bot[^/]+/getMe', self.get_me)
+        self.route('POST', r'/bot[^/]+/(?:getUpdates|setWebhook|deleteWebhook)',
+                   self.empty)
+        self.route('POST', r'/bot[^/]+/sendMessage', self.send_message)
+        self.route('POST', r'/bot[^/]+/sendPhoto', self.send_photo)
+        self.route('POST', r'/bot[^/]+/sendDocument', self.send_document)
+        self.route('POST', r'/bot[^/]+/editMessageText',
+                   self.edit_message_text)
+        self.route('POST', r'/bot[^/]+/editMessageReplyMarkup',
+                   self.edit_message_reply_markup)
+        self.route('POST', r'/bot[^/]+/editMessageMedia',
+                   self.edit_message_media)
+        self.route('POST', r'/bot[^/]+/deleteMessage', self.ok)
+        self.route('POST', r'/bot[^/]+/answerCallbackQuery', self.ok)
+
+    @property
+    def base_url(self):
+        return f'{self.url}/bot'
+
+    def error_response(self):
+        return 429, {
+            'ok': False,
+            'error_code': 429,
+            'description': 'Too Many Requests: retry after 1',
+            'parameters': {'retry_after': 1},
+        }
+
+    def last_message(self, chat_id):
+        """Возвращает последнее сообщение бота в чате."""
+        with self.lock:
+            return self.messages.get(int(chat_id))
+
+    def get_me(self, request):
+        return 200, {'ok': True, 'result': {
+            'id': 123456, 'is_bot': True, 'first_name': 'FakeBot',
+            'username': 'fake_bot',
+        }}
+
+    def empty(self, request):
+        return 200, {'ok': True, 'result': []}
+
+    def ok(self, request):
+        return 200, {'ok': True, 'result': True}
+
+    def send_message(self, request):
+        data = self.__data(request)
+        return self.__store(data, {'text': data.get('text', '')})
+
+    def send_photo(self, request):
+        data = self.__data(request)
+        return self.__store(data, {
+            'photo': [self.__photo()],
+            'caption': data.get('caption', ''),
+        })
+
+    def send_document(self, request):
+        file_id = f'fake-document-{next(self.__file_ids)}'
+        return self.__store(self.__data(request), {
+            'document': {'file_id': file_id, 'file_unique_id': file_id},
+        })
+
+    def edit_message_text(self, request):
+        data = self.__data(request)
+        return self.__edit(data, {'text': data.get('text', '')})
+
+    def edit_message_reply_markup(self, request):
+        return self.__edit(self.__data(request), {})
+
+    def edit_message_media(self, request):
+        data = self.__data(request)
+        media = data.get('media')
+        if isinstance(media, str):
+            media = json.loads(media)
+
+        return self.__edit(data, {
+            'photo': [self.__photo()],
+            'caption': (media or {}).get('caption', ''),
+        })
+
+    def __data(self, request):
+        data = json_body(request)
+        if not data and request.body:
+            # Загрузка файла приходит как multipart, нужен только chat_id.
+            found = re.search(rb'name="chat_id"\r\n\r\n(-?\d+)', request.body)
+            data = {'chat_id': int(found.group(1))} if found else {}
+
+        return data
+
+    def __photo(self):
+        file_id = f'fake-photo-{next(self.__file_ids)}'
+        return {'file_id': file_id, 'file_unique_id': file_id,
+                'width': 640, 'height': 480}
+
+    def __store(self, data, content):
+        chat_id = int(data.get('chat_id'))
+        message = {
+            'message_id': next(self.__message_ids),
+            'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'private'},
+            **content,
+        }
+        if reply_markup := data.get('reply_markup'):
+            message['reply_markup'] = (json.loads(reply_markup)
+                                       if isinstance(reply_markup, str)
+                                       else reply_markup)
+
+        self.messages[chat_id] = message
+
+        return 200, {'ok': True, 'result': message}
+
+    def __edit(self, data, content):
+        chat_id = int(data.get('chat_id'))
+        message = dict(self.messages.get(chat_id) or {
+            'message_id': int(data.get('message_id')),
+            'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'private'},
+        })
+        if 'photo' in content:
+            message.pop('text', None)
+        if 'text' in content:
+            message.pop('photo', None)
+            message.pop('caption', None)
+        message.update(content)
+        if reply_markup := data.get('reply_markup'):
+            message['reply_markup'] = (json.loads(reply_markup)
+                                       if isinstance(reply_markup, str)
+                                       else reply_markup)
+        else:
+            message.pop('reply_markup', None)
+
+        self.messages[chat_id] = message
+
+        return 200, {'ok': True, 'result': message}
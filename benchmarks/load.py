@@ -0,0 +1,307 @@
+"""
+Нагрузочный тест бота на поддельных Moltin, геокодере и Telegram.
+
+Каждый покупатель в своём потоке проходит сценарий START → HANDLE_MENU →
+HANDLE_DESCRIPTION → HANDLE_CART → HANDLE_WAITING, нажимая кнопки под
+последним сообщением бота. Апдейты обрабатывает настоящий
+handle_users_reply. В отчёте — пропускная способность и p50/p95/p99
+по состояниям, а также число запросов к каждому поддельному сервису.
+
+Сессии, корзины и file_id фотографий пишутся в Redis из REDIS_HOST и
+REDIS_PORT, поэтому запускайте тест на отдельном Redis.
+
+Запуск из корня проекта:
+    python -m benchmarks.load --customers 50 --rounds 5 --latency 0.05
+"""
+import argparse
+import itertools
+import json
+import random
+import threading
+import time
+from collections import defaultdict
+
+import numpy as np
+from telegram import Bot, Update
+from telegram.utils.request import Request
+
+from benchmarks.fakes import (FakeMoltin, FakeTelegram,
+                              FakeYandexGeocoder)
+from catalog_cache import CatalogCache
+from database import get_database_connection
+from geocode_api import Geocode
+from moltin_api import Moltin
+from send_scheduler import ScheduledBot, SendScheduler
+from session_store import get_session_store
+from tg_bot import handle_users_reply
+
+# Первый id чата покупателя; настоящие пользователи столько не набирают.
+FIRST_CHAT_ID = 9_000_000_000
+
+
+class Customer():
+    """Покупатель, который нажимает кнопки под последним сообщением бота."""
+
+    def __init__(self, number, bot, telegram, moltin_api, geocode_api,
+                 update_ids, think_time=0.0, update_deadline=10):
+        self.chat_id = FIRST_CHAT_ID + number
+        self.bot = bot
+        self.telegram = telegram
+        self.moltin_api = moltin_api
+        self.geocode_api = geocode_api
+        self.update_ids = update_ids
+        self.think_time = think_time
+        self.update_deadline = update_deadline
+        self.timings = defaultdict(list)
+        self.failures = defaultdict(int)
+        self.__random = random.Random(number)
+
+    def __repr__(self):
+        return '<{} {}>'.format(self.__class__.__name__.upper(), self.chat_id)
+
+    def run(self, rounds):
+        """Проходит сценарий заказа rounds раз."""
+        for _ in range(rounds):
+            self.order()
+
+    def order(self):
+        """Один заказ; после сбоя следующий заказ начинается с /start."""
+        steps = (
+            ('START', self.send_text, '/start', 'HANDLE_MENU'),
+            ('HANDLE_MENU', self.press, self.is_product, 'HANDLE_DESCRIPTION'),
+            ('HANDLE_DESCRIPTION', self.press, self.is_add_to_cart,
+             'HANDLE_DESCRIPTION'),
+            ('HANDLE_DESCRIPTION', self.press, 'SHOW_CART', 'HANDLE_CART'),
+            ('HANDLE_CART', self.press, 'HANDLE_WAITING', 'HANDLE_WAITING'),
+            ('HANDLE_WAITING', self.send_text, self.address(), 'HANDLE_CART'),
+        )
+
+        for state, action, argument, next_state in steps:
+            if self.think_time:
+                time.sleep(self.__random.uniform(0, 2 * self.think_time))
+
+            if not action(state, argument, next_state):
+                return
+
+    def send_text(self, state, text, next_state):
+        return self.handle(state, next_state, {
+            'message': {
+                'message_id': next(self.update_ids),
+                'date': int(time.time()),
+                'chat': {'id': self.chat_id, 'type': 'private'},
+                'from': self.user,
+                'text': text,
+            },
+        })
+
+    def press(self, state, button, next_state):
+        message = self.telegram.last_message(self.chat_id)
+        if message is None or (data := self.find_button(message,
+                                                        button)) is None:
+            self.failures[state] += 1
+            return False
+
+        return self.handle(state, next_state, {
+            'callback_query': {
+                'id': str(next(self.update_ids)),
+                'chat_instance': str(self.chat_id),
+                'from': self.user,
+                'message': message,
+                'data': data,
+            },
+        })
+
+    def handle(self, state, next_state, payload):
+        payload['update_id'] = next(self.update_ids)
+        update = Update.de_json(payload, self.bot)
+
+        started_at = time.perf_counter()
+        handle_users_reply(self.bot,
+                           update,
+                           self.moltin_api,
+                           self.geocode_api,
+                           self.update_deadline)
+        self.timings[state].append(time.perf_counter() - started_at)
+
+        # Ошибку обработчик глотает, её видно по несменившемуся состоянию.
+        if get_session_store().load(self.chat_id).state != next_state:
+            self.failures[state] += 1
+            return False
+
+        return True
+
+    def find_button(self, message, button):
+        """Возвращает callback_data подходящей кнопки сообщения."""
+        keyboard = message.get('reply_markup', {}).get('inline_keyboard', [])
+        found = [
+            key['callback_data']
+            for row in keyboard
+            for key in row
+            if (button(key['callback_data']) if callable(button)
+                else key['callback_data'] == button)
+        ]
+
+        return self.__random.choice(found) if found else None
+
+    @staticmethod
+    def is_product(data):
+        return data != 'SHOW_CART' and not data.startswith('PAGE#')
+
+    @staticmethod
+    def is_add_to_cart(data):
+        return data.endswith('#1')
+
+    def address(self):
+        return 'Москва, ул. Тестовая, дом {}'.format(
+            self.__random.randint(1, 200))
+
+    @property
+    def user(self):
+        return {'id': self.chat_id, 'is_bot': False, 'first_name': 'Load'}
+
+
+def percentiles(timings):
+    """Возвращает p50, p95 и p99 в миллисекундах."""
+    return np.percentile(np.array(timings) * 1000, (50, 95, 99))
+
+
+def print_report(customers, elapsed, fakes):
+    timings = defaultdict(list)
+    failures = defaultdict(int)
+    for customer in customers:
+        for state, state_timings in customer.timings.items():
+            timings[state].extend(state_timings)
+        for state, count in customer.failures.items():
+            failures[state] += count
+
+    total = sum(len(state_timings) for state_timings in timings.values())
+    print(f'Апдейтов: {total} за {elapsed:.2f} с, '
+          f'{total / elapsed:.1f} апдейтов/с')
+    print()
+    print(f'{"Состояние":<20}{"апдейтов":>10}{"сбоев":>8}'
+          f'{"p50, мс":>10}{"p95, мс":>10}{"p99, мс":>10}')
+
+    for state in ('START', 'HANDLE_MENU', 'HANDLE_DESCRIPTION',
+                  'HANDLE_CART', 'HANDLE_WAITING'):
+        if not timings[state]:
+            continue
+
+        p50, p95, p99 = percentiles(timings[state])
+        print(f'{state:<20}{len(timings[state]):>10}{failures[state]:>8}'
+              f'{p50:>10.1f}{p95:>10.1f}{p99:>10.1f}')
+
+    for name, fake in fakes.items():
+        print()
+        print(f'{name}: {sum(fake.calls.values())} запросов')
+        for route, count in fake.calls.most_common():
+            print(f'    {count:>6}  {route}')
+
+
+def create_parser():
+    parser = argparse.ArgumentParser(
+        description='Нагрузочный тест бота на поддельных сервисах'
+    )
+    parser.add_argument('--customers', type=int, default=20,
+                        help='Число одновременных покупателей')
+    parser.add_argument('--rounds', type=int, default=3,
+                        help='Сколько заказов делает каждый покупатель')
+    parser.add_argument('--think-time', type=float, default=0.0,
+                        help='Средняя пауза покупателя между нажатиями, с')
+    parser.add_argument('--latency', type=float, default=0.02,
+                        help='Задержка ответа поддельных сервисов, с')
+    parser.add_argument('--jitter', type=float, default=0.01,
+                        help='Добавочная случайная задержка до, с')
+    parser.add_argument('--error-rate', type=float, default=0.0,
+                        help='Доля ответов с ошибкой (503, у Telegram 429)')
+    parser.add_argument('--telegram-rate', type=float, default=30,
+                        help='Лимит сообщений в секунду на всего бота')
+    parser.add_argument('--chat-rate', type=float, default=1,
+                        help='Лимит сообщений в секунду на чат')
+    parser.add_argument('--update-deadline', type=float, default=10,
+                        help='Время на обработку одного апдейта, с')
+
+    return parser
+
+
+def start_fakes(latency=0.0, jitter=0.0, error_rate=0.0):
+    """Запускает поддельные сервисы с меню и адресами из load_data."""
+    fake_kwargs = {
+        'latency': latency,
+        'jitter': jitter,
+        'error_rate': error_rate,
+    }
+
+    with open('load_data/menu.json', 'r', encoding='utf-8') as file:
+        menu_items = json.load(file)
+    with open('load_data/addresses.json', 'r', encoding='utf-8') as file:
+        addresses = json.load(file)
+
+    return {
+        'Moltin': FakeMoltin(menu_items, addresses, **fake_kwargs).start(),
+        'Yandex': FakeYandexGeocoder(**fake_kwargs).start(),
+        'Telegram': FakeTelegram(**fake_kwargs).start(),
+    }
+
+
+def create_clients(fakes, workers=8, telegram_rate=30, chat_rate=1):
+    """Возвращает бота, очередь отправки и клиенты Moltin и геокодера."""
+    moltin_api = Moltin('fake-client-id',
+                        pool_size=workers,
+                        catalog_cache=CatalogCache(ttl=300),
+                        api_url=fakes['Moltin'].url)
+    geocode_api = Geocode('',
+                          redis_db=get_database_connection(),
+                          base_url=fakes['Yandex'].base_url)
+    send_scheduler = SendScheduler(global_rate=telegram_rate,
+                                   chat_rate=chat_rate,
+                                   workers=min(workers, 32))
+    bot = ScheduledBot(
+        Bot(FakeTelegram.TOKEN,
+            base_url=fakes['Telegram'].base_url,
+            request=Request(con_pool_size=min(workers, 32) + 8)),
+        send_scheduler,
+    )
+
+    return bot, send_scheduler, moltin_api, geocode_api
+
+
+def main():
+    args = create_parser().parse_args()
+
+    fakes = start_fakes(args.latency, args.jitter, args.error_rate)
+    bot, send_scheduler, moltin_api, geocode_api = create_clients(
+        fakes,
+        workers=args.customers,
+        telegram_rate=args.telegram_rate,
+        chat_rate=args.chat_rate,
+    )
+
+    update_ids = itertools.count(1)
+    customers = [
+        Customer(number, bot, fakes['Telegram'], moltin_api, geocode_api,
+                 update_ids,
+                 think_time=args.think_time,
+                 update_deadline=args.update_deadline)
+        for number in range(args.customers)
+    ]
+    threads = [
+        threading.Thread(target=customer.run, args=(args.rounds,))
+        for customer in customers
+    ]
+
+    started_at = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started_at
+
+    send_scheduler.stop()
+    for fake in fakes.values():
+        fake.stop()
+
+    print_report(customers, elapsed, fakes)
+
+
+if __name__ == '__main__':
+    main()
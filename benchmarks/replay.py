@@ -0,0 +1,314 @@
+"""
+Повторный прогон записанных апдейтов и сравнение прогонов.
+
+run прогоняет запись TRAFFIC_CAPTURE_PATH через handle_users_reply на
+поддельных Moltin, геокодере и Telegram, в исходном темпе (--speed 1),
+ускоренно (--speed 10) или без пауз (--speed 0), и сам записывает
+прогон в том же формате. diff сравнивает две записи: время обработки
+по состояниям и число вызовов Moltin и геокодера на апдейт. Если
+что-то ухудшилось больше порога, команда завершается с кодом 1.
+
+Сессии и корзины пишутся в Redis, поэтому запускайте прогон на
+отдельном Redis.
+
+Запуск из корня проекта:
+    python -m benchmarks.replay run capture.jsonl --output base.jsonl
+    python -m benchmarks.replay run capture.jsonl --output new.jsonl
+    python -m benchmarks.replay diff base.jsonl new.jsonl
+"""
+import argparse
+import itertools
+import json
+import re
+import sys
+import time
+from collections import defaultdict
+
+from telegram import Update
+
+from benchmarks.load import create_clients, percentiles, start_fakes
+from chat_executor import ChatExecutor
+from session_store import get_session_store
+from tg_bot import handle_users_reply
+from traffic_capture import disable_traffic_capture, enable_traffic_capture
+
+STATES = ('START', 'HANDLE_MENU', 'HANDLE_DESCRIPTION', 'HANDLE_CART',
+          'HANDLE_WAITING')
+
+UUID_PATTERN = re.compile(
+    r'[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}'
+)
+
+
+def read_capture(path):
+    """Читает записанные апдейты, отсортированные по времени."""
+    with open(path, 'r', encoding='utf-8') as file:
+        entries = [json.loads(line) for line in file if line.strip()]
+
+    return sorted(entries, key=lambda entry: entry['ts'])
+
+
+def get_entry_chat_id(entry):
+    update = entry['update']
+    if message := update.get('message'):
+        return message['chat']['id']
+
+    return update['callback_query']['message']['chat']['id']
+
+
+class Replayer():
+    """
+    Прогоняет записанные апдейты через бота на поддельных сервисах.
+
+    Id товаров из записи заменяются товарами поддельного Moltin, а id
+    позиций корзины — позициями корзины этого чата. Кнопка нажимается
+    под последним сообщением, которое бот отправил в чат при прогоне.
+    """
+
+    def __init__(self, bot, fakes, moltin_api, geocode_api,
+                 update_deadline=10):
+        self.bot = bot
+        self.fakes = fakes
+        self.moltin_api = moltin_api
+        self.geocode_api = geocode_api
+        self.update_deadline = update_deadline
+        self.__product_ids = {}
+        self.__fake_product_ids = itertools.cycle(
+            list(fakes['Moltin'].products))
+
+    def __repr__(self):
+        return '<{}>'.format(self.__class__.__name__.upper())
+
+    def start_chat(self, chat_id, state):
+        """Переводит чат в состояние, с которого начинается запись."""
+        session_store = get_session_store()
+        session = session_store.load(chat_id)
+        session.state = state
+        session_store.save(session)
+
+    def replay(self, entry):
+        """Обрабатывает записанный апдейт."""
+        payload = json.loads(json.dumps(entry['update']))
+
+        if query := payload.get('callback_query'):
+            chat_id = query['message']['chat']['id']
+            query['data'] = self.map_data(chat_id, entry['state'],
+                                          query.get('data') or '')
+            if message := self.fakes['Telegram'].last_message(chat_id):
+                query['message'] = message
+
+        handle_users_reply(self.bot,
+                           Update.de_json(payload, self.bot),
+                           self.moltin_api,
+                           self.geocode_api,
+                           self.update_deadline)
+
+    def map_data(self, chat_id, state, data):
+        """Заменяет id Moltin в callback_data на id поддельного Moltin."""
+        if not UUID_PATTERN.search(data):
+            return data
+
+        if state == 'HANDLE_CART':
+            cart_items = self.fakes['Moltin'].carts.get(str(chat_id))
+            return cart_items[0]['id'] if cart_items else data
+
+        return UUID_PATTERN.sub(self.map_product_id, data)
+
+    def map_product_id(self, match):
+        product_id = match.group(0)
+        if product_id not in self.__product_ids:
+            self.__product_ids[product_id] = next(self.__fake_product_ids)
+
+        return self.__product_ids[product_id]
+
+
+def run(args):
+    entries = read_capture(args.capture)
+    if not entries:
+        sys.exit(f'В {args.capture} нет апдейтов')
+
+    fakes = start_fakes(args.latency, args.jitter, args.error_rate)
+    bot, send_scheduler, moltin_api, geocode_api = create_clients(
+        fakes,
+        workers=args.workers,
+        telegram_rate=args.telegram_rate,
+        chat_rate=args.chat_rate,
+    )
+    replayer = Replayer(bot, fakes, moltin_api, geocode_api,
+                        update_deadline=args.update_deadline)
+    chat_executor = ChatExecutor(args.workers)
+
+    # Чат продолжает с того состояния, в котором его застала запись.
+    started_chats = set()
+    for entry in entries:
+        chat_id = get_entry_chat_id(entry)
+        if chat_id not in started_chats:
+            replayer.start_chat(chat_id, entry['state'])
+            started_chats.add(chat_id)
+
+    enable_traffic_capture(args.output, salt='replay')
+
+    first_ts = entries[0]['ts']
+    started_at = time.monotonic()
+    for entry in entries:
+        if args.speed:
+            delay = (entry['ts'] - first_ts) / args.speed
+            time.sleep(max(started_at + delay - time.monotonic(), 0))
+
+        chat_executor.submit(get_entry_chat_id(entry), replayer.replay, entry)
+
+    chat_executor.shutdown()
+    elapsed = time.monotonic() - started_at
+
+    disable_traffic_capture()
+    send_scheduler.stop()
+    for fake in fakes.values():
+        fake.stop()
+
+    print(f'Прогнано апдейтов: {len(entries)} за {elapsed:.2f} с, '
+          f'запись в {args.output}')
+
+
+def summarize(entries):
+    """Собирает время обработки по состояниям и вызовы по операциям."""
+    durations = defaultdict(list)
+    errors = defaultdict(int)
+    calls = defaultdict(list)
+
+    for entry in entries:
+        durations[entry['state']].append(entry['duration'])
+        if entry.get('error'):
+            errors[entry['state']] += 1
+
+        for call in entry['calls']:
+            operation = '{} {}'.format(call['service'], call['operation'])
+            calls[operation].append(call['duration'])
+
+    return {
+        'updates': len(entries),
+        'durations': durations,
+        'errors': errors,
+        'calls': calls,
+    }
+
+
+def change(base, new):
+    """Возвращает относительное изменение значения."""
+    if not base:
+        return float('inf') if new else 0.0
+
+    return (new - base) / base
+
+
+def diff(args):
+    base = summarize(read_capture(args.base))
+    new = summarize(read_capture(args.new))
+    regressions = 0
+
+    def mark(value_change):
+        nonlocal regressions
+        if value_change > args.threshold:
+            regressions += 1
+            return '  !'
+
+        return ''
+
+    print(f'Апдейтов: {base["updates"]} → {new["updates"]}')
+    print()
+    print(f'{"Состояние":<20}{"апдейтов":>16}{"ошибок":>12}'
+          f'{"p50, мс":>20}{"p95, мс":>20}')
+
+    states = [state for state in STATES
+              if base['durations'][state] or new['durations'][state]]
+    for state in states:
+        base_durations = base['durations'][state]
+        new_durations = new['durations'][state]
+        if not base_durations or not new_durations:
+            print(f'{state:<20}{len(base_durations):>7} → '
+                  f'{len(new_durations):<6}')
+            continue
+
+        base_p50, base_p95, _ = percentiles(base_durations)
+        new_p50, new_p95, _ = percentiles(new_durations)
+        base_error_rate = base['errors'][state] / len(base_durations)
+        new_error_rate = new['errors'][state] / len(new_durations)
+
+        print(f'{state:<20}'
+              f'{len(base_durations):>7} → {len(new_durations):<6}'
+              f'{base["errors"][state]:>4} → {new["errors"][state]:<5}'
+              f'{base_p50:>9.1f} → {new_p50:<8.1f}'
+              f'{base_p95:>9.1f} → {new_p95:<8.1f}'
+              f'{mark(change(base_p95, new_p95))}'
+              f'{mark(new_error_rate - base_error_rate)}')
+
+    print()
+    print(f'{"Вызов":<45}{"на апдейт":>18}{"среднее, мс":>22}')
+
+    for operation in sorted(set(base['calls']) | set(new['calls'])):
+        base_calls = base['calls'][operation]
+        new_calls = new['calls'][operation]
+        base_per_update = len(base_calls) / max(base['updates'], 1)
+        new_per_update = len(new_calls) / max(new['updates'], 1)
+        base_mean = (sum(base_calls) / len(base_calls) * 1000
+                     if base_calls else 0)
+        new_mean = (sum(new_calls) / len(new_calls) * 1000
+                    if new_calls else 0)
+
+        print(f'{operation:<45}'
+              f'{base_per_update:>8.2f} → {new_per_update:<7.2f}'
+              f'{base_mean:>10.1f} → {new_mean:<9.1f}'
+              f'{mark(change(base_per_update, new_per_update))}')
+
+    if regressions:
+        print()
+        print(f'Ухудшений больше {args.threshold:.0%}: {regressions}')
+        sys.exit(1)
+
+
+def create_parser():
+    parser = argparse.ArgumentParser(
+        description='Повторный прогон записанных апдейтов'
+    )
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    run_parser = subparsers.add_parser(
+        'run', help='Прогнать запись на поддельных сервисах')
+    run_parser.add_argument('capture', help='Файл записи апдейтов')
+    run_parser.add_argument('--output', default='replay.jsonl',
+                            help='Куда записать прогон')
+    run_parser.add_argument('--speed', type=float, default=1,
+                            help='Ускорение относительно записи, 0 — без пауз')
+    run_parser.add_argument('--workers', type=int, default=16,
+                            help='Число потоков обработки апдейтов')
+    run_parser.add_argument('--latency', type=float, default=0.02,
+                            help='Задержка ответа поддельных сервисов, с')
+    run_parser.add_argument('--jitter', type=float, default=0.01,
+                            help='Добавочная случайная задержка до, с')
+    run_parser.add_argument('--error-rate', type=float, default=0.0,
+                            help='Доля ответов с ошибкой')
+    run_parser.add_argument('--telegram-rate', type=float, default=30,
+                            help='Лимит сообщений в секунду на всего бота')
+    run_parser.add_argument('--chat-rate', type=float, default=1,
+                            help='Лимит сообщений в секунду на чат')
+    run_parser.add_argument('--update-deadline', type=float, default=10,
+                            help='Время на обработку одного апдейта, с')
+    run_parser.set_defaults(func=run)
+
+    diff_parser = subparsers.add_parser(
+        'diff', help='Сравнить два прогона')
+    diff_parser.add_argument('base', help='Запись прогона до изменений')
+    diff_parser.add_argument('new', help='Запись прогона после изменений')
+    diff_parser.add_argument('--threshold', type=float, default=0.2,
+                             help='Допустимое ухудшение, доля')
+    diff_parser.set_defaults(func=diff)
+
+    return parser
+
+
+def main():
+    args = create_parser().parse_args()
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
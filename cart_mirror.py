@@ -0,0 +1,147 @@
+import json
+import logging
+import time
+
+from environs import Env
+
+from database import get_database_connection
+from instrumentation import cache_lookup
+
+_cart_mirror = None
+
+logger = logging.getLogger('pizza-shop')
+
+
+class CartMirror():
+    """
+    Копия корзин Moltin в Redis.
+
+    Добавление и удаление товара идут в Moltin, а его ответ со всем
+    содержимым корзины и её стоимостью, посчитанной Moltin, сразу
+    записывается в копию. Поэтому для показа
+    корзины запрос к Moltin нужен, только если копия старше
+    reconcile_interval секунд или её нет.
+    """
+
+    KEY = 'cart:{}'
+
+    def __init__(self, redis_db, reconcile_interval=300, ttl=24 * 60 * 60):
+        self.reconcile_interval = reconcile_interval
+        self.ttl = ttl
+        self.__redis_db = redis_db
+
+    def __repr__(self):
+        return '<{}>'.format(self.__class__.__name__.upper())
+
+    def ensure_cart(self, moltin_api, cart_id):
+        """Создаёт корзину в Moltin, если её ещё нет в копии."""
+        if not self.__redis_db.exists(self.KEY.format(cart_id)):
+            moltin_api.get_or_create_cart(cart_id)
+            self.reconcile(moltin_api, cart_id)
+
+    def get_cart(self, moltin_api, cart_id):
+        """
+        Возвращает корзину: словарь с товарами в items и стоимостью в cost.
+
+        cost — стоимость с налогами в формате Moltin, либо None, если
+        копия записана без неё.
+        """
+        if mirrored := self.__redis_db.get(self.KEY.format(cart_id)):
+            cart = json.loads(mirrored)
+
+            if time.time() - cart['synced_at'] < self.reconcile_interval:
+                cache_lookup('cart', True)
+                return cart
+
+        cache_lookup('cart', False)
+        return self.__store(cart_id, moltin_api.get_cart_items(cart_id))
+
+    def add_item(self, moltin_api, cart_id, item_id, quantity=1):
+        """Добавляет товар в корзину."""
+        cart_items = moltin_api.add_cart_item(cart_id,
+                                              item_id=item_id,
+                                              quantity=quantity)
+
+        return self.__store(cart_id, cart_items)['items']
+
+    def remove_item(self, moltin_api, cart_id, item_id):
+        """Удаляет товар из корзины."""
+        cart_items = moltin_api.remove_cart_item(cart_id, item_id)
+
+        return self.__store(cart_id, cart_items)['items']
+
+    def reconcile(self, moltin_api, cart_id):
+        """Перечитывает корзину из Moltin."""
+        cart_items = moltin_api.get_cart_items(cart_id)
+
+        return self.__store(cart_id, cart_items)['items']
+
+    def __store(self, cart_id, cart_items):
+        cost = (cart_items.get('meta', {})
+                          .get('display_price', {})
+                          .get('with_tax', {})
+                          .get('formatted'))
+        items = [
+            {
+                'id': item.get('id'),
+                'product_id': item.get('product_id'),
+                'name': item.get('name'),
+                'quantity': item.get('quantity', 0),
+                'unit_price': item.get('unit_price', {}),
+            }
+            for item in cart_items.get('data', [])
+        ]
+
+        cart = {'items': items, 'cost': cost, 'synced_at': time.time()}
+        self.__redis_db.set(self.KEY.format(cart_id),
+                            json.dumps(cart, ensure_ascii=False),
+                            ex=self.ttl)
+
+        return cart
+
+
+def get_cart_cost(moltin_api, cart):
+    """
+    Возвращает стоимость корзины, посчитанную Moltin.
+
+    Если в копии корзины её нет, стоимость считается по ценам каталога,
+    загруженного одним запросом, а для товаров не из каталога — по цене
+    из самой корзины.
+    """
+    if cart.get('cost'):
+        return cart['cost']
+
+    try:
+        prices = {
+            product.get('id'): product.get('price')[0]
+            for product in moltin_api.get_products()
+            if product.get('price')
+        }
+    except Exception as err:
+        logger.debug('Нет цен каталога: %s', err)
+        prices = {}
+
+    total = 0
+    currency = 'RUB'
+
+    for item in cart['items']:
+        price = prices.get(item.get('product_id'), item.get('unit_price', {}))
+        total += price.get('amount', 0) * item.get('quantity', 0)
+        currency = price.get('currency', currency)
+
+    return f'{total / 100} {currency}'
+
+
+def get_cart_mirror():
+    """Возвращает копию корзин, либо создаёт новую, если она ещё не создана."""
+    global _cart_mirror
+    if _cart_mirror is None:
+        env = Env()
+        env.read_env()
+
+        _cart_mirror = CartMirror(
+            get_database_connection(),
+            reconcile_interval=env.int('CART_RECONCILE_INTERVAL', 300),
+        )
+
+    return _cart_mirror
@@ -0,0 +1,167 @@
+import logging
+import threading
+import time
+from functools import partial
+
+from instrumentation import cache_lookup
+from single_flight import SingleFlight
+
+logger = logging.getLogger('pizza-shop')
+
+UNCHECKED = object()
+
+
+class CatalogCache():
+    """
+    Кэш каталога в памяти процесса.
+
+    Просроченная запись продолжает отдаваться, пока в фоне идёт
+    единственное обновление (stale-while-revalidate). Одновременные
+    загрузки ключа объединяются: при промахе loader вызывает один поток,
+    остальные ждут его результат, в том числе если ключ уже обновляется
+    в фоне. Если передан Redis, сброс кэша виден всем процессам через
+    общий номер версии каталога.
+    """
+
+    VERSION_KEY = 'catalog:version'
+
+    def __init__(self, ttl=300, redis_db=None, version_check_interval=5):
+        self.ttl = ttl
+        self.__entries = {}
+        self.__refreshing = set()
+        self.__lock = threading.Lock()
+        self.__single_flight = SingleFlight()
+        self.__redis_db = redis_db
+        self.__version_check_interval = version_check_interval
+        self.__version_checked_at = 0
+        self.__remote_version = UNCHECKED
+
+    def __repr__(self):
+        return '<{}>'.format(self.__class__.__name__.upper())
+
+    def get(self, key, loader):
+        """Возвращает значение по ключу, загружая его через loader при промахе."""
+        found, value, is_stale = self.lookup(key)
+
+        if not found:
+            value = self.load(key, loader)
+        elif is_stale:
+            self.refresh_in_background(key, loader)
+
+        return value
+
+    def lookup(self, key):
+        """Возвращает тройку (найдено ли, значение, просрочено ли)."""
+        self.check_remote_version()
+
+        with self.__lock:
+            entry = self.__entries.get(key)
+
+        if entry is None:
+            cache_lookup('catalog', False)
+            return False, None, False
+
+        value, expires_at = entry
+        is_stale = time.monotonic() > expires_at
+        cache_lookup('catalog', 'stale' if is_stale else True)
+
+        return True, value, is_stale
+
+    def load(self, key, loader):
+        """
+        Загружает ключ через loader и сохраняет его.
+
+        Если ключ уже загружается, дожидается той загрузки, а не вызывает
+        loader ещё раз.
+        """
+        return self.__single_flight.do(key, partial(self.__load, key, loader))
+
+    def __load(self, key, loader):
+        # Ключ мог загрузиться, пока вызывающий шёл сюда после промаха.
+        with self.__lock:
+            entry = self.__entries.get(key)
+        if entry is not None and time.monotonic() <= entry[1]:
+            return entry[0]
+
+        value = loader()
+        self.set(key, value)
+
+        return value
+
+    def peek(self, key):
+        """Возвращает значение по ключу без загрузки, даже просроченное."""
+        return self.lookup(key)[1]
+
+    def set(self, key, value):
+        """Сохраняет значение по ключу."""
+        with self.__lock:
+            self.__entries[key] = (value, time.monotonic() + self.ttl)
+
+    def invalidate(self, key=None):
+        """Сбрасывает ключ или весь кэш, в том числе в других процессах."""
+        with self.__lock:
+            if key is None:
+                self.__entries.clear()
+            else:
+                self.__entries.pop(key, None)
+
+        if key is None and self.__redis_db is not None:
+            remote_version = self.__redis_db.incr(self.VERSION_KEY)
+            self.__remote_version = str(remote_version).encode()
+
+    def claim_refresh(self, key):
+        """Отмечает начало обновления ключа, если оно ещё не идёт."""
+        with self.__lock:
+            if key in self.__refreshing:
+                return False
+            self.__refreshing.add(key)
+
+            return True
+
+    def release_refresh(self, key):
+        """Отмечает окончание обновления ключа."""
+        with self.__lock:
+            self.__refreshing.discard(key)
+
+    def refresh_in_background(self, key, loader):
+        """Запускает обновление ключа, если оно ещё не запущено."""
+        if not self.claim_refresh(key):
+            return
+
+        thread = threading.Thread(
+            target=self.__refresh,
+            args=(key, loader),
+            name=f'catalog-refresh-{key}',
+            daemon=True,
+        )
+        thread.start()
+
+    def __refresh(self, key, loader):
+        try:
+            self.load(key, loader)
+        except Exception as err:
+            logger.warning('Не удалось обновить %s: %s', key, err)
+        finally:
+            self.release_refresh(key)
+
+    def check_remote_version(self):
+        """Сбрасывает кэш, если каталог был изменён другим процессом."""
+        if self.__redis_db is None:
+            return
+
+        now = time.monotonic()
+        if now - self.__version_checked_at < self.__version_check_interval:
+            return
+        self.__version_checked_at = now
+
+        try:
+            remote_version = self.__redis_db.get(self.VERSION_KEY)
+        except Exception as err:
+            logger.warning('Не удалось проверить версию каталога: %s', err)
+            return
+
+        if remote_version != self.__remote_version:
+            if self.__remote_version is not UNCHECKED:
+                with self.__lock:
+                    self.__entries.clear()
+            self.__remote_version = remote_version
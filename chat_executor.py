@@ -0,0 +1,79 @@
+import logging
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from metrics import BUSY_CHATS, CHAT_QUEUE_DEPTH, QUEUED_UPDATES
+
+logger = logging.getLogger('pizza-shop')
+
+
+class ChatExecutor():
+    """
+    Пул потоков для обработки апдейтов.
+
+    Апдейты разных чатов выполняются параллельно, апдейты одного чата —
+    строго по очереди, в порядке поступления. Поэтому чтение и запись
+    состояния чата в handle_users_reply не пересекаются между собой.
+    """
+
+    def __init__(self, workers=8):
+        self.workers = workers
+        self.__pool = ThreadPoolExecutor(max_workers=workers,
+                                         thread_name_prefix='chat')
+        self.__queues = {}
+        self.__lock = threading.Lock()
+        self.__idle = threading.Condition(self.__lock)
+
+    def __repr__(self):
+        return '<{} workers={}>'.format(self.__class__.__name__.upper(),
+                                        self.workers)
+
+    def submit(self, chat_id, func, *args, **kwargs):
+        """Ставит вызов в очередь чата."""
+        with self.__lock:
+            queue = self.__queues.setdefault(chat_id, deque())
+            queue.append((func, args, kwargs))
+            depth = len(queue)
+
+        CHAT_QUEUE_DEPTH.observe(depth)
+        QUEUED_UPDATES.inc()
+
+        # Очередь была пустой, значит чат сейчас никто не обрабатывает.
+        if depth == 1:
+            BUSY_CHATS.inc()
+            self.__pool.submit(self.__run_next, chat_id)
+
+    def __run_next(self, chat_id):
+        with self.__lock:
+            func, args, kwargs = self.__queues[chat_id][0]
+
+        try:
+            func(*args, **kwargs)
+        except Exception:
+            logger.exception('Ошибка обработки апдейта чата %s', chat_id)
+        finally:
+            QUEUED_UPDATES.dec()
+
+            with self.__lock:
+                queue = self.__queues[chat_id]
+                queue.popleft()
+                if not queue:
+                    del self.__queues[chat_id]
+                if not self.__queues:
+                    self.__idle.notify_all()
+
+            # Следующий апдейт чата снова встаёт в общий пул, чтобы
+            # один активный чат не занимал поток целиком.
+            if queue:
+                self.__pool.submit(self.__run_next, chat_id)
+            else:
+                BUSY_CHATS.dec()
+
+    def shutdown(self, wait=True):
+        """Останавливает пул потоков, при wait=True дождавшись всех очередей."""
+        if wait:
+            with self.__idle:
+                self.__idle.wait_for(lambda: not self.__queues)
+
+        self.__pool.shutdown(wait=wait)
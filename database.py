@@ -0,0 +1,60 @@
+import redis
+from environs import Env
+from redis.client import Pipeline
+
+from instrumentation import call_timer
+
+_database = None
+
+
+class InstrumentedPipeline(Pipeline):
+    """Конвейер Redis, замеряющий отправку всех команд разом."""
+
+    def execute(self, raise_on_error=True):
+        with call_timer('redis', 'PIPELINE'):
+            return super().execute(raise_on_error)
+
+
+class InstrumentedRedis(redis.Redis):
+    """Клиент Redis, замеряющий каждую команду через instrumentation."""
+
+    def execute_command(self, *args, **options):
+        with call_timer('redis', args[0]):
+            return super().execute_command(*args, **options)
+
+    def pipeline(self, transaction=True, shard_hint=None):
+        return InstrumentedPipeline(self.connection_pool,
+                                    self.response_callbacks,
+                                    transaction,
+                                    shard_hint)
+
+
+def get_database_connection():
+    """
+    Возвращает конекшн с базой данных Redis, либо создаёт новый, если он ещё не создан.
+    """
+    global _database
+    if _database is None:
+        env = Env()
+        env.read_env()
+
+        database_host = env.str('REDIS_HOST', 'localhost')
+        database_port = env.str('REDIS_PORT', 6379)
+        database_username = env.str('REDIS_USERNAME', '')
+        database_password = env.str('REDIS_PASSWORD', '')
+        database_max_connections = env.int('REDIS_MAX_CONNECTIONS', 20)
+
+        # Пул ждёт освободившееся соединение вместо ошибки,
+        # когда все соединения заняты потоками бота.
+        connection_pool = redis.BlockingConnectionPool(
+            host=database_host,
+            port=database_port,
+            username=database_username,
+            password=database_password,
+            max_connections=database_max_connections,
+            timeout=5,
+        )
+
+        _database = InstrumentedRedis(connection_pool=connection_pool)
+
+    return _database
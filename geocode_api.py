@@ -1,29 +1,204 @@
+import asyncio
+import hashlib
+import json
+import logging
+import re
+import threading
+import time
+from collections import OrderedDict
+from functools import partial
+
+import numpy as np
 import requests
 from geopy.distance import distance, lonlat
 
+from instrumentation import cache_lookup, call_timer
+from single_flight import SingleFlight
+
+EARTH_RADIUS_KM = 6371.0088
+
+logger = logging.getLogger('pizza-shop')
+
+
+def normalize_address(address):
+    """Приводит текст адреса к виду, по которому он ищется в кэше."""
+    address = address.lower().replace('ё', 'е')
+    address = re.sub(r'[\s,.;]+', ' ', address)
+
+    return address.strip()
+
+
+def parse_coordinates(geocoder_response):
+    """Достаёт координаты самого подходящего места из ответа геокодера."""
+    found_places = geocoder_response[
+        'response']['GeoObjectCollection']['featureMember']
+
+    if not found_places:
+        return None
+
+    most_relevant = found_places[0]
+    lon, lat = most_relevant['GeoObject']['Point']['pos'].split(" ")
+    return float(lat), float(lon)
+
+
+class LRUCache():
+    """Потокобезопасный LRU-кэш в памяти, у каждой записи свой срок жизни."""
+
+    def __init__(self, max_size=1024):
+        self.max_size = max_size
+        self.__entries = OrderedDict()
+        self.__lock = threading.Lock()
+
+    def get(self, key):
+        """Возвращает пару (найдено ли, значение)."""
+        with self.__lock:
+            entry = self.__entries.get(key)
+            if entry is None:
+                return False, None
+
+            value, expires_at = entry
+            if time.monotonic() > expires_at:
+                del self.__entries[key]
+                return False, None
+
+            self.__entries.move_to_end(key)
+
+            return True, value
+
+    def set(self, key, value, ttl):
+        """Сохраняет значение на ttl секунд."""
+        with self.__lock:
+            self.__entries[key] = (value, time.monotonic() + ttl)
+            self.__entries.move_to_end(key)
+
+            while len(self.__entries) > self.max_size:
+                self.__entries.popitem(last=False)
+
 
 class Geocode():
-    def __init__(self, apikey) -> None:
+    """
+    Клиент геокодера Яндекса.
+
+    Координаты кэшируются в памяти процесса и, если передан Redis, в общем
+    кэше всех процессов. Ненайденные адреса кэшируются на меньший срок.
+    """
+
+    BASE_URL = 'https://geocode-maps.yandex.ru/1.x'
+    CACHE_KEY = 'geocode:{}'
+
+    def __init__(self,
+                 apikey,
+                 redis_db=None,
+                 cache_size=1024,
+                 hit_ttl=30 * 24 * 60 * 60,
+                 miss_ttl=60 * 60,
+                 timeout=5,
+                 base_url=None) -> None:
         self.apikey = apikey
+        self.base_url = base_url or self.BASE_URL
+        self.hit_ttl = hit_ttl
+        self.miss_ttl = miss_ttl
+        self.timeout = timeout
+        self.session = self.create_session()
+        self._redis_db = redis_db
+        self._local_cache = LRUCache(cache_size)
+        self.__single_flight = SingleFlight()
+
+    @staticmethod
+    def create_session():
+        """Создаёт HTTP-сессию с keep-alive соединениями."""
+        return requests.Session()
+
+    def close(self):
+        """Закрывает соединения сессии."""
+        self.session.close()
 
     def fetch_coordinates(self, address):
         """Получение координат по адресу."""
-        base_url = "https://geocode-maps.yandex.ru/1.x"
-        response = requests.get(base_url, params={
+        normalized_address = normalize_address(address)
+
+        found, coords = self._local_cache.get(normalized_address)
+        cache_lookup('geocode', found)
+        if found:
+            return coords
+
+        return self.__single_flight.do(
+            normalized_address,
+            partial(self.__lookup_coordinates, address, normalized_address)
+        )
+
+    def __lookup_coordinates(self, address, normalized_address):
+        # Нормализованный адрес — только ключ кэша: геокодеру уходит
+        # адрес как его написал пользователь, с номерами вроде «д. 5/2».
+        cache_key = self._cache_key(normalized_address)
+
+        found, coords = self._get_shared(cache_key)
+        if not found:
+            coords = self.request_coordinates(address)
+
+        ttl = self._remember(normalized_address, coords)
+        if not found:
+            self._set_shared(cache_key, coords, ttl)
+
+        return coords
+
+    def _cache_key(self, normalized_address):
+        return self.CACHE_KEY.format(
+            hashlib.sha1(normalized_address.encode('utf-8')).hexdigest()
+        )
+
+    def _remember(self, normalized_address, coords):
+        """Кладёт координаты в кэш процесса и возвращает их срок жизни."""
+        ttl = self.hit_ttl if coords else self.miss_ttl
+        self._local_cache.set(normalized_address, coords, ttl)
+
+        return ttl
+
+    def _get_shared(self, cache_key):
+        if self._redis_db is None:
+            return False, None
+
+        try:
+            cached = self._redis_db.get(cache_key)
+        except Exception as err:
+            logger.warning('Не удалось прочитать кэш геокодера: %s', err)
+            return False, None
+
+        cache_lookup('geocode_redis', cached is not None)
+        if cached is None:
+            return False, None
+
+        coords = json.loads(cached)
+
+        return True, tuple(coords) if coords else None
+
+    def _set_shared(self, cache_key, coords, ttl):
+        if self._redis_db is None:
+            return
+
+        try:
+            self._redis_db.set(cache_key, json.dumps(coords), ex=ttl)
+        except Exception as err:
+            logger.warning('Не удалось записать кэш геокодера: %s', err)
+
+    def _request_params(self, address):
+        return {
             "geocode": address,
             "apikey": self.apikey,
             "format": "json",
-        })
-        response.raise_for_status()
-        found_places = response.json(
-        )['response']['GeoObjectCollection']['featureMember']
+        }
 
-        if not found_places:
-            return None
+    def request_coordinates(self, address):
+        """Запрашивает координаты адреса у геокодера, минуя кэш."""
+        with call_timer('yandex', 'geocode'):
+            response = self.session.get(
+                self.base_url,
+                params=self._request_params(address),
+                timeout=self.timeout
+            )
+        response.raise_for_status()
 
-        most_relevant = found_places[0]
-        lon, lat = most_relevant['GeoObject']['Point']['pos'].split(" ")
-        return float(lat), float(lon)
+        return parse_coordinates(response.json())
 
     def calculate_distance(self, coords_from, coords_to):
         """Рассчитывает расстояние между двумя точками."""
@@ -31,3 +206,112 @@ class Geocode():
             return round(distance(coords_from, coords_to).km, 2)
 
         return None
+
+    def calculate_distances(self, coords_from, coords_to, geodesic=False):
+        """
+        Рассчитывает расстояния, км, сразу для массива точек.
+
+        coords_from - одна точка (широта, долгота) или массив точек формы (N, 2),
+        coords_to - массив точек формы (N, 2).
+        По умолчанию считает по формуле гаверсинусов на сфере: относительная
+        погрешность против эллипсоида geopy не больше 0.6%. С geodesic=True
+        считает точное расстояние по эллипсоиду WGS-84, но по одной паре за раз.
+        """
+        coords_from = np.asarray(coords_from, dtype=float)
+        coords_to = np.asarray(coords_to, dtype=float).reshape(-1, 2)
+        coords_from = np.broadcast_to(coords_from, coords_to.shape)
+
+        if geodesic:
+            return np.array([
+                distance(point_from, point_to).km
+                for point_from, point_to in zip(coords_from, coords_to)
+            ])
+
+        lat_from, lon_from = np.radians(coords_from).T
+        lat_to, lon_to = np.radians(coords_to).T
+
+        haversine = (
+            np.sin((lat_to - lat_from) / 2) ** 2
+            + np.cos(lat_from) * np.cos(lat_to)
+            * np.sin((lon_to - lon_from) / 2) ** 2
+        )
+
+        return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(haversine))
+
+
+class AsyncGeocode(Geocode):
+    """
+    Асинхронный клиент геокодера Яндекса с тем же набором методов.
+
+    Одновременные запросы одного адреса ждут одну и ту же задачу.
+    """
+
+    def __init__(self, *args, pool_size=10, **kwargs):
+        self.pool_size = pool_size
+        super().__init__(*args, **kwargs)
+        self.__in_flight = {}
+
+    def create_session(self):
+        """Создаёт асинхронный HTTP-клиент с пулом keep-alive соединений."""
+        import httpx
+
+        return httpx.AsyncClient(
+            limits=httpx.Limits(max_connections=self.pool_size,
+                                max_keepalive_connections=self.pool_size),
+        )
+
+    async def close(self):
+        """Закрывает соединения клиента."""
+        await self.session.aclose()
+
+    async def fetch_coordinates(self, address):
+        """Получение координат по адресу."""
+        normalized_address = normalize_address(address)
+
+        found, coords = self._local_cache.get(normalized_address)
+        cache_lookup('geocode', found)
+        if found:
+            return coords
+
+        task = self.__in_flight.get(normalized_address)
+        if task is None:
+            task = asyncio.ensure_future(
+                self.__lookup_coordinates(address, normalized_address)
+            )
+            self.__in_flight[normalized_address] = task
+            task.add_done_callback(
+                lambda _: self.__in_flight.pop(normalized_address, None)
+            )
+
+        return await asyncio.shield(task)
+
+    async def __lookup_coordinates(self, address, normalized_address):
+        loop = asyncio.get_running_loop()
+        cache_key = self._cache_key(normalized_address)
+
+        # Клиент Redis синхронный, поэтому выносим его вызовы из цикла событий.
+        found, coords = await loop.run_in_executor(
+            None, self._get_shared, cache_key
+        )
+        if not found:
+            coords = await self.request_coordinates(address)
+
+        ttl = self._remember(normalized_address, coords)
+        if not found:
+            await loop.run_in_executor(
+                None, self._set_shared, cache_key, coords, ttl
+            )
+
+        return coords
+
+    async def request_coordinates(self, address):
+        """Запрашивает координаты адреса у геокодера, минуя кэш."""
+        with call_timer('yandex', 'geocode'):
+            response = await self.session.get(
+                self.base_url,
+                params=self._request_params(address),
+                timeout=self.timeout
+            )
+        response.raise_for_status()
+
+        return parse_coordinates(response.json())
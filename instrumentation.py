@@ -0,0 +1,116 @@
+import re
+import time
+from contextlib import nullcontext
+
+# Слушатели вызовов внешних сервисов:
+# listener(service, operation, duration, error).
+_listeners = []
+# Слушатели обращений к кэшам: listener(cache, result).
+_cache_listeners = []
+# Открывает span вызова: span_starter(service, operation) -> span или None.
+_span_starter = None
+
+# Id — сегмент пути с цифрами, кроме номера версии API вроде v2.
+ID_PATTERN = re.compile(r'^(?!v\d+$).*\d')
+
+
+def add_listener(listener):
+    """Подписывает слушателя на вызовы внешних сервисов."""
+    if listener not in _listeners:
+        _listeners.append(listener)
+
+
+def remove_listener(listener):
+    """Отписывает слушателя."""
+    if listener in _listeners:
+        _listeners.remove(listener)
+
+
+def add_cache_listener(listener):
+    """Подписывает слушателя на обращения к кэшам."""
+    if listener not in _cache_listeners:
+        _cache_listeners.append(listener)
+
+
+def remove_cache_listener(listener):
+    """Отписывает слушателя обращений к кэшам."""
+    if listener in _cache_listeners:
+        _cache_listeners.remove(listener)
+
+
+def set_span_starter(span_starter):
+    """Задаёт функцию, открывающую span на время вызова; None — отключает."""
+    global _span_starter
+    _span_starter = span_starter
+
+
+class CallTimer():
+    """Замеряет вызов внешнего сервиса и сообщает о нём слушателям."""
+
+    __slots__ = ('service', 'operation', 'started_at', 'span')
+
+    def __init__(self, service, operation):
+        self.service = service
+        self.operation = operation
+        self.span = None
+
+    def __repr__(self):
+        return '<{} {} {}>'.format(self.__class__.__name__.upper(),
+                                   self.service,
+                                   self.operation)
+
+    def __enter__(self):
+        if _span_starter is not None:
+            self.span = _span_starter(self.service, self.operation)
+            if self.span is not None:
+                self.span.__enter__()
+
+        self.started_at = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        duration = time.perf_counter() - self.started_at
+        for listener in tuple(_listeners):
+            listener(self.service, self.operation, duration, exc_value)
+
+        if self.span is not None:
+            self.span.__exit__(exc_type, exc_value, traceback)
+
+
+_NO_TIMER = nullcontext()
+
+
+def call_timer(service, operation):
+    """
+    Возвращает контекстный менеджер, замеряющий вызов внешнего сервиса.
+
+    Пока нет ни слушателей, ни трассировки, время не замеряется.
+    """
+    if not _listeners and _span_starter is None:
+        return _NO_TIMER
+
+    return CallTimer(service, operation)
+
+
+def cache_lookup(cache, result):
+    """Сообщает об обращении к кэшу; result — True, False или строка."""
+    if not _cache_listeners:
+        return
+
+    if result is True:
+        result = 'hit'
+    elif result is False:
+        result = 'miss'
+
+    for listener in tuple(_cache_listeners):
+        listener(cache, result)
+
+
+def route_name(method, path):
+    """Возвращает маршрут запроса без id, например «GET /v2/carts/{id}/items»."""
+    parts = [
+        '{id}' if ID_PATTERN.search(part) else part
+        for part in path.split('?')[0].strip('/').split('/')
+    ]
+
+    return '{} /{}'.format(method, '/'.join(parts))
@@ -1,30 +1,90 @@
+import argparse
 import json
 import logging
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
+import redis
 from environs import Env
 from slugify import slugify
 
-from moltin_api import Moltin
+from catalog_cache import CatalogCache
+from database import get_database_connection
+from moltin_api import MOLTIN_API_URL, Moltin
+from moltin_sync import AddressSync, Checkpoint, MenuSync
+from photo_cache import get_photo_cache
+from rate_limit import TokenBucket
+from retry_policy import RetryPolicy
 
 logger = logging.getLogger('pizza-shop')
 
 
-def delete_all_products(moltin_api):
-    """Удаляет все товары."""
-    for product in moltin_api.get_products():
-        moltin_api.delete_product(product.get('id'))
+def run_parallel(title, func, items, workers):
+    """
+    Выполняет func для каждого элемента в пуле из workers потоков.
 
+    Пишет в лог прогресс и в конце — скорость загрузки.
+    """
+    items = list(items)
+    started_at = time.monotonic()
+    done = 0
+    failed = 0
+    step = max(len(items) // 10, 1)
 
-def delete_all_files(moltin_api):
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(func, item) for item in items]
+
+        for future in as_completed(futures):
+            try:
+                future.result()
+            except Exception as err:
+                failed += 1
+                logger.error('%s: %s', title, err)
+
+            done += 1
+            if done % step == 0 or done == len(items):
+                logger.info('%s: %s/%s', title, done, len(items))
+
+    elapsed = time.monotonic() - started_at
+    logger.info('%s: %s шт. за %.1f с (%.1f шт./с), ошибок: %s',
+                title, len(items), elapsed,
+                len(items) / elapsed if elapsed else 0, failed)
+
+    return failed
+
+
+def delete_all_products(moltin_api, workers=1):
+    """Удаляет все товары и возвращает их id."""
+    # Сначала собираем id: удаление во время перебора сдвигает страницы.
+    product_ids = [product.get('id') for product in moltin_api.iter_products()]
+
+    run_parallel('Удаление товаров', moltin_api.delete_product,
+                 product_ids, workers)
+
+    return product_ids
+
+
+def delete_all_files(moltin_api, workers=1):
     """Удаляет все файлы."""
-    for remote_file in moltin_api.get_files():
-        moltin_api.delete_file(remote_file.get('id'))
+    file_ids = [
+        remote_file.get('id') for remote_file in moltin_api.iter_files()
+    ]
+
+    run_parallel('Удаление файлов', moltin_api.delete_file, file_ids, workers)
 
 
-def delete_all_addresses(moltin_api):
+def delete_all_addresses(moltin_api, workers=1):
     """Удаляет все записи."""
-    for entry in moltin_api.get_entries('Pizzeria'):
-        moltin_api.delete_entry('Pizzeria', entry.get('id'))
+    entry_ids = [
+        entry.get('id') for entry in moltin_api.iter_entries('Pizzeria')
+    ]
+
+    run_parallel(
+        'Удаление адресов',
+        lambda entry_id: moltin_api.delete_entry('Pizzeria', entry_id),
+        entry_ids,
+        workers,
+    )
 
 
 def create_product(moltin_api, product, image_id):
@@ -37,47 +97,96 @@ def create_product(moltin_api, product, image_id):
 
     moltin_api.add_file_to_product(new_product.get('id'), image_id)
 
-    logger.info(product.get('name'))
+    logger.debug(product.get('name'))
 
     return new_product
 
 
-def load_menu(moltin_api):
+def load_menu_item(moltin_api, menu_item):
+    """Загружает изображение и создаёт товар."""
+    logger.debug(menu_item)
+
+    image_url = menu_item.get('product_image').get('url')
+    logger.debug(image_url)
+
+    upload_file = moltin_api.upload_file_from_url(image_url)
+    logger.debug(upload_file)
+
+    file_id = upload_file.get('data').get('id')
+    logger.debug(file_id)
+
+    return create_product(moltin_api, menu_item, file_id)
+
+
+def load_menu(moltin_api, workers=1):
     """Загружает данные меню."""
     with open('load_data/menu.json', 'r') as file_menu:
         menu_items = json.load(file_menu)
 
-    for menu_item in menu_items:
-        logger.debug(menu_item)
+    run_parallel(
+        'Загрузка меню',
+        lambda menu_item: load_menu_item(moltin_api, menu_item),
+        menu_items,
+        workers,
+    )
 
-        image_url = menu_item.get('product_image').get('url')
-        logger.debug(image_url)
 
-        upload_file = moltin_api.upload_file_from_url(image_url)
-        logger.debug(upload_file)
+def get_address_fields(address):
+    """Возвращает поля записи Pizzeria для адреса."""
+    return {
+        'address': address.get('address').get('full'),
+        'alias': address.get('alias'),
+        'longitude': float(address.get('coordinates').get('lon')),
+        'latitude': float(address.get('coordinates').get('lat')),
+    }
 
-        file_id = upload_file.get('data').get('id')
-        logger.debug(file_id)
 
-        create_product(moltin_api, menu_item, file_id)
+def load_addresses(moltin_api, workers=1):
+    """Загружает данные по адресам."""
+    with open('load_data/addresses.json', 'r') as file_addresses:
+        addresses = json.load(file_addresses)
 
+    run_parallel(
+        'Загрузка адресов',
+        lambda address: moltin_api.create_entry('Pizzeria',
+                                                get_address_fields(address)),
+        addresses,
+        workers,
+    )
 
-def load_addresses(moltin_api):
-    """Загружает данные по адресам."""
+
+def sync_menu(moltin_api, checkpoint, workers=1):
+    """Приводит товары Moltin к меню, меняя только отличающиеся."""
+    with open('load_data/menu.json', 'r') as file_menu:
+        menu_items = json.load(file_menu)
+
+    menu_sync = MenuSync(moltin_api, checkpoint)
+
+    failed = run_parallel(
+        'Синхронизация меню',
+        menu_sync.apply,
+        menu_sync.plan(menu_items),
+        workers,
+    )
+
+    return failed, menu_sync
+
+
+def sync_addresses(moltin_api, checkpoint, workers=1):
+    """Приводит пиццерии Moltin к адресам, меняя только отличающиеся."""
     with open('load_data/addresses.json', 'r') as file_addresses:
         addresses = json.load(file_addresses)
 
-    for address in addresses:
-        logger.debug(address)
+    address_sync = AddressSync(moltin_api, checkpoint)
 
-        field_data = {
-            'address': address.get('address').get('full'),
-            'alias': address.get('alias'),
-            'longitude': float(address.get('coordinates').get('lon')),
-            'latitude': float(address.get('coordinates').get('lat')),
-        }
+    failed = run_parallel(
+        'Синхронизация адресов',
+        address_sync.apply,
+        address_sync.plan(addresses, get_address_fields),
+        workers,
+    )
 
-        moltin_api.create_entry('Pizzeria', field_data)
+    return failed, address_sync
 
 
 def main():
@@ -89,30 +198,107 @@ def main():
     env = Env()
     env.read_env()
 
+    parser = argparse.ArgumentParser(
+        description='Загружает меню и адреса пиццерий в Moltin.'
+    )
+    parser.add_argument('--menu', action='store_true',
+                        help='загрузить меню')
+    parser.add_argument('--addresses', action='store_true',
+                        help='загрузить адреса пиццерий')
+    parser.add_argument('--delete', action='store_true',
+                        help='перед загрузкой удалить старые данные')
+    parser.add_argument('--sync', action='store_true',
+                        help='загрузить только изменения, '
+                             'удалив лишние товары и адреса')
+    parser.add_argument('--checkpoint',
+                        default=env.str('SYNC_CHECKPOINT',
+                                        'sync_checkpoint.json'),
+                        help='файл для продолжения прерванной синхронизации')
+    parser.add_argument('--workers', type=int,
+                        default=env.int('LOADER_WORKERS', 8),
+                        help='число параллельных потоков')
+    parser.add_argument('--rate', type=float,
+                        default=env.float('MOLTIN_RATE_LIMIT', 20),
+                        help='не больше запросов к Moltin в секунду')
+    args = parser.parse_args()
+
     moltin_client_id = env.str('MOLTIN_CLIENT_ID')
     moltin_client_secret = env.str('MOLTIN_CLIENT_SECRET')
-    moltin_api = Moltin(moltin_client_id, moltin_client_secret)
-
-    # delete_all_products(moltin_api)
-    # delete_all_files(moltin_api)
-    # load_menu(moltin_api)
-    # delete_all_addresses(moltin_api)
-    # load_addresses(moltin_api)
-
-    # TODO #1 удалить
-    # print(moltin_api.get_entries('Pizzeria'))
-    # print(moltin_api.get_access_token())
-    # print(moltin_api.get_products())
-    # print(moltin_api.get_files())
-    # print(moltin_api.create_flow('Pizzeria2', 'My Pizzeria2'))
-    # print(moltin_api.get_flows())
-    # print(moltin_api.get_flow_by_slug('Pizzeria'))
-    # print(moltin_api.create_field_in_flow(
-    #     'd0e9cbe1-9435-45e4-98dd-4b8f34b1a509',
-    #     'Latitude',
-    #     'Latitude Pizzeria',
-    #     'float'
-    # ))
+    rate_limiter = TokenBucket(args.rate)
+    moltin_api = Moltin(moltin_client_id,
+                        moltin_client_secret,
+                        pool_size=args.workers,
+                        rate_limiter=rate_limiter,
+                        retry_policy=RetryPolicy(
+                            max_attempts=env.int('MOLTIN_MAX_ATTEMPTS', 4),
+                            retry_rate=env.float('MOLTIN_RETRY_RATE', 1),
+                        ),
+                        api_url=env.str('MOLTIN_API_URL', '') or MOLTIN_API_URL)
+    catalog_cache = CatalogCache(redis_db=get_database_connection())
+
+    started_at = time.monotonic()
+    # Менялись ли товары или пиццерии и у каких товаров больше
+    # не годятся file_id фотографий.
+    catalog_changed = False
+    changed_photos = set()
+
+    if args.sync:
+        checkpoint = Checkpoint(args.checkpoint)
+        failed = 0
+
+        if args.menu:
+            menu_failed, menu_sync = sync_menu(moltin_api,
+                                               checkpoint,
+                                               args.workers)
+            failed += menu_failed
+            catalog_changed |= menu_sync.changed
+            changed_photos = menu_sync.changed_photos
+        if args.addresses:
+            address_failed, address_sync = sync_addresses(moltin_api,
+                                                          checkpoint,
+                                                          args.workers)
+            failed += address_failed
+            catalog_changed |= address_sync.changed
+
+        if not failed:
+            checkpoint.remove()
+    else:
+        if args.menu:
+            if args.delete:
+                changed_photos.update(
+                    delete_all_products(moltin_api, args.workers))
+                delete_all_files(moltin_api, args.workers)
+            load_menu(moltin_api, args.workers)
+
+        if args.addresses:
+            if args.delete:
+                delete_all_addresses(moltin_api, args.workers)
+            load_addresses(moltin_api, args.workers)
+
+        catalog_changed = args.menu or args.addresses
+
+    elapsed = time.monotonic() - started_at
+    logger.info('Запросов к Moltin: %s за %.1f с (%.1f в секунду)',
+                rate_limiter.acquired, elapsed,
+                rate_limiter.acquired / elapsed if elapsed else 0)
+
+    invalidate_bot_caches(catalog_cache, catalog_changed, changed_photos)
+
+
+def invalidate_bot_caches(catalog_cache, catalog_changed, changed_photos):
+    """
+    Сбрасывает кэш каталога, если он менялся, и file_id изменившихся
+    фотографий в ботах.
+
+    Moltin к этому моменту уже обновлён, поэтому недоступный Redis
+    не считается ошибкой загрузки.
+    """
+    try:
+        if catalog_changed:
+            catalog_cache.invalidate()
+        get_photo_cache().discard(changed_photos)
+    except redis.RedisError as err:
+        logger.error('Не удалось сбросить кэши ботов: %s', err)
 
 
 if __name__ == '__main__':
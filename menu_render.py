@@ -0,0 +1,139 @@
+import threading
+from textwrap import dedent
+
+from environs import Env
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+
+from instrumentation import cache_lookup
+
+_menu_renderer = None
+
+MENU_TEXT = 'Please choose:'
+
+
+class MenuRenderer():
+    """
+    Готовые клавиатуры меню и карточки товаров.
+
+    Клавиатуры и подписи строятся один раз для каждой версии каталога и
+    хранятся уже сериализованными в JSON, как их принимает Bot API.
+    Версию определяет сам объект из кэша каталога: когда кэш обновляет
+    список товаров или товар, приходит новый объект и отрисовка
+    выполняется заново.
+    """
+
+    def __init__(self, page_size=8):
+        self.page_size = page_size
+        self.__products = None
+        self.__pages = []
+        self.__cards = {}
+        self.__lock = threading.Lock()
+
+    def __repr__(self):
+        return '<{} page_size={}>'.format(self.__class__.__name__.upper(),
+                                          self.page_size)
+
+    def menu_page(self, products, page=0):
+        """Возвращает текст, клавиатуру и номер существующей страницы меню."""
+        with self.__lock:
+            is_rendered = products is self.__products
+            if not is_rendered:
+                self.__pages = self.render_pages(products)
+                self.__products = products
+
+            pages = self.__pages
+
+        cache_lookup('menu_page', is_rendered)
+        page = min(max(page, 0), len(pages) - 1)
+
+        return MENU_TEXT, pages[page], page
+
+    def product_card(self, product):
+        """Возвращает подпись и клавиатуру карточки товара."""
+        product_id = product.get('id')
+
+        with self.__lock:
+            rendered_product, card = self.__cards.get(product_id, (None, None))
+            is_rendered = rendered_product is product
+            if not is_rendered:
+                card = self.render_card(product)
+                self.__cards[product_id] = (product, card)
+
+        cache_lookup('product_card', is_rendered)
+        return card
+
+    def render_pages(self, products):
+        """Разбивает меню на страницы и строит клавиатуру каждой."""
+        chunks = [
+            products[start:start + self.page_size]
+            for start in range(0, len(products), self.page_size)
+        ] or [[]]
+
+        pages = []
+        for page, chunk in enumerate(chunks):
+            keyboard = [
+                [InlineKeyboardButton(product.get('name'),
+                                      callback_data=product.get('id'))]
+                for product in chunk
+            ]
+
+            navigation = []
+            if page > 0:
+                navigation.append(InlineKeyboardButton(
+                    '◀️', callback_data=f'PAGE#{page - 1}'))
+            if page < len(chunks) - 1:
+                navigation.append(InlineKeyboardButton(
+                    '▶️', callback_data=f'PAGE#{page + 1}'))
+            if navigation:
+                keyboard.append(navigation)
+
+            keyboard.append(
+                [InlineKeyboardButton('🛒 Корзина', callback_data='SHOW_CART')]
+            )
+
+            pages.append(InlineKeyboardMarkup(keyboard).to_json())
+
+        return pages
+
+    @staticmethod
+    def render_card(product):
+        """Строит подпись и клавиатуру карточки товара."""
+        item_id = product.get('id')
+        price = product.get('price')[0]
+        price = f'{float(price["amount"])} {price["currency"]}'
+
+        caption = dedent(
+            f'''
+                *{product.get('name')}*
+
+                *Цена:*:
+                `{price}`
+
+                Описание:
+                `{product.get('description')}`
+
+            '''
+        )
+
+        keyboard = [
+            [InlineKeyboardButton('Добавить в корзину',
+                                  callback_data=f'{item_id}#1')],
+            [InlineKeyboardButton('🛒 Корзина', callback_data='SHOW_CART')],
+            [InlineKeyboardButton('В меню', callback_data='BACK')]
+        ]
+
+        return caption, InlineKeyboardMarkup(keyboard).to_json()
+
+
+def get_menu_renderer():
+    """Возвращает отрисовщик меню, либо создаёт новый, если он ещё не создан."""
+    global _menu_renderer
+    if _menu_renderer is None:
+        env = Env()
+        env.read_env()
+
+        _menu_renderer = MenuRenderer(
+            page_size=env.int('MENU_PAGE_SIZE', 8),
+        )
+
+    return _menu_renderer
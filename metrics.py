@@ -0,0 +1,117 @@
+from prometheus_client import Counter, Gauge, Histogram, start_http_server
+
+from instrumentation import add_cache_listener, add_listener
+
+# Границы корзин гистограмм задержки, с: от Redis до медленного Moltin.
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                   0.25, 0.5, 1, 2.5, 5, 10)
+
+CHAT_QUEUE_DEPTH = Histogram(
+    'bot_chat_queue_depth',
+    'Длина очереди чата в момент постановки апдейта',
+    buckets=(1, 2, 3, 5, 10, 20, 50),
+)
+QUEUED_UPDATES = Gauge(
+    'bot_queued_updates',
+    'Апдейты, ожидающие или выполняемые в очередях чатов',
+)
+BUSY_CHATS = Gauge(
+    'bot_busy_chats',
+    'Чаты, у которых есть апдейты в очереди',
+)
+TELEGRAM_CALLS_SAVED = Histogram(
+    'bot_telegram_calls_saved',
+    'Запросы к Telegram, сэкономленные редактированием сообщений, на апдейт',
+    buckets=(0, 1, 2, 3),
+)
+
+SEND_QUEUE_LATENCY = Histogram(
+    'bot_telegram_send_queue_seconds',
+    'Время ожидания запроса к Telegram в очереди отправки',
+    buckets=(0.01, 0.05, 0.1, 0.25, 0.5, 1, 2, 5, 10),
+)
+SEND_QUEUE_DEPTH = Gauge(
+    'bot_telegram_send_queue_depth',
+    'Запросы к Telegram в очереди отправки',
+)
+SEND_RETRY_AFTER = Counter(
+    'bot_telegram_retry_after_total',
+    'Ответы Telegram с просьбой подождать (RetryAfter)',
+)
+
+HANDLER_LATENCY = Histogram(
+    'bot_handler_seconds',
+    'Время обработки апдейта хэндлером состояния',
+    ['state'],
+    buckets=LATENCY_BUCKETS,
+)
+HANDLER_ERRORS = Counter(
+    'bot_handler_errors_total',
+    'Ошибки хэндлеров состояний',
+    ['state', 'error'],
+)
+CALL_LATENCY = Histogram(
+    'bot_external_call_seconds',
+    'Время вызова внешнего сервиса: Moltin, геокодера, Redis, Telegram',
+    ['service', 'operation'],
+    buckets=LATENCY_BUCKETS,
+)
+CALL_ERRORS = Counter(
+    'bot_external_call_errors_total',
+    'Ошибки вызовов внешних сервисов',
+    ['service', 'operation', 'error'],
+)
+CACHE_LOOKUPS = Counter(
+    'bot_cache_lookups_total',
+    'Обращения к кэшам: hit, miss или stale',
+    ['cache', 'result'],
+)
+
+
+def error_name(err):
+    """Возвращает тип ошибки, для ошибок HTTP — код ответа."""
+    if (response := getattr(err, 'response', None)) is not None:
+        if status_code := getattr(response, 'status_code', None):
+            return str(status_code)
+
+    return err.__class__.__name__
+
+
+# Метрики с уже подставленными метками: labels() заметно дороже observe().
+_call_latency = {}
+_cache_lookups = {}
+
+
+def observe_call(service, operation, duration, error):
+    """Слушатель instrumentation: пишет вызов внешнего сервиса в метрики."""
+    key = (service, operation)
+    if (call_latency := _call_latency.get(key)) is None:
+        call_latency = _call_latency.setdefault(
+            key, CALL_LATENCY.labels(service, operation))
+
+    call_latency.observe(duration)
+    if error is not None:
+        CALL_ERRORS.labels(service, operation, error_name(error)).inc()
+
+
+def count_cache_lookup(cache, result):
+    """Слушатель instrumentation: считает обращение к кэшу."""
+    key = (cache, result)
+    if (cache_lookups := _cache_lookups.get(key)) is None:
+        cache_lookups = _cache_lookups.setdefault(
+            key, CACHE_LOOKUPS.labels(cache, result))
+
+    cache_lookups.inc()
+
+
+def start_metrics_server(port, addr='127.0.0.1'):
+    """
+    Запускает HTTP-сервер с эндпоинтом /metrics, если задан порт.
+
+    По умолчанию сервер слушает только локальный адрес. Только когда он
+    запущен, включается замер вызовов внешних сервисов и кэшей.
+    """
+    if port:
+        add_listener(observe_call)
+        add_cache_listener(count_cache_lookup)
+        start_http_server(port, addr=addr)
@@ -1,70 +1,323 @@
+import asyncio
+import contextvars
+import logging
 import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from urllib.parse import parse_qsl, urlsplit
 
 import requests
+from requests.adapters import HTTPAdapter
 from slugify import slugify
 
+from instrumentation import call_timer, route_name
+from moltin_token import TokenManager
+from retry_policy import RetryPolicy, check_deadline, transient_errors
+
+logger = logging.getLogger('pizza-shop')
+
+MOLTIN_API_URL = 'https://api.moltin.com'
+# Наибольший размер страницы, который отдаёт Moltin.
+PAGE_SIZE = 100
+
+
+def response_json(response):
+    """Возвращает тело ответа."""
+    return response.json()
+
+
+def response_data(response):
+    """Возвращает объект из поля data ответа."""
+    return response.json().get('data', {})
+
+
+def response_data_list(response):
+    """Возвращает список из поля data ответа."""
+    return response.json().get('data', [])
+
+
+def response_status(response):
+    """Возвращает код ответа."""
+    return response.status_code
+
+
+def page_params(page_size=PAGE_SIZE, offset=0):
+    """Возвращает параметры запроса страницы списка."""
+    return {'page[limit]': page_size, 'page[offset]': offset}
+
+
+def next_page(path, page):
+    """
+    Возвращает путь и параметры следующей страницы списка.
+
+    Берёт ссылку links.next, а если её нет, считает смещение по meta.page.
+    Для последней страницы возвращает None.
+    """
+    if not page.get('data'):
+        return None
+
+    links = page.get('links') or {}
+    if next_link := links.get('next'):
+        if next_link == links.get('current'):
+            return None
+
+        next_url = urlsplit(next_link)
+        return next_url.path, dict(parse_qsl(next_url.query))
+
+    page_meta = (page.get('meta') or {}).get('page') or {}
+    if page_meta.get('current', 0) < page_meta.get('total', 0):
+        return path, page_params(page_meta['limit'],
+                                 page_meta['offset'] + page_meta['limit'])
+
 
 class Moltin():
-    __moltin_token = {}
+    """
+    Клиент API Moltin.
+
+    Каждый метод API описывает только запрос и разбор ответа и передаёт их
+    в _call. Синхронный клиент выполняет запрос сразу, асинхронный
+    AsyncMoltin возвращает корутину с тем же результатом.
+    """
+
     __moltin_client_id = ''
     __moltin_client_secret = ''
 
-    def __init__(self, moltin_client_id='', moltin_client_secret=''):
+    def __init__(self,
+                 moltin_client_id='',
+                 moltin_client_secret='',
+                 pool_size=10,
+                 http2=False,
+                 catalog_cache=None,
+                 redis_db=None,
+                 rate_limiter=None,
+                 retry_policy=None,
+                 api_url=MOLTIN_API_URL):
         if not self.__moltin_client_id:
             self.__moltin_client_id = moltin_client_id
             self.__moltin_client_secret = moltin_client_secret
 
+        self.api_url = api_url
+        self.catalog_cache = catalog_cache
+        self.rate_limiter = rate_limiter
+        self.retry_policy = retry_policy or RetryPolicy()
+        self.__auth_headers = {}
+        self.session = self.create_session(pool_size, http2)
+        self.token_manager = TokenManager(
+            self._fetch_token,
+            redis_db=redis_db,
+            namespace=' '.join(self._token_request_data().values()),
+        )
+
     def __repr__(self):
         return '<{}>'.format(self.__class__.__name__.upper())
 
     def __eq__(self, other):
         return other is self
 
+    @staticmethod
+    def create_session(pool_size, http2=False):
+        """
+        Создаёт HTTP-сессию с пулом keep-alive соединений.
+
+        Для HTTP/2 нужен пакет httpx[http2], иначе используется requests.
+        """
+        if http2:
+            import httpx
+
+            return httpx.Client(
+                http2=True,
+                limits=httpx.Limits(max_connections=pool_size,
+                                    max_keepalive_connections=pool_size),
+            )
+
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size,
+                              pool_maxsize=pool_size)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+
+        return session
+
+    def close(self):
+        """Закрывает соединения сессии."""
+        self.session.close()
+
     def is_token_expired(self):
         """Проверка, истек ли срок действия токена."""
-        if not self.__moltin_token:
-            return True
+        return self.token_manager.is_expired()
+
+    def _token_request_data(self):
+        """Возвращает параметры запроса токена."""
+        if self.__moltin_client_secret:
+            return {
+                'client_id': self.__moltin_client_id,
+                'client_secret': self.__moltin_client_secret,
+                'grant_type': 'client_credentials',
+            }
 
-        token_expires = self.__moltin_token.get('expires', 0)
+        return {
+            'client_id': self.__moltin_client_id,
+            'grant_type': 'implicit',
+        }
 
-        return time.time() > token_expires
+    def _fetch_token(self):
+        """
+        Запрашивает новый токен.
+
+        Запрос токена ничего не меняет в Moltin, поэтому после сетевых
+        ошибок и ответов 5xx он повторяется, как и идемпотентные запросы.
+        """
+        path = '/oauth/access_token'
+        attempt = 0
+
+        with call_timer('moltin', f'POST {path}'):
+            while True:
+                timeout = check_deadline()
+                try:
+                    response = self._post_token_request(
+                        f'{self.api_url}{path}',
+                        data=self._token_request_data(),
+                        **self._timeout_kwargs(timeout)
+                    )
+                except transient_errors() as err:
+                    delay = self.retry_policy.retry_delay(
+                        'POST', path, attempt, error=err, is_idempotent=True)
+                    if delay is None:
+                        raise
+                else:
+                    delay = self.retry_policy.retry_delay(
+                        'POST', path, attempt, response=response,
+                        is_idempotent=True)
+                    if delay is None:
+                        response.raise_for_status()
+                        return response.json()
+
+                time.sleep(delay)
+                attempt += 1
+
+    def _post_token_request(self, url, **kwargs):
+        """Отправляет запрос токена."""
+        return self.session.post(url, **kwargs)
+
+    def _build_auth_headers(self, moltin_token):
+        """Возвращает заголовки авторизации, пересобирая их при смене токена."""
+        access_token = moltin_token.get('access_token')
+
+        if self.__auth_headers.get('token') != access_token:
+            self.__auth_headers = {
+                'token': access_token,
+                'headers': {'Authorization': f'Bearer {access_token}'},
+            }
+
+        return self.__auth_headers['headers']
 
     def get_access_token(self):
         """Возвращает токен."""
-        if self.is_token_expired():
-            if self.__moltin_client_secret:
-                data = {
-                    'client_id': self.__moltin_client_id,
-                    'client_secret': self.__moltin_client_secret,
-                    'grant_type': 'client_credentials',
-                }
+        return self.token_manager.get()
+
+    def get_auth_headers(self):
+        """Возвращает заголовки авторизации."""
+        return self._build_auth_headers(self.get_access_token())
+
+    def _request(self, method, path, **kwargs):
+        """Выполняет авторизованный запрос к API Moltin."""
+        with call_timer('moltin', route_name(method, path)):
+            return self._send_request(method, path, **kwargs)
+
+    def _send_request(self, method, path, **kwargs):
+        """
+        Отправляет запрос к API Moltin.
+
+        Повторяет запрос по правилам retry_policy, а после ответа 401
+        один раз повторяет его с новым токеном.
+        """
+        attempt = 0
+        is_token_refreshed = False
+
+        while True:
+            timeout = check_deadline()
+            if self.rate_limiter is not None:
+                self.rate_limiter.acquire()
+
+            moltin_token = self.get_access_token()
+            try:
+                response = self.session.request(
+                    method,
+                    f'{self.api_url}{path}',
+                    headers=self._build_auth_headers(moltin_token),
+                    **self._timeout_kwargs(timeout),
+                    **kwargs
+                )
+            except transient_errors() as err:
+                delay = self.retry_policy.retry_delay(method, path, attempt,
+                                                      error=err)
+                if delay is None:
+                    raise
             else:
-                data = {
-                    'client_id': self.__moltin_client_id,
-                    'grant_type': 'implicit',
-                }
-
-            response = requests.post(
-                'https://api.moltin.com/oauth/access_token',
-                data=data
-            )
-            response.raise_for_status()
-
-            self.__moltin_token = response.json()
-
-        return self.__moltin_token
+                if response.status_code == 401 and not is_token_refreshed:
+                    self.token_manager.invalidate(moltin_token)
+                    is_token_refreshed = True
+                    continue
+
+                delay = self.retry_policy.retry_delay(method, path, attempt,
+                                                      response=response)
+                if delay is None:
+                    response.raise_for_status()
+                    return response
+
+            time.sleep(delay)
+            attempt += 1
+
+    def _timeout_kwargs(self, timeout):
+        """Ограничивает попытку запроса её таймаутом и временем до дедлайна."""
+        attempt_timeout = self.retry_policy.attempt_timeout
+        if timeout is None:
+            return {'timeout': attempt_timeout}
+
+        return {'timeout': min(timeout, attempt_timeout)}
+
+    def _call(self, method, path, result=response_json, **kwargs):
+        """Выполняет запрос и разбирает ответ функцией result."""
+        return result(self._request(method, path, **kwargs))
+
+    def iter_pages(self, path, page_size=PAGE_SIZE):
+        """
+        Постранично загружает список, по одной странице за раз.
+
+        Следующая страница запрашивается в фоне, пока вызывающий код
+        обрабатывает текущую, поэтому в памяти не больше двух страниц.
+        """
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            # Дедлайн хранится в contextvars, поэтому передаём контекст
+            # в поток вместе с запросом.
+            future = executor.submit(contextvars.copy_context().run,
+                                     self._call, 'GET', path,
+                                     params=page_params(page_size))
+            while future is not None:
+                page = future.result()
+
+                future = None
+                if request := next_page(path, page):
+                    future = executor.submit(contextvars.copy_context().run,
+                                             self._call, 'GET', request[0],
+                                             params=request[1])
+
+                yield page.get('data', [])
+
+    def iter_items(self, path, page_size=PAGE_SIZE):
+        """Перебирает все элементы списка, загружая их постранично."""
+        for page in self.iter_pages(path, page_size):
+            yield from page
 
     def get_or_create_cart(self, cart_id):
         """Создаёт корзину."""
         if cart := self.get_cart(cart_id):
             return cart
 
-        moltin_token = self.get_access_token()
-
-        headers = {
-            'Authorization': f'Bearer {moltin_token.get("access_token")}'
-        }
+        return self.create_cart(cart_id)
 
+    def create_cart(self, cart_id):
+        """Создаёт новую корзину."""
         payload = {
             'data': {
                 'id': cart_id,
@@ -72,55 +325,18 @@ class Moltin():
             }
         }
 
-        response = requests.post(
-            'https://api.moltin.com/v2/carts',
-            headers=headers,
-            json=payload
-        )
-        response.raise_for_status()
-
-        return response.json()
+        return self._call('POST', '/v2/carts', json=payload)
 
     def get_cart(self, cart_id):
         """Получает данные корзины."""
-        moltin_token = self.get_access_token()
-
-        headers = {
-            'Authorization': f'Bearer {moltin_token.get("access_token")}'
-        }
-
-        response = requests.get(
-            f'https://api.moltin.com/v2/carts/{cart_id}',
-            headers=headers,
-        )
-        response.raise_for_status()
-
-        return response.json()
+        return self._call('GET', f'/v2/carts/{cart_id}')
 
     def get_cart_items(self, cart_id):
         """Получает содержимое корзины."""
-        moltin_token = self.get_access_token()
-
-        headers = {
-            'Authorization': f'Bearer {moltin_token.get("access_token")}'
-        }
-
-        response = requests.get(
-            f'https://api.moltin.com/v2/carts/{cart_id}/items',
-            headers=headers,
-        )
-        response.raise_for_status()
-
-        return response.json()
+        return self._call('GET', f'/v2/carts/{cart_id}/items')
 
     def add_cart_item(self, cart_id, item_id, quantity=1):
         """Добавляет товар в корзину."""
-        moltin_token = self.get_access_token()
-
-        headers = {
-            'Authorization': f'Bearer {moltin_token.get("access_token")}'
-        }
-
         payload = {
             'data': {
                 'id': item_id,
@@ -129,39 +345,21 @@ class Moltin():
             }
         }
 
-        response = requests.post(
-            f'https://api.moltin.com/v2/carts/{cart_id}/items',
-            headers=headers,
+        return self._call(
+            'POST',
+            f'/v2/carts/{cart_id}/items',
             json=payload
         )
-        response.raise_for_status()
-
-        return response.json()
 
     def remove_cart_item(self, cart_id, item_id):
         """Удаляет товар из корзины."""
-        moltin_token = self.get_access_token()
-
-        headers = {
-            'Authorization': f'Bearer {moltin_token.get("access_token")}'
-        }
-
-        response = requests.delete(
-            f'https://api.moltin.com/v2/carts/{cart_id}/items/{item_id}',
-            headers=headers,
+        return self._call(
+            'DELETE',
+            f'/v2/carts/{cart_id}/items/{item_id}'
         )
-        response.raise_for_status()
-
-        return response.json()
 
     def create_product(self, name, description, price, currency='RUB'):
         """Создаёт товар."""
-        moltin_token = self.get_access_token()
-
-        headers = {
-            'Authorization': f'Bearer {moltin_token.get("access_token")}'
-        }
-
         payload = {
             'data': {
                 'type': 'product',
@@ -182,74 +380,100 @@ class Moltin():
             }
         }
 
-        response = requests.post(
-            f'https://api.moltin.com/v2/products',
-            headers=headers,
-            json=payload
+        return self._call(
+            'POST',
+            '/v2/products',
+            json=payload,
+            result=response_data
         )
-        response.raise_for_status()
-
-        return response.json().get('data', {})
-
-    def delete_product(self, product_id):
-        """Удаляет товар."""
-        moltin_token = self.get_access_token()
 
-        headers = {
-            'Authorization': f'Bearer {moltin_token.get("access_token")}'
+    def update_product(self,
+                       product_id,
+                       name,
+                       description,
+                       price,
+                       currency='RUB'):
+        """Изменяет товар."""
+        payload = {
+            'data': {
+                'id': product_id,
+                'type': 'product',
+                'name': f'{name}',
+                'slug': f'{slugify(name)}',
+                'sku':  f'{slugify(name)}-001',
+                'description': description,
+                'price': [
+                    {
+                        'amount': price,
+                        'currency': currency,
+                        'includes_tax': True,
+                    }
+                ],
+            }
         }
 
-        response = requests.delete(
-            f'https://api.moltin.com/v2/products/{product_id}',
-            headers=headers
+        return self._call(
+            'PUT',
+            f'/v2/products/{product_id}',
+            json=payload,
+            result=response_data
         )
-        response.raise_for_status()
 
-        return response.status_code
+    def delete_product(self, product_id):
+        """Удаляет товар."""
+        return self._call(
+            'DELETE',
+            f'/v2/products/{product_id}',
+            result=response_status
+        )
 
     def get_products(self):
         """Возвращает список товаров."""
-        products = []
-        moltin_token = self.get_access_token()
+        if self.catalog_cache is None:
+            return self.fetch_products()
 
-        headers = {
-            'Authorization': f'Bearer {moltin_token.get("access_token")}'
-        }
+        return self.catalog_cache.get('products', self.fetch_products)
 
-        response = requests.get(
-            'https://api.moltin.com/v2/products',
-            headers=headers
-        )
-        response.raise_for_status()
+    def fetch_products(self):
+        """Загружает список товаров из Moltin, минуя кэш."""
+        return self._cache_products(list(self.iter_products()))
+
+    def iter_products(self):
+        """Перебирает все товары Moltin постранично, минуя кэш."""
+        return self.iter_items('/v2/products')
 
-        products = response.json().get('data', [])
+    def _cache_products(self, products):
+        """Кладёт каждый товар списка в кэш."""
+        if self.catalog_cache is not None:
+            for product in products:
+                self.catalog_cache.set(f'product:{product.get("id")}',
+                                       product)
 
         return products
 
     def get_product(self, item_id):
         """Возвращает описание товара."""
-        moltin_token = self.get_access_token()
-
-        headers = {
-            'Authorization': f'Bearer {moltin_token.get("access_token")}'
-        }
-
-        response = requests.get(
-            f'https://api.moltin.com/v2/products/{item_id}',
-            headers=headers
+        if self.catalog_cache is None:
+            return self.fetch_product(item_id)
+
+        return self.catalog_cache.get(f'product:{item_id}',
+                                      partial(self.fetch_product, item_id))
+
+    def fetch_product(self, item_id):
+        """Загружает описание товара из Moltin, минуя кэш."""
+        return self._call(
+            'GET',
+            f'/v2/products/{item_id}',
+            result=response_data
         )
-        response.raise_for_status()
 
-        return response.json().get('data', {})
+    def invalidate_catalog(self):
+        """Сбрасывает кэш каталога."""
+        if self.catalog_cache is not None:
+            self.catalog_cache.invalidate()
 
     def add_file_to_product(self, product_id, file_id):
         """Добавляет файл к товару."""
-        moltin_token = self.get_access_token()
-
-        headers = {
-            'Authorization': f'Bearer {moltin_token.get("access_token")}'
-        }
-
         payload = {
             'data': {
                 'type': 'main_image',
@@ -257,23 +481,15 @@ class Moltin():
             }
         }
 
-        response = requests.post(
-            f'https://api.moltin.com/v2/products/{product_id}/relationships/main-image',
-            headers=headers,
-            json=payload
+        return self._call(
+            'POST',
+            f'/v2/products/{product_id}/relationships/main-image',
+            json=payload,
+            result=response_data
         )
-        response.raise_for_status()
-
-        return response.json().get('data', {})
 
     def create_customer(self, customer_id, customer_email):
         """Создает покупателя."""
-        moltin_token = self.get_access_token()
-
-        headers = {
-            'Authorization': f'Bearer {moltin_token.get("access_token")}'
-        }
-
         payload = {
             'data': {
                 'type': 'customer',
@@ -282,94 +498,38 @@ class Moltin():
             }
         }
 
-        response = requests.post(
-            f'https://api.moltin.com/v2/customers',
-            headers=headers,
-            json=payload
-        )
-        response.raise_for_status()
-
-        return response.json()
+        return self._call('POST', '/v2/customers', json=payload)
 
     def get_files(self):
         """Возвращает список файлов."""
-        products = []
-        moltin_token = self.get_access_token()
+        return list(self.iter_files())
 
-        headers = {
-            'Authorization': f'Bearer {moltin_token.get("access_token")}'
-        }
-
-        response = requests.get(
-            'https://api.moltin.com/v2/files',
-            headers=headers
-        )
-        response.raise_for_status()
-
-        products = response.json().get('data', [])
-
-        return products
+    def iter_files(self):
+        """Перебирает все файлы постранично."""
+        return self.iter_items('/v2/files')
 
     def get_file_url(self, file_id):
         """Получает URL файла по id."""
-        moltin_token = self.get_access_token()
-
-        headers = {
-            'Authorization': f'Bearer {moltin_token.get("access_token")}'
-        }
-
-        response = requests.get(
-            f'https://api.moltin.com/v2/files/{file_id}',
-            headers=headers
-        )
-        response.raise_for_status()
-
-        return response.json()
+        return self._call('GET', f'/v2/files/{file_id}')
 
     def delete_file(self, file_id):
         """Удаляет файл."""
-        moltin_token = self.get_access_token()
-
-        headers = {
-            'Authorization': f'Bearer {moltin_token.get("access_token")}'
-        }
-
-        response = requests.delete(
-            f'https://api.moltin.com/v2/files/{file_id}',
-            headers=headers
+        return self._call(
+            'DELETE',
+            f'/v2/files/{file_id}',
+            result=response_status
         )
-        response.raise_for_status()
-
-        return response.status_code
 
     def upload_file_from_url(self, file_url):
         """Загружает файл из ссылки."""
-        moltin_token = self.get_access_token()
-
-        headers = {
-            'Authorization': f'Bearer {moltin_token.get("access_token")}',
-        }
-
         files = {
             'file_location': (None, file_url)
         }
 
-        response = requests.post(
-            'https://api.moltin.com/v2/files',
-            headers=headers,
-            files=files)
-        response.raise_for_status()
-
-        return response.json()
+        return self._call('POST', '/v2/files', files=files)
 
     def create_flow(self, flow_name, flow_description):
         """Создаёт Flow."""
-        moltin_token = self.get_access_token()
-
-        headers = {
-            'Authorization': f'Bearer {moltin_token.get("access_token")}'
-        }
-
         payload = {
             'data': {
                 'type': 'flow',
@@ -380,40 +540,15 @@ class Moltin():
             }
         }
 
-        response = requests.post(
-            f'https://api.moltin.com/v2/flows',
-            headers=headers,
-            json=payload
-        )
-        response.raise_for_status()
-
-        return response.json()
+        return self._call('POST', '/v2/flows', json=payload)
 
     def get_flows(self):
         """Получает список Flows."""
-        moltin_token = self.get_access_token()
-
-        headers = {
-            'Authorization': f'Bearer {moltin_token.get("access_token")}'
-        }
-
-        response = requests.get(
-            f'https://api.moltin.com/v2/flows',
-            headers=headers,
-        )
-        response.raise_for_status()
-
-        return response.json().get('data', [])
+        return self._call('GET', '/v2/flows', result=response_data_list)
 
     def get_flow_by_slug(self, flow_slug):
         """Получает Flow по slug."""
-        flows = self.get_flows()
-
-        flow_slug = slugify(flow_slug)
-
-        for flow in flows:
-            if flow.get('slug') == flow_slug:
-                return flow
+        return find_flow(self.get_flows(), flow_slug)
 
     def create_field_in_flow(self,
                              flow_id,
@@ -422,12 +557,6 @@ class Moltin():
                              field_type,
                              required=True):
         """Создаёт поле в Flow."""
-        moltin_token = self.get_access_token()
-
-        headers = {
-            'Authorization': f'Bearer {moltin_token.get("access_token")}'
-        }
-
         payload = {
             'data': {
                 'type': 'field',
@@ -451,70 +580,279 @@ class Moltin():
             }
         }
 
-        response = requests.post(
-            f'https://api.moltin.com/v2/fields',
-            headers=headers,
+        return self._call('POST', '/v2/fields', json=payload)
+
+    def create_entry(self, flow_name, field_data):
+        """Создание записи."""
+        payload = {
+            'data': {
+                'type': 'entry',
+                **field_data
+            }
+        }
+
+        return self._call(
+            'POST',
+            f'/v2/flows/{slugify(flow_name)}/entries',
             json=payload
         )
-        response.raise_for_status()
 
-        return response.json()
+    def get_entries(self, flow_name: str):
+        """Возвращает все записи."""
+        if self.catalog_cache is None:
+            return self.fetch_entries(flow_name)
 
-    def create_entry(self, flow_name, field_data):
-        """Создание записи."""
-        moltin_token = self.get_access_token()
+        return self.catalog_cache.get(f'entries:{slugify(flow_name)}',
+                                      partial(self.fetch_entries, flow_name))
 
-        headers = {
-            'Authorization': f'Bearer {moltin_token.get("access_token")}'
-        }
+    def fetch_entries(self, flow_name: str):
+        """Загружает все записи из Moltin, минуя кэш."""
+        return list(self.iter_entries(flow_name))
 
+    def iter_entries(self, flow_name: str):
+        """Перебирает все записи постранично, минуя кэш."""
+        return self.iter_items(f'/v2/flows/{slugify(flow_name)}/entries')
+
+    def update_entry(self, flow_name, entry_id, field_data):
+        """Изменение записи."""
         payload = {
             'data': {
+                'id': entry_id,
                 'type': 'entry',
                 **field_data
             }
         }
 
-        response = requests.post(
-            f'https://api.moltin.com/v2/flows/{slugify(flow_name)}/entries',
-            headers=headers,
+        return self._call(
+            'PUT',
+            f'/v2/flows/{slugify(flow_name)}/entries/{entry_id}',
             json=payload
         )
-        response.raise_for_status()
 
-        return response.json()
+    def delete_entry(self, flow_name, entry_id):
+        """Удаление записи."""
+        return self._call(
+            'DELETE',
+            f'/v2/flows/{slugify(flow_name)}/entries/{entry_id}',
+            result=response_status
+        )
 
-    def get_entries(self, flow_name: str):
-        """Возвращает все записи."""
-        entries = []
-        moltin_token = self.get_access_token()
 
-        headers = {
-            'Authorization': f'Bearer {moltin_token.get("access_token")}'
-        }
+class AsyncMoltin(Moltin):
+    """
+    Асинхронный клиент API Moltin с тем же набором методов.
+
+    Методы возвращают корутины, поэтому независимые запросы можно выполнять
+    одновременно, например asyncio.gather(get_cart(id), get_cart_items(id)).
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # Идущие загрузки ключей кэша каталога, общие для всех ждущих.
+        self.__loads = {}
 
-        response = requests.get(
-            f'https://api.moltin.com/v2/flows/{slugify(flow_name)}/entries',
-            headers=headers
+    @staticmethod
+    def create_session(pool_size, http2=False):
+        """Создаёт асинхронный HTTP-клиент с пулом keep-alive соединений."""
+        import httpx
+
+        return httpx.AsyncClient(
+            http2=http2,
+            limits=httpx.Limits(max_connections=pool_size,
+                                max_keepalive_connections=pool_size),
         )
-        response.raise_for_status()
 
-        entries = response.json().get('data', [])
+    async def close(self):
+        """Закрывает соединения клиента."""
+        await self.session.aclose()
 
-        return entries
+    def _post_token_request(self, url, **kwargs):
+        """Отправляет запрос токена; вызывается из потока, не из цикла событий."""
+        return requests.post(url, **kwargs)
 
-    def delete_entry(self, flow_name, entry_id):
-        """Удаление записи."""
-        moltin_token = self.get_access_token()
+    async def get_access_token(self):
+        """Возвращает токен."""
+        if self.token_manager.current():
+            return self.token_manager.get()
+
+        # Обновление токена блокирующее, поэтому выполняем его в потоке,
+        # передав туда контекст с дедлайном апдейта.
+        loop = asyncio.get_running_loop()
+
+        return await loop.run_in_executor(
+            None, contextvars.copy_context().run, self.token_manager.get)
+
+    async def get_auth_headers(self):
+        """Возвращает заголовки авторизации."""
+        return self._build_auth_headers(await self.get_access_token())
+
+    async def _request(self, method, path, **kwargs):
+        """Выполняет авторизованный запрос к API Moltin."""
+        with call_timer('moltin', route_name(method, path)):
+            return await self._send_request(method, path, **kwargs)
+
+    async def _send_request(self, method, path, **kwargs):
+        """
+        Отправляет запрос к API Moltin.
+
+        Повторяет запрос по правилам retry_policy, а после ответа 401
+        один раз повторяет его с новым токеном.
+        """
+        attempt = 0
+        is_token_refreshed = False
+
+        while True:
+            timeout = check_deadline()
+            if self.rate_limiter is not None:
+                await asyncio.sleep(self.rate_limiter.reserve())
+
+            moltin_token = await self.get_access_token()
+            try:
+                response = await self.session.request(
+                    method,
+                    f'{self.api_url}{path}',
+                    headers=self._build_auth_headers(moltin_token),
+                    **self._timeout_kwargs(timeout),
+                    **kwargs
+                )
+            except transient_errors() as err:
+                delay = self.retry_policy.retry_delay(method, path, attempt,
+                                                      error=err)
+                if delay is None:
+                    raise
+            else:
+                if response.status_code == 401 and not is_token_refreshed:
+                    self.token_manager.invalidate(moltin_token)
+                    is_token_refreshed = True
+                    continue
+
+                delay = self.retry_policy.retry_delay(method, path, attempt,
+                                                      response=response)
+                if delay is None:
+                    response.raise_for_status()
+                    return response
+
+            await asyncio.sleep(delay)
+            attempt += 1
+
+    async def _call(self, method, path, result=response_json, **kwargs):
+        """Выполняет запрос и разбирает ответ функцией result."""
+        return result(await self._request(method, path, **kwargs))
+
+    async def iter_pages(self, path, page_size=PAGE_SIZE):
+        """
+        Постранично загружает список, по одной странице за раз.
+
+        Следующая страница запрашивается, пока вызывающий код обрабатывает
+        текущую, поэтому в памяти не больше двух страниц.
+        """
+        task = asyncio.ensure_future(
+            self._call('GET', path, params=page_params(page_size))
+        )
 
-        headers = {
-            'Authorization': f'Bearer {moltin_token.get("access_token")}'
-        }
+        try:
+            while task is not None:
+                page = await task
+
+                task = None
+                if request := next_page(path, page):
+                    task = asyncio.ensure_future(
+                        self._call('GET', request[0], params=request[1])
+                    )
+
+                yield page.get('data', [])
+        finally:
+            if task is not None:
+                task.cancel()
+
+    async def iter_items(self, path, page_size=PAGE_SIZE):
+        """Перебирает все элементы списка, загружая их постранично."""
+        async for page in self.iter_pages(path, page_size):
+            for item in page:
+                yield item
+
+    async def _cached(self, key, loader):
+        """Читает ключ из кэша каталога, обновляя просроченное значение в фоне."""
+        if self.catalog_cache is None:
+            return await loader()
+
+        found, value, is_stale = self.catalog_cache.lookup(key)
 
-        response = requests.delete(
-            f'https://api.moltin.com/v2/flows/{slugify(flow_name)}/entries/{entry_id}',
-            headers=headers
+        if not found:
+            # Отмена одного ждущего не должна отменять общую загрузку.
+            value = await asyncio.shield(self.__load(key, loader))
+        elif is_stale and self.catalog_cache.claim_refresh(key):
+            task = self.__load(key, loader)
+            task.add_done_callback(partial(self.__refreshed, key))
+
+        return value
+
+    def __refreshed(self, key, task):
+        """Отмечает окончание фонового обновления ключа."""
+        self.catalog_cache.release_refresh(key)
+
+        if not task.cancelled() and (err := task.exception()):
+            logger.warning('Не удалось обновить %s: %s', key, err)
+
+    def __load(self, key, loader):
+        """Возвращает задачу загрузки ключа, запуская её, если её ещё нет."""
+        if (task := self.__loads.get(key)) is None:
+            task = asyncio.create_task(self.__store(key, loader))
+            self.__loads[key] = task
+            task.add_done_callback(lambda task: self.__loads.pop(key, None))
+
+        return task
+
+    async def __store(self, key, loader):
+        value = await loader()
+        self.catalog_cache.set(key, value)
+
+        return value
+
+    async def get_or_create_cart(self, cart_id):
+        """Создаёт корзину."""
+        if cart := await self.get_cart(cart_id):
+            return cart
+
+        return await self.create_cart(cart_id)
+
+    async def get_products(self):
+        """Возвращает список товаров."""
+        return await self._cached('products', self.fetch_products)
+
+    async def fetch_products(self):
+        """Загружает список товаров из Moltin, минуя кэш."""
+        return self._cache_products(
+            [product async for product in self.iter_products()]
         )
-        response.raise_for_status()
 
-        return response.status_code
+    async def get_product(self, item_id):
+        """Возвращает описание товара."""
+        return await self._cached(f'product:{item_id}',
+                                  partial(self.fetch_product, item_id))
+
+    async def get_flow_by_slug(self, flow_slug):
+        """Получает Flow по slug."""
+        return find_flow(await self.get_flows(), flow_slug)
+
+    async def get_entries(self, flow_name: str):
+        """Возвращает все записи."""
+        return await self._cached(f'entries:{slugify(flow_name)}',
+                                  partial(self.fetch_entries, flow_name))
+
+    async def fetch_entries(self, flow_name: str):
+        """Загружает все записи из Moltin, минуя кэш."""
+        return [entry async for entry in self.iter_entries(flow_name)]
+
+    async def get_files(self):
+        """Возвращает список файлов."""
+        return [remote_file async for remote_file in self.iter_files()]
+
+
+def find_flow(flows, flow_slug):
+    """Ищет Flow по slug."""
+    flow_slug = slugify(flow_slug)
+
+    for flow in flows:
+        if flow.get('slug') == flow_slug:
+            return flow
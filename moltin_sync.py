@@ -0,0 +1,361 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+
+from slugify import slugify
+
+logger = logging.getLogger('pizza-shop')
+
+
+class Checkpoint():
+    """
+    Файл с уже выполненными шагами синхронизации.
+
+    Позволяет прерванному запуску продолжить с того места, где он
+    остановился, не загружая повторно уже загруженные изображения.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.__lock = threading.Lock()
+        self.__state = {'done': [], 'files': {}}
+
+        if os.path.exists(path):
+            with open(path, 'r') as checkpoint_file:
+                self.__state = json.load(checkpoint_file)
+            logger.info('Продолжаем синхронизацию с %s', path)
+
+        self.__done = set(self.__state['done'])
+
+    def __repr__(self):
+        return '<{} {}>'.format(self.__class__.__name__.upper(), self.path)
+
+    def is_done(self, step):
+        """Проверяет, выполнен ли шаг."""
+        return step in self.__done
+
+    def mark_done(self, step):
+        """Отмечает шаг выполненным."""
+        with self.__lock:
+            self.__done.add(step)
+            self.__state['done'].append(step)
+            self.__save()
+
+    def get_file(self, url):
+        """Возвращает id файла, загруженного по ссылке в этом запуске."""
+        return self.__state['files'].get(url)
+
+    def set_file(self, url, file_id):
+        """Запоминает id загруженного файла."""
+        with self.__lock:
+            self.__state['files'][url] = file_id
+            self.__save()
+
+    def remove(self):
+        """Удаляет файл после успешной синхронизации."""
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def __save(self):
+        temporary_path = f'{self.path}.tmp'
+        with open(temporary_path, 'w') as checkpoint_file:
+            json.dump(self.__state, checkpoint_file)
+        os.replace(temporary_path, self.path)
+
+
+def record_hash(record):
+    """Возвращает хэш содержимого записи."""
+    content = json.dumps(record, sort_keys=True, ensure_ascii=False)
+
+    return hashlib.sha256(content.encode('utf-8')).hexdigest()[:16]
+
+
+def index_remote_records(remote_records):
+    """
+    Раскладывает пары (ключ, запись Moltin) по ключам.
+
+    Возвращает словарь записей и id лишних копий с уже встреченным
+    ключом: такие копии синхронизация удаляет.
+    """
+    records = {}
+    duplicate_ids = []
+
+    for key, remote in remote_records:
+        if key in records:
+            logger.warning('В Moltin несколько записей %s, лишняя %s '
+                           'будет удалена', key, remote['id'])
+            duplicate_ids.append(remote['id'])
+        else:
+            records[key] = remote
+
+    return records, duplicate_ids
+
+
+def get_local_menu(menu_items):
+    """Возвращает товары меню по slug."""
+    return {
+        slugify(menu_item.get('name')): {
+            'name': menu_item.get('name'),
+            'description': menu_item.get('description'),
+            'price': menu_item.get('price'),
+            'image_url': menu_item.get('product_image').get('url'),
+        }
+        for menu_item in menu_items
+    }
+
+
+def get_remote_menu(moltin_api):
+    """
+    Возвращает товары Moltin по slug, id лишних копий товаров с тем же
+    slug и id загруженных файлов по ссылке.
+
+    Записи товаров приводятся к тому же виду, что и локальные, чтобы их
+    хэши можно было сравнить.
+    """
+    file_urls = {
+        remote_file.get('id'): remote_file.get('link', {}).get('href')
+        for remote_file in moltin_api.get_files()
+    }
+
+    remote_products = []
+    for product in moltin_api.fetch_products():
+        image = (product.get('relationships', {})
+                 .get('main_image', {})
+                 .get('data')) or {}
+        price = (product.get('price') or [{}])[0]
+
+        remote_products.append((product.get('slug'), {
+            'id': product.get('id'),
+            'record': {
+                'name': product.get('name'),
+                'description': product.get('description'),
+                'price': price.get('amount'),
+                'image_url': file_urls.get(image.get('id')),
+            },
+        }))
+
+    products, duplicate_ids = index_remote_records(remote_products)
+    file_ids = {url: file_id for file_id, url in file_urls.items() if url}
+
+    return products, duplicate_ids, file_ids
+
+
+def get_local_addresses(addresses, get_address_fields):
+    """Возвращает поля пиццерий по alias."""
+    return {
+        address.get('alias'): get_address_fields(address)
+        for address in addresses
+    }
+
+
+def get_remote_addresses(moltin_api, flow_name, field_names):
+    """
+    Возвращает записи пиццерий Moltin по alias и id лишних копий записей
+    с тем же alias.
+    """
+    return index_remote_records(
+        (entry.get('alias'), {
+            'id': entry.get('id'),
+            'record': {name: entry.get(name) for name in field_names},
+        })
+        for entry in moltin_api.fetch_entries(flow_name)
+    )
+
+
+def plan_changes(local_records, remote_records, duplicate_ids=()):
+    """
+    Сравнивает локальные и удалённые записи по хэшам.
+
+    Возвращает списки ключей на создание и изменение и id на удаление,
+    в том числе id лишних копий из duplicate_ids.
+    """
+    to_create = []
+    to_update = []
+
+    for key, record in local_records.items():
+        remote = remote_records.get(key)
+        if remote is None:
+            to_create.append(key)
+        elif record_hash(record) != record_hash(remote['record']):
+            to_update.append(key)
+
+    to_delete = [
+        remote['id']
+        for key, remote in remote_records.items()
+        if key not in local_records
+    ]
+    to_delete.extend(duplicate_ids)
+
+    return to_create, to_update, to_delete
+
+
+class MenuSync():
+    """
+    Синхронизирует меню с Moltin, трогая только изменившиеся товары.
+
+    changed становится True, если товары создавались, менялись или
+    удалялись. В changed_photos собираются id товаров, у которых
+    сменилось или пропало изображение: их фотографии нужно убрать из
+    кэша бота.
+    """
+
+    def __init__(self, moltin_api, checkpoint):
+        self.moltin_api = moltin_api
+        self.checkpoint = checkpoint
+        self.changed = False
+        self.changed_photos = set()
+        self.__file_ids = {}
+        self.__lock = threading.Lock()
+
+    def plan(self, menu_items):
+        """Возвращает шаги синхронизации."""
+        self.local_menu = get_local_menu(menu_items)
+        self.remote_menu, duplicate_ids, self.__file_ids = get_remote_menu(
+            self.moltin_api)
+
+        to_create, to_update, to_delete = plan_changes(self.local_menu,
+                                                       self.remote_menu,
+                                                       duplicate_ids)
+        logger.info('Меню: создать %s, изменить %s, удалить %s, '
+                    'без изменений %s',
+                    len(to_create), len(to_update), len(to_delete),
+                    len(self.local_menu) - len(to_create) - len(to_update))
+
+        return (
+            [('create', slug) for slug in to_create]
+            + [('update', slug) for slug in to_update]
+            + [('delete', product_id) for product_id in to_delete]
+        )
+
+    def apply(self, step):
+        """Выполняет шаг синхронизации, если он ещё не выполнен."""
+        action, key = step
+        record = self.local_menu.get(key, {})
+        checkpoint_step = f'menu:{action}:{key}:{record_hash(record)}'
+        # Шаг из прерванного запуска тоже изменил каталог.
+        self.changed = True
+
+        if self.checkpoint.is_done(checkpoint_step):
+            return
+
+        if action == 'create':
+            self.create(record)
+        elif action == 'update':
+            self.update(self.remote_menu[key], record)
+        else:
+            with self.__lock:
+                self.changed_photos.add(key)
+            self.moltin_api.delete_product(key)
+
+        self.checkpoint.mark_done(checkpoint_step)
+
+    def create(self, record):
+        """Создаёт товар."""
+        product = self.moltin_api.create_product(record['name'],
+                                                 record['description'],
+                                                 record['price'])
+        self.moltin_api.add_file_to_product(
+            product.get('id'),
+            self.get_file_id(record['image_url'])
+        )
+
+    def update(self, remote, record):
+        """Изменяет товар и, если поменялась ссылка, его изображение."""
+        remote_record = remote['record']
+
+        if any(remote_record[field] != record[field]
+               for field in ('name', 'description', 'price')):
+            self.moltin_api.update_product(remote['id'],
+                                           record['name'],
+                                           record['description'],
+                                           record['price'])
+
+        if remote_record['image_url'] != record['image_url']:
+            with self.__lock:
+                self.changed_photos.add(remote['id'])
+            self.moltin_api.add_file_to_product(
+                remote['id'],
+                self.get_file_id(record['image_url'])
+            )
+
+    def get_file_id(self, image_url):
+        """Возвращает id файла по ссылке, загружая файл только один раз."""
+        with self.__lock:
+            if file_id := (self.__file_ids.get(image_url)
+                           or self.checkpoint.get_file(image_url)):
+                return file_id
+
+        upload_file = self.moltin_api.upload_file_from_url(image_url)
+        file_id = upload_file.get('data').get('id')
+
+        with self.__lock:
+            self.__file_ids[image_url] = file_id
+        self.checkpoint.set_file(image_url, file_id)
+
+        return file_id
+
+
+class AddressSync():
+    """
+    Синхронизирует пиццерии с Moltin, трогая только изменившиеся записи.
+
+    changed становится True, если записи создавались, менялись или
+    удалялись.
+    """
+
+    def __init__(self, moltin_api, checkpoint, flow_name='Pizzeria'):
+        self.moltin_api = moltin_api
+        self.checkpoint = checkpoint
+        self.flow_name = flow_name
+        self.changed = False
+
+    def plan(self, addresses, get_address_fields):
+        """Возвращает шаги синхронизации."""
+        self.local_addresses = get_local_addresses(addresses,
+                                                   get_address_fields)
+        field_names = next(iter(self.local_addresses.values()), {}).keys()
+        self.remote_addresses, duplicate_ids = get_remote_addresses(
+            self.moltin_api,
+            self.flow_name,
+            field_names
+        )
+
+        to_create, to_update, to_delete = plan_changes(
+            self.local_addresses,
+            self.remote_addresses,
+            duplicate_ids
+        )
+        logger.info('Адреса: создать %s, изменить %s, удалить %s, '
+                    'без изменений %s',
+                    len(to_create), len(to_update), len(to_delete),
+                    len(self.local_addresses) - len(to_create)
+                    - len(to_update))
+
+        return (
+            [('create', alias) for alias in to_create]
+            + [('update', alias) for alias in to_update]
+            + [('delete', entry_id) for entry_id in to_delete]
+        )
+
+    def apply(self, step):
+        """Выполняет шаг синхронизации, если он ещё не выполнен."""
+        action, key = step
+        record = self.local_addresses.get(key, {})
+        checkpoint_step = f'addresses:{action}:{key}:{record_hash(record)}'
+        self.changed = True
+
+        if self.checkpoint.is_done(checkpoint_step):
+            return
+
+        if action == 'create':
+            self.moltin_api.create_entry(self.flow_name, record)
+        elif action == 'update':
+            self.moltin_api.update_entry(self.flow_name,
+                                         self.remote_addresses[key]['id'],
+                                         record)
+        else:
+            self.moltin_api.delete_entry(self.flow_name, key)
+
+        self.checkpoint.mark_done(checkpoint_step)
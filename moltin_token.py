@@ -0,0 +1,188 @@
+import hashlib
+import json
+import logging
+import threading
+import time
+
+from single_flight import SingleFlight
+
+logger = logging.getLogger('pizza-shop')
+
+
+class TokenManager():
+    """
+    Токен доступа Moltin.
+
+    Обновляет токен в фоне за refresh_margin секунд до истечения, а
+    одновременные запросы нового токена объединяет в один. Если передан
+    Redis, токен общий для всех процессов бота: обновляет его тот процесс,
+    который первым взял блокировку, остальные читают готовый токен.
+    """
+
+    KEY = 'moltin:token:{}'
+    LOCK_KEY = 'moltin:token:{}:lock'
+
+    def __init__(self,
+                 fetch_token,
+                 redis_db=None,
+                 namespace='',
+                 refresh_margin=60,
+                 lock_timeout=10):
+        self.refresh_margin = refresh_margin
+        self.lock_timeout = lock_timeout
+        self.__fetch_token = fetch_token
+        self.__redis_db = redis_db
+        namespace = hashlib.sha1(namespace.encode('utf-8')).hexdigest()[:12]
+        self.__key = self.KEY.format(namespace)
+        self.__lock_key = self.LOCK_KEY.format(namespace)
+        self.__token = {}
+        self.__single_flight = SingleFlight()
+        self.__timer = None
+        self.__timer_lock = threading.Lock()
+        self.__is_refreshing = False
+
+    def __repr__(self):
+        return '<{}>'.format(self.__class__.__name__.upper())
+
+    def current(self):
+        """Возвращает текущий токен, если он ещё действует."""
+        if time_left(self.__token) > 0:
+            return self.__token
+
+    def is_expired(self):
+        """Проверка, истек ли срок действия токена."""
+        return self.current() is None
+
+    def get(self):
+        """Возвращает действующий токен, при необходимости дожидаясь нового."""
+        if moltin_token := self.current():
+            if time_left(moltin_token) < self.__margin(moltin_token):
+                self.refresh_in_background()
+
+            return moltin_token
+
+        return self.refresh()
+
+    def refresh(self):
+        """Получает новый токен; одновременные вызовы ждут один запрос."""
+        return self.__single_flight.do('token', self.__refresh)
+
+    def refresh_in_background(self):
+        """Запускает обновление токена в отдельном потоке, если оно не идёт."""
+        with self.__timer_lock:
+            if self.__is_refreshing:
+                return
+            self.__is_refreshing = True
+
+        thread = threading.Thread(target=self.__refresh_quietly,
+                                  name='moltin-token-refresh',
+                                  daemon=True)
+        thread.start()
+
+    def invalidate(self, moltin_token=None):
+        """
+        Сбрасывает токен, например после ответа 401.
+
+        Если передан moltin_token, сбрасывает только его, чтобы не выбросить
+        уже полученный другим потоком новый токен.
+        """
+        if moltin_token is not None and moltin_token is not self.__token:
+            return
+
+        access_token = self.__token.get('access_token')
+        self.__token = {}
+
+        if self.__redis_db is None or not access_token:
+            return
+
+        try:
+            shared_token = self.__redis_db.get(self.__key)
+            if shared_token and json.loads(shared_token).get(
+                    'access_token') == access_token:
+                self.__redis_db.delete(self.__key)
+        except Exception as err:
+            logger.warning('Не удалось сбросить общий токен Moltin: %s', err)
+
+    def __refresh_quietly(self):
+        try:
+            self.refresh()
+        except Exception as err:
+            logger.warning('Не удалось обновить токен Moltin: %s', err)
+        finally:
+            with self.__timer_lock:
+                self.__is_refreshing = False
+
+    def __margin(self, moltin_token):
+        # Короткоживущий токен обновляем не раньше середины его срока.
+        return min(self.refresh_margin,
+                   moltin_token.get('expires_in', self.refresh_margin) / 2)
+
+    def __refresh(self):
+        # Пока шёл предыдущий запрос, токен мог обновиться.
+        if (moltin_token := self.current()) and \
+                time_left(moltin_token) >= self.__margin(moltin_token):
+            return moltin_token
+
+        if self.__redis_db is None:
+            moltin_token = self.__fetch_token()
+        else:
+            moltin_token = self.__refresh_shared()
+
+        self.__token = moltin_token
+        self.__schedule_refresh(moltin_token)
+
+        return moltin_token
+
+    def __refresh_shared(self):
+        deadline = time.monotonic() + self.lock_timeout
+
+        while True:
+            try:
+                shared_token = self.__redis_db.get(self.__key)
+            except Exception as err:
+                logger.warning('Общий токен Moltin недоступен: %s', err)
+                return self.__fetch_token()
+
+            if shared_token:
+                moltin_token = json.loads(shared_token)
+                if time_left(moltin_token) >= self.__margin(moltin_token):
+                    return moltin_token
+
+            if self.__redis_db.set(self.__lock_key, 1,
+                                   nx=True, ex=self.lock_timeout):
+                try:
+                    moltin_token = self.__fetch_token()
+                    self.__redis_db.set(
+                        self.__key,
+                        json.dumps(moltin_token),
+                        ex=max(int(time_left(moltin_token)), 1),
+                    )
+                    return moltin_token
+                finally:
+                    self.__redis_db.delete(self.__lock_key)
+
+            # Токен обновляет другой процесс.
+            if time.monotonic() > deadline:
+                return self.__fetch_token()
+            time.sleep(0.1)
+
+    def __schedule_refresh(self, moltin_token):
+        delay = time_left(moltin_token) - self.__margin(moltin_token)
+        if delay <= 0:
+            return
+
+        with self.__timer_lock:
+            if self.__timer is not None:
+                self.__timer.cancel()
+
+            self.__timer = threading.Timer(delay, self.__refresh_quietly)
+            self.__timer.daemon = True
+            self.__timer.start()
+
+
+def time_left(moltin_token):
+    """Возвращает, сколько секунд ещё действует токен."""
+    if not moltin_token:
+        return 0
+
+    return moltin_token.get('expires', 0) - time.time()
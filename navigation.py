@@ -0,0 +1,126 @@
+import contextvars
+import logging
+from contextlib import contextmanager
+
+from telegram.error import BadRequest
+
+from metrics import TELEGRAM_CALLS_SAVED
+from photo_cache import send_product_photo
+
+logger = logging.getLogger('pizza-shop')
+
+# Сколько запросов к Telegram сэкономлено при обработке текущего апдейта.
+_calls_saved = contextvars.ContextVar('calls_saved', default=None)
+
+
+@contextmanager
+def count_calls_saved():
+    """Считает сэкономленные запросы к Telegram внутри блока with."""
+    tally = [0]
+    token = _calls_saved.set(tally)
+    try:
+        yield tally
+    finally:
+        _calls_saved.reset(token)
+        TELEGRAM_CALLS_SAVED.observe(tally[0])
+
+
+def add_calls_saved(count=1):
+    """Добавляет сэкономленные запросы к счётчику апдейта."""
+    if (tally := _calls_saved.get()) is not None:
+        tally[0] += count
+
+
+def is_not_modified(err):
+    """Проверяет, что Telegram отказался править сообщение без изменений."""
+    return 'message is not modified' in str(err).lower()
+
+
+def show_text(bot, update, text, reply_markup=None, parse_mode=None):
+    """
+    Показывает экран с текстом.
+
+    Если пользователь нажал кнопку под текстовым сообщением, оно
+    редактируется: меняется только клавиатура, если текст тот же, иначе
+    текст с клавиатурой. Иначе отправляется новое сообщение, а старое
+    удаляется.
+    """
+    chat_id = update.effective_chat.id
+    current = update.effective_message
+
+    if update.callback_query and current.text is not None:
+        try:
+            if current.text == text and parse_mode is None:
+                message = bot.edit_message_reply_markup(
+                    chat_id=chat_id,
+                    message_id=current.message_id,
+                    reply_markup=reply_markup,
+                )
+            else:
+                message = bot.edit_message_text(
+                    text,
+                    chat_id=chat_id,
+                    message_id=current.message_id,
+                    reply_markup=reply_markup,
+                    parse_mode=parse_mode,
+                )
+        except BadRequest as err:
+            if not is_not_modified(err):
+                logger.debug('Не удалось изменить сообщение: %s', err)
+                return replace_message(bot, update, text,
+                                       reply_markup=reply_markup,
+                                       parse_mode=parse_mode)
+
+            message = current
+
+        add_calls_saved()
+
+        return message
+
+    return replace_message(bot, update, text,
+                           reply_markup=reply_markup,
+                           parse_mode=parse_mode)
+
+
+def show_product_photo(bot, update, product, moltin_api, caption,
+                       reply_markup=None, parse_mode=None):
+    """
+    Показывает карточку товара с фотографией.
+
+    Карточку открывают из текстового меню, а текстовое сообщение Telegram
+    не даёт заменить фотографией, поэтому отправляется новое сообщение,
+    а старое удаляется.
+    """
+    chat_id = update.effective_chat.id
+
+    message = send_product_photo(bot,
+                                 chat_id,
+                                 product,
+                                 moltin_api,
+                                 caption=caption,
+                                 parse_mode=parse_mode,
+                                 reply_markup=reply_markup)
+    delete_message(bot, chat_id, update.effective_message.message_id)
+
+    return message
+
+
+def replace_message(bot, update, text, reply_markup=None, parse_mode=None):
+    """Отправляет новое сообщение и удаляет то, на которое ответил пользователь."""
+    chat_id = update.effective_chat.id
+
+    message = bot.send_message(chat_id=chat_id,
+                               text=text,
+                               reply_markup=reply_markup,
+                               parse_mode=parse_mode)
+    delete_message(bot, chat_id, update.effective_message.message_id)
+
+    return message
+
+
+def delete_message(bot, chat_id, message_id):
+    """Удаляет сообщение; сообщения старше 48 часов Telegram удалять не даёт."""
+    try:
+        bot.delete_message(chat_id=chat_id, message_id=message_id)
+    except BadRequest as err:
+        logger.debug('Не удалось удалить сообщение: %s', err)
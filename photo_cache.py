@@ -0,0 +1,134 @@
+import logging
+
+from environs import Env
+from telegram import Bot
+
+from database import get_database_connection
+from instrumentation import cache_lookup
+from moltin_api import MOLTIN_API_URL, Moltin
+
+NO_IMAGE_PATH = 'no_image.jpg'
+
+_photo_cache = None
+
+logger = logging.getLogger('pizza-shop')
+
+
+class PhotoCache():
+    """Хранит в Redis Telegram file_id фотографий товаров."""
+
+    KEY = 'product_photos'
+
+    def __init__(self, redis_db):
+        self.__redis_db = redis_db
+
+    def __repr__(self):
+        return '<{}>'.format(self.__class__.__name__.upper())
+
+    def get(self, product_id):
+        """Возвращает file_id фотографии товара."""
+        file_id = self.__redis_db.hget(self.KEY, product_id)
+        cache_lookup('photo', file_id is not None)
+
+        if file_id:
+            return file_id.decode('utf-8')
+
+    def set(self, product_id, file_id):
+        """Запоминает file_id фотографии товара."""
+        self.__redis_db.hset(self.KEY, product_id, file_id)
+
+    def discard(self, product_ids):
+        """Удаляет file_id фотографий перечисленных товаров."""
+        if product_ids:
+            self.__redis_db.hdel(self.KEY, *product_ids)
+
+    def clear(self):
+        """Удаляет все file_id."""
+        self.__redis_db.delete(self.KEY)
+
+
+def get_photo_cache():
+    """Возвращает кэш фотографий, либо создаёт новый, если он ещё не создан."""
+    global _photo_cache
+    if _photo_cache is None:
+        _photo_cache = PhotoCache(get_database_connection())
+
+    return _photo_cache
+
+
+def get_image_url(product, moltin_api):
+    """Получает ссылку на URL изображения."""
+    if file_id := (product.get('relationships')
+                   .get('main_image')
+                   .get('data')
+                   .get('id')):
+
+        if file_url := (moltin_api.get_file_url(file_id)
+                        .get('data')
+                        .get('link')
+                        .get('href')):
+
+            return file_url
+
+
+def send_product_photo(bot, chat_id, product, moltin_api, **kwargs):
+    """
+    Отправляет фотографию товара.
+
+    При первой отправке Telegram сам скачивает изображение, а полученный
+    file_id сохраняется, чтобы дальше отправлять фото без обращения к Moltin.
+    """
+    photo_cache = get_photo_cache()
+    product_id = product.get('id')
+
+    if file_id := photo_cache.get(product_id):
+        return bot.send_photo(chat_id=chat_id, photo=file_id, **kwargs)
+
+    try:
+        image_url = get_image_url(product, moltin_api)
+    except AttributeError:
+        image_url = None
+
+    if image_url:
+        message = bot.send_photo(chat_id=chat_id, photo=image_url, **kwargs)
+    else:
+        with open(NO_IMAGE_PATH, 'rb') as image:
+            message = bot.send_photo(chat_id=chat_id, photo=image, **kwargs)
+
+    photo_cache.set(product_id, message.photo[-1].file_id)
+
+    return message
+
+
+def warm_up(bot, chat_id, moltin_api):
+    """Заполняет кэш фотографий для всего каталога."""
+    get_photo_cache().clear()
+
+    for product in moltin_api.get_products():
+        message = send_product_photo(bot, chat_id, product, moltin_api)
+        bot.delete_message(chat_id=chat_id, message_id=message.message_id)
+
+        logger.info(product.get('name'))
+
+
+def main():
+    logging.basicConfig(
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+        level=logging.INFO,
+    )
+
+    env = Env()
+    env.read_env()
+
+    token = env.str('TELEGRAM_TOKEN')
+    warm_up_chat_id = env.int('TELEGRAM_WARM_UP_CHAT_ID')
+    moltin_client_id = env.str('MOLTIN_CLIENT_ID')
+
+    moltin_api = Moltin(moltin_client_id,
+                        api_url=env.str('MOLTIN_API_URL', '') or MOLTIN_API_URL)
+
+    warm_up(Bot(token), warm_up_chat_id, moltin_api)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,150 @@
+import heapq
+import math
+import threading
+
+from geocode_api import EARTH_RADIUS_KM
+
+_index = None
+_index_entries = None
+_index_lock = threading.Lock()
+
+
+def to_unit_vector(coords):
+    """Переводит (широта, долгота) в точку на единичной сфере."""
+    lat, lon = map(math.radians, coords)
+
+    return (math.cos(lat) * math.cos(lon),
+            math.cos(lat) * math.sin(lon),
+            math.sin(lat))
+
+
+def chord_to_km(chord):
+    """Переводит длину хорды единичной сферы в расстояние по поверхности, км."""
+    return 2 * EARTH_RADIUS_KM * math.asin(min(chord / 2, 1.0))
+
+
+def km_to_chord(distance_km):
+    """Переводит расстояние по поверхности, км, в длину хорды единичной сферы."""
+    angle = min(distance_km / EARTH_RADIUS_KM, math.pi)
+
+    return 2 * math.sin(angle / 2)
+
+
+class PizzeriaIndex():
+    """
+    KD-дерево по координатам пиццерий на единичной сфере.
+
+    Евклидово расстояние между точками сферы (хорда) монотонно расстоянию
+    по большому кругу, поэтому ближайшие по хорде пиццерии — ближайшие и
+    на карте. Расстояния возвращаются в километрах по сфере.
+    """
+
+    def __init__(self, pizzerias):
+        points = [
+            (to_unit_vector((pizzeria.get('latitude'),
+                             pizzeria.get('longitude'))), pizzeria)
+            for pizzeria in pizzerias
+        ]
+        self.size = len(points)
+        self.__root = self.__build(points, 0)
+
+    def __repr__(self):
+        return '<{} size={}>'.format(self.__class__.__name__.upper(),
+                                     self.size)
+
+    def __build(self, points, axis):
+        if not points:
+            return None
+
+        points.sort(key=lambda point: point[0][axis])
+        median = len(points) // 2
+        next_axis = (axis + 1) % 3
+
+        return (points[median],
+                axis,
+                self.__build(points[:median], next_axis),
+                self.__build(points[median + 1:], next_axis))
+
+    def nearest(self, coords, k=1):
+        """Возвращает k ближайших пиццерий списком пар (расстояние, пиццерия)."""
+        target = to_unit_vector(coords)
+        # Куча из k лучших кандидатов, с обратным знаком расстояния.
+        best = []
+
+        def search(node):
+            if node is None:
+                return
+
+            (point, pizzeria), axis, left, right = node
+            chord = math.dist(point, target)
+
+            if len(best) < k:
+                heapq.heappush(best, (-chord, id(pizzeria), pizzeria))
+            elif chord < -best[0][0]:
+                heapq.heapreplace(best, (-chord, id(pizzeria), pizzeria))
+
+            delta = target[axis] - point[axis]
+            near, far = (left, right) if delta < 0 else (right, left)
+
+            search(near)
+            if len(best) < k or abs(delta) < -best[0][0]:
+                search(far)
+
+        search(self.__root)
+
+        return [(round(chord_to_km(-chord), 2), pizzeria)
+                for chord, _, pizzeria in sorted(best, reverse=True)]
+
+    def within_radius(self, coords, radius_km):
+        """Возвращает пиццерии в радиусе radius_km, от ближней к дальней."""
+        target = to_unit_vector(coords)
+        radius = km_to_chord(radius_km)
+        found = []
+
+        def search(node):
+            if node is None:
+                return
+
+            (point, pizzeria), axis, left, right = node
+            chord = math.dist(point, target)
+
+            if chord <= radius:
+                found.append((chord, id(pizzeria), pizzeria))
+
+            delta = target[axis] - point[axis]
+            if delta - radius <= 0:
+                search(left)
+            if delta + radius >= 0:
+                search(right)
+
+        search(self.__root)
+
+        return [(round(chord_to_km(chord), 2), pizzeria)
+                for chord, _, pizzeria in sorted(found)]
+
+
+def get_pizzeria_index(moltin_api, flow_name='Pizzeria'):
+    """
+    Возвращает индекс пиццерий.
+
+    Индекс перестраивается, только когда из Moltin пришли другие записи.
+    """
+    global _index, _index_entries
+
+    entries = moltin_api.get_entries(flow_name)
+
+    with _index_lock:
+        if entries is not _index_entries:
+            if _index is None or fingerprint(entries) != fingerprint(_index_entries):
+                _index = PizzeriaIndex(entries)
+            _index_entries = entries
+
+        return _index
+
+
+def fingerprint(entries):
+    """Возвращает слепок записей для проверки изменений."""
+    return tuple(
+        (entry.get('id'), entry.get('latitude'), entry.get('longitude'))
+        for entry in entries or []
+    )
@@ -0,0 +1,279 @@
+import linecache
+import logging
+import os
+import signal
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+
+from environs import Env
+
+logger = logging.getLogger('pizza-shop')
+
+_profiler = None
+
+# Выделения самого профилирования не интересны. Фильтровать статистику
+# дешевле, чем снимок: Snapshot.filter_traces() перебирает каждую трассу.
+IGNORED_FILES = frozenset((
+    tracemalloc.__file__,
+    linecache.__file__,
+    '<frozen importlib._bootstrap>',
+    '<frozen importlib._bootstrap_external>',
+))
+
+
+class SamplingProfiler():
+    """
+    Сэмплирующий профилировщик CPU.
+
+    Фоновый поток раз в interval секунд снимает стеки всех потоков через
+    sys._current_frames() и считает одинаковые стеки. Код бота при этом
+    не меняется и не замедляется, кроме как на время снятия стеков.
+    Результат — свёрнутые стеки (collapsed stacks), которые понимают
+    flamegraph.pl и speedscope.
+    """
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+
+    def __repr__(self):
+        return '<{} interval={}>'.format(self.__class__.__name__.upper(),
+                                         self.interval)
+
+    def run(self, seconds):
+        """Снимает стеки в течение seconds секунд, возвращает их счётчик."""
+        stacks = Counter()
+        own_thread_id = threading.get_ident()
+        thread_names = {}
+        deadline = time.monotonic() + seconds
+
+        while time.monotonic() < deadline:
+            if len(thread_names) != threading.active_count():
+                thread_names = {thread.ident: thread.name
+                                for thread in threading.enumerate()}
+
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_thread_id:
+                    continue
+
+                stacks[self.collapse(thread_names.get(thread_id, thread_id),
+                                     frame)] += 1
+
+            time.sleep(self.interval)
+
+        return stacks
+
+    @staticmethod
+    def collapse(thread_name, frame):
+        """Сворачивает стек в строку «поток;внешняя функция;...;внутренняя»."""
+        names = []
+        while frame is not None:
+            code = frame.f_code
+            names.append('{} ({}:{})'.format(code.co_name,
+                                             os.path.basename(code.co_filename),
+                                             code.co_firstlineno))
+            frame = frame.f_back
+
+        names.append(str(thread_name))
+
+        return ';'.join(reversed(names))
+
+
+def write_collapsed(stacks, path):
+    """Пишет свёрнутые стеки в формате flamegraph.pl."""
+    with open(path, 'w', encoding='utf-8') as file:
+        for stack, count in stacks.most_common():
+            file.write(f'{stack} {count}\n')
+
+
+class Profiler():
+    """
+    Профилирование работающего бота по команде.
+
+    CPU профилируется сэмплирующим профилировщиком только на время
+    запроса, память — через tracemalloc, который запускается первым
+    снимком и работает до memory_stop(). Результаты пишутся в output_dir.
+    """
+
+    def __init__(self, output_dir='profiles', interval=0.005, frames=10):
+        self.output_dir = output_dir
+        self.frames = frames
+        self.sampling_profiler = SamplingProfiler(interval)
+        self.__snapshot = None
+        self.__cpu_lock = threading.Lock()
+        self.__memory_lock = threading.Lock()
+        self.__snapshot_lock = threading.Lock()
+
+    def __repr__(self):
+        return '<{} {}>'.format(self.__class__.__name__.upper(),
+                                self.output_dir)
+
+    @property
+    def is_cpu_running(self):
+        return self.__cpu_lock.locked()
+
+    def start_cpu(self, seconds, on_done=None):
+        """
+        Запускает профилирование CPU в фоновом потоке.
+
+        Возвращает путь будущего профиля или None, если профилирование уже
+        идёт. По окончании вызывает on_done(path).
+        """
+        if not self.__cpu_lock.acquire(blocking=False):
+            return None
+
+        path = self.__output_path('cpu', 'collapsed')
+        threading.Thread(target=self.__profile_cpu,
+                         args=(seconds, path, on_done),
+                         name='cpu-profiler',
+                         daemon=True).start()
+        logger.info('Профилирование CPU на %s с, профиль %s', seconds, path)
+
+        return path
+
+    def __profile_cpu(self, seconds, path, on_done):
+        try:
+            stacks = self.sampling_profiler.run(seconds)
+            write_collapsed(stacks, path)
+            logger.info('Профиль CPU записан в %s: %s стеков',
+                        path, sum(stacks.values()))
+        except Exception:
+            logger.exception('Профилирование CPU не удалось')
+            return
+        finally:
+            self.__cpu_lock.release()
+
+        if on_done is not None:
+            try:
+                on_done(path)
+            except Exception:
+                logger.exception('Не удалось отправить профиль CPU')
+
+    def start_memory_snapshot(self, on_done=None, top=15):
+        """
+        Снимает снимок памяти в фоновом потоке.
+
+        Снимок живого процесса может занять секунды, поэтому вызывающий
+        поток его не ждёт. Возвращает False, если снимок уже снимается.
+        По окончании вызывает on_done(path, lines).
+        """
+        if not self.__snapshot_lock.acquire(blocking=False):
+            return False
+
+        threading.Thread(target=self.__take_memory_snapshot,
+                         args=(top, on_done),
+                         name='memory-snapshot',
+                         daemon=True).start()
+
+        return True
+
+    def __take_memory_snapshot(self, top, on_done):
+        try:
+            path, lines = self.memory_snapshot(top)
+        except Exception:
+            logger.exception('Снимок памяти не удался')
+            return
+        finally:
+            self.__snapshot_lock.release()
+
+        if on_done is not None:
+            try:
+                on_done(path, lines)
+            except Exception:
+                logger.exception('Не удалось отправить снимок памяти')
+
+    def memory_snapshot(self, top=15):
+        """
+        Снимает tracemalloc-снимок и сравнивает его с предыдущим.
+
+        Первый вызов только запускает tracemalloc: выделения памяти видны
+        начиная с него. Возвращает путь снимка и строки сравнения.
+        """
+        with self.__memory_lock:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start(self.frames)
+                self.__snapshot = None
+                logger.info('tracemalloc запущен')
+
+            snapshot = tracemalloc.take_snapshot()
+            path = self.__output_path('memory', 'tracemalloc')
+            snapshot.dump(path)
+
+            if self.__snapshot is None:
+                statistics = snapshot.statistics('lineno')
+            else:
+                statistics = snapshot.compare_to(self.__snapshot, 'lineno')
+            lines = [
+                f'{stat}'
+                for stat in statistics
+                if stat.traceback[0].filename not in IGNORED_FILES
+            ][:top]
+            self.__snapshot = snapshot
+
+        current, peak = tracemalloc.get_traced_memory()
+        lines.insert(0, 'Отслеживается {:.1f} МБ, пик {:.1f} МБ'.format(
+            current / 2 ** 20, peak / 2 ** 20))
+
+        return path, lines
+
+    def memory_stop(self):
+        """Останавливает tracemalloc и забывает снимки."""
+        with self.__memory_lock:
+            self.__snapshot = None
+            if tracemalloc.is_tracing():
+                tracemalloc.stop()
+                logger.info('tracemalloc остановлен')
+
+    def __output_path(self, kind, extension):
+        os.makedirs(self.output_dir, exist_ok=True)
+        now = time.time()
+        file_name = '{}-{}.{:03d}-{}.{}'.format(
+            kind,
+            time.strftime('%Y%m%d-%H%M%S', time.localtime(now)),
+            int(now * 1000) % 1000,
+            os.getpid(),
+            extension,
+        )
+
+        return os.path.join(self.output_dir, file_name)
+
+
+def get_profiler():
+    """Возвращает профилировщик, либо создаёт новый, если он ещё не создан."""
+    global _profiler
+    if _profiler is None:
+        env = Env()
+        env.read_env()
+
+        _profiler = Profiler(
+            output_dir=env.str('PROFILE_DIR', 'profiles'),
+            interval=env.float('PROFILE_INTERVAL', 0.005),
+        )
+
+    return _profiler
+
+
+def install_signal_handlers(profiler, seconds=30):
+    """
+    Профилирование по сигналам.
+
+    SIGUSR1 профилирует CPU seconds секунд, SIGUSR2 снимает снимок памяти
+    и пишет в лог отличия от предыдущего.
+    """
+    def on_cpu_signal(signum, frame):
+        if profiler.start_cpu(seconds) is None:
+            logger.warning('Профилирование CPU уже идёт')
+
+    def on_memory_signal(signum, frame):
+        if not profiler.start_memory_snapshot(on_done=log_memory_snapshot):
+            logger.warning('Снимок памяти уже снимается')
+
+    signal.signal(signal.SIGUSR1, on_cpu_signal)
+    signal.signal(signal.SIGUSR2, on_memory_signal)
+
+
+def log_memory_snapshot(path, lines):
+    """Пишет в лог сравнение снимка памяти с предыдущим."""
+    logger.info('Снимок памяти %s:\n%s', path, '\n'.join(lines))
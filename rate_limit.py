@@ -0,0 +1,62 @@
+import threading
+import time
+
+
+class TokenBucket():
+    """
+    Ограничитель частоты запросов «ведро с токенами».
+
+    Пропускает в среднем rate запросов в секунду и до burst запросов подряд.
+    """
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst or max(rate, 1)
+        self.acquired = 0
+        self.__tokens = self.burst
+        self.__updated_at = time.monotonic()
+        self.__lock = threading.Lock()
+
+    def __repr__(self):
+        return '<{} rate={}>'.format(self.__class__.__name__.upper(),
+                                     self.rate)
+
+    def reserve(self, tokens=1):
+        """Забирает токены и возвращает, сколько секунд нужно подождать."""
+        with self.__lock:
+            now = time.monotonic()
+            self.__tokens = min(
+                self.burst,
+                self.__tokens + (now - self.__updated_at) * self.rate
+            )
+            self.__updated_at = now
+            self.__tokens -= tokens
+            self.acquired += tokens
+
+            if self.__tokens >= 0:
+                return 0
+
+            return -self.__tokens / self.rate
+
+    def try_acquire(self, tokens=1):
+        """Забирает токены, только если их хватает прямо сейчас."""
+        with self.__lock:
+            now = time.monotonic()
+            self.__tokens = min(
+                self.burst,
+                self.__tokens + (now - self.__updated_at) * self.rate
+            )
+            self.__updated_at = now
+
+            if self.__tokens < tokens:
+                return False
+
+            self.__tokens -= tokens
+            self.acquired += tokens
+
+            return True
+
+    def acquire(self, tokens=1):
+        """Ждёт, пока можно выполнить запрос."""
+        if delay := self.reserve(tokens):
+            time.sleep(delay)
@@ -0,0 +1,175 @@
+import contextvars
+import email.utils
+import random
+import threading
+import time
+from contextlib import contextmanager
+
+import requests
+
+from rate_limit import TokenBucket
+
+# Момент (по time.monotonic), к которому нужно закончить обработку апдейта.
+_deadline = contextvars.ContextVar('deadline', default=None)
+
+# Методы, которые можно безопасно повторить после ошибки сервера.
+IDEMPOTENT_METHODS = {'GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE'}
+# Ответы, после которых запрос имеет смысл повторить.
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+
+class DeadlineExceeded(Exception):
+    """Время на обработку апдейта истекло."""
+
+
+@contextmanager
+def deadline(seconds):
+    """Ограничивает время на все запросы внутри блока with."""
+    token = _deadline.set(time.monotonic() + seconds)
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
+
+
+def time_remaining():
+    """Возвращает, сколько секунд осталось до дедлайна, или None."""
+    if (moment := _deadline.get()) is None:
+        return None
+
+    return moment - time.monotonic()
+
+
+def check_deadline():
+    """Возвращает оставшееся время, а если его нет — бросает исключение."""
+    remaining = time_remaining()
+    if remaining is not None and remaining <= 0:
+        raise DeadlineExceeded('Время на обработку запроса истекло')
+
+    return remaining
+
+
+def transient_errors():
+    """Возвращает классы сетевых ошибок, после которых запрос можно повторить."""
+    errors = (requests.ConnectionError, requests.Timeout)
+
+    try:
+        import httpx
+    except ImportError:
+        return errors
+
+    return errors + (httpx.TransportError,)
+
+
+def parse_retry_after(value):
+    """Разбирает заголовок Retry-After: число секунд или HTTP-дату."""
+    if not value:
+        return None
+
+    try:
+        return max(float(value), 0)
+    except ValueError:
+        pass
+
+    try:
+        retry_at = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+
+    return max(retry_at.timestamp() - time.time(), 0)
+
+
+def endpoint_name(method, path):
+    """Возвращает имя эндпоинта без id, например «GET /v2/carts»."""
+    parts = path.split('?')[0].strip('/').split('/')
+
+    return '{} /{}'.format(method, '/'.join(parts[:2]))
+
+
+class RetryPolicy():
+    """
+    Правила повтора запросов к API.
+
+    Повторяет идемпотентные запросы после сетевых ошибок и ответов 5xx,
+    а любые — после 429, с экспоненциальной задержкой со случайным
+    разбросом или через Retry-After. Повторы каждого эндпоинта ограничены
+    бюджетом retry_rate в секунду, чтобы при сбое сервиса не умножать
+    нагрузку, а задержка не может выйти за дедлайн апдейта. Одна попытка
+    длится не дольше attempt_timeout секунд.
+    """
+
+    def __init__(self,
+                 max_attempts=4,
+                 backoff_base=0.2,
+                 backoff_max=5,
+                 retry_rate=1,
+                 retry_burst=10,
+                 attempt_timeout=30):
+        self.max_attempts = max_attempts
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.retry_rate = retry_rate
+        self.retry_burst = retry_burst
+        self.attempt_timeout = attempt_timeout
+        self.__budgets = {}
+        self.__lock = threading.Lock()
+
+    def __repr__(self):
+        return '<{} attempts={}>'.format(self.__class__.__name__.upper(),
+                                         self.max_attempts)
+
+    def retry_delay(self,
+                    method,
+                    path,
+                    attempt,
+                    response=None,
+                    error=None,
+                    is_idempotent=None):
+        """
+        Возвращает, через сколько секунд повторить запрос, или None.
+
+        attempt — номер неудачной попытки, начиная с нуля. is_idempotent
+        задают для запросов, которые можно повторить, хотя их метод
+        не идемпотентный, например для запроса токена.
+        """
+        if attempt + 1 >= self.max_attempts:
+            return None
+
+        if is_idempotent is None:
+            is_idempotent = method in IDEMPOTENT_METHODS
+
+        if error is not None:
+            is_retryable = is_idempotent
+        else:
+            # На 429 сервер запрос не выполнял, поэтому его можно повторить.
+            is_retryable = response.status_code == 429 or (
+                response.status_code in RETRY_STATUSES and is_idempotent
+            )
+        if not is_retryable:
+            return None
+
+        delay = random.uniform(
+            0,
+            min(self.backoff_max, self.backoff_base * 2 ** attempt)
+        )
+        if response is not None:
+            retry_after = parse_retry_after(response.headers.get('Retry-After'))
+            if retry_after is not None:
+                delay = max(delay, retry_after)
+
+        remaining = time_remaining()
+        if remaining is not None and delay >= remaining:
+            return None
+
+        if not self.__budget(endpoint_name(method, path)).try_acquire():
+            return None
+
+        return delay
+
+    def __budget(self, endpoint):
+        with self.__lock:
+            if endpoint not in self.__budgets:
+                self.__budgets[endpoint] = TokenBucket(self.retry_rate,
+                                                       self.retry_burst)
+
+            return self.__budgets[endpoint]
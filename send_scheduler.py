@@ -0,0 +1,394 @@
+import contextvars
+import functools
+import heapq
+import itertools
+import logging
+import threading
+import time
+from concurrent.futures import (Future, InvalidStateError,
+                                ThreadPoolExecutor, TimeoutError)
+
+from telegram import Bot, Message, Update
+from telegram.error import RetryAfter
+
+from instrumentation import call_timer
+from metrics import SEND_QUEUE_DEPTH, SEND_QUEUE_LATENCY, SEND_RETRY_AFTER
+from rate_limit import TokenBucket
+from retry_policy import time_remaining
+from tracing import trace_span
+
+logger = logging.getLogger('pizza-shop')
+
+# Чем меньше число, тем раньше отправляется запрос.
+PRIORITY_URGENT = 0
+PRIORITY_REPLY = 1
+PRIORITY_CLEANUP = 2
+
+# Методы Bot, которые ходят в Bot API: у каждого есть имя в camelCase.
+API_METHODS = frozenset(
+    method.__name__
+    for name, method in vars(Bot).items()
+    if callable(method) and name != method.__name__ and not name.islower()
+)
+
+
+class _Job():
+    def __init__(self, priority, chat_id, func, args, kwargs, is_limited):
+        self.priority = priority
+        self.chat_id = chat_id
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.is_limited = is_limited
+        self.future = Future()
+        self.enqueued_at = time.monotonic()
+        self.attempts = 0
+        # Запрос выполняется в контексте апдейта, который его поставил.
+        self.context = contextvars.copy_context()
+
+
+class SendScheduler():
+    """
+    Очередь исходящих запросов к Telegram.
+
+    Отправляет не больше global_rate сообщений в секунду на всего бота,
+    chat_rate — в личный чат и group_rate — в группу. Из готовых к отправке
+    запросов первым уходит запрос с меньшим приоритетом, то есть ответы
+    пользователю идут раньше удаления старых сообщений. После RetryAfter
+    запрос откладывается в очереди, а не ждёт в потоке обработчика.
+    """
+
+    def __init__(self,
+                 global_rate=30,
+                 chat_rate=1,
+                 chat_burst=3,
+                 group_rate=20 / 60,
+                 group_burst=5,
+                 workers=8):
+        self.global_rate = global_rate
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.group_rate = group_rate
+        self.group_burst = group_burst
+        self.__global_bucket = TokenBucket(global_rate)
+        self.__chat_buckets = {}
+        self.__ready = []
+        self.__delayed = []
+        self.__sequence = itertools.count()
+        self.__condition = threading.Condition()
+        self.__pool = ThreadPoolExecutor(max_workers=workers,
+                                         thread_name_prefix='telegram-send')
+        self.__stopped = False
+        self.__thread = threading.Thread(target=self.__run,
+                                         name='send-scheduler',
+                                         daemon=True)
+        self.__thread.start()
+
+    def __repr__(self):
+        return '<{} rate={}>'.format(self.__class__.__name__.upper(),
+                                     self.global_rate)
+
+    def submit(self,
+               chat_id,
+               func,
+               args=(),
+               kwargs=None,
+               priority=PRIORITY_REPLY,
+               is_limited=True):
+        """
+        Ставит запрос в очередь и возвращает Future с его результатом.
+
+        Запросы с is_limited=False, например удаление сообщений и ответы
+        на нажатие кнопки, не расходуют лимит сообщений в чат. Запрос,
+        Future которого отменён, не отправляется, даже если уже получил
+        RetryAfter и ждёт в очереди.
+        """
+        job = _Job(priority, chat_id, func, args, kwargs or {}, is_limited)
+
+        with self.__condition:
+            if self.__stopped:
+                raise RuntimeError('Очередь отправки остановлена')
+
+            heapq.heappush(self.__ready,
+                           (priority, next(self.__sequence), job))
+            SEND_QUEUE_DEPTH.inc()
+            self.__condition.notify()
+
+        return job.future
+
+    def queue_depth(self):
+        """Возвращает число запросов в очереди."""
+        with self.__condition:
+            return len(self.__ready) + len(self.__delayed)
+
+    def stop(self, wait=True):
+        """Останавливает очередь, при wait=True отправив уже поставленное."""
+        with self.__condition:
+            if wait:
+                self.__condition.wait_for(
+                    lambda: not self.__ready and not self.__delayed)
+            self.__stopped = True
+            self.__condition.notify_all()
+
+        self.__thread.join()
+        self.__pool.shutdown(wait=wait)
+
+    def __run(self):
+        while True:
+            with self.__condition:
+                job = self.__next_job()
+                while job is None:
+                    if self.__stopped:
+                        return
+                    self.__condition.wait(self.__wait_time())
+                    job = self.__next_job()
+
+            # Общий лимит ждём в потоке очереди, не в потоке обработчика.
+            if delay := self.__global_bucket.reserve():
+                time.sleep(delay)
+
+            self.__pool.submit(self.__send, job)
+
+    def __next_job(self):
+        now = time.monotonic()
+        while self.__delayed and self.__delayed[0][0] <= now:
+            _, sequence, job = heapq.heappop(self.__delayed)
+            heapq.heappush(self.__ready, (job.priority, sequence, job))
+
+        # Чаты, исчерпавшие лимит, пропускаем, не меняя порядок их запросов.
+        skipped = []
+        selected = None
+        while self.__ready:
+            entry = heapq.heappop(self.__ready)
+            job = entry[2]
+
+            if job.future.cancelled():
+                SEND_QUEUE_DEPTH.dec()
+                continue
+
+            if not job.is_limited or self.__chat_bucket(
+                    job.chat_id).try_acquire():
+                selected = job
+                break
+
+            skipped.append(entry)
+
+        for entry in skipped:
+            heapq.heappush(self.__ready, entry)
+
+        if selected is not None:
+            SEND_QUEUE_DEPTH.dec()
+        if not self.__ready and not self.__delayed:
+            self.__condition.notify_all()
+
+        return selected
+
+    def __wait_time(self):
+        if self.__ready:
+            # Ждём, пока у какого-нибудь чата освободится лимит.
+            return 0.05
+        if self.__delayed:
+            return max(self.__delayed[0][0] - time.monotonic(), 0)
+
+        return None
+
+    def __chat_bucket(self, chat_id):
+        if (bucket := self.__chat_buckets.get(chat_id)) is None:
+            if len(self.__chat_buckets) > 10000:
+                self.__chat_buckets.clear()
+
+            if chat_id is not None and chat_id < 0:
+                bucket = TokenBucket(self.group_rate, self.group_burst)
+            else:
+                bucket = TokenBucket(self.chat_rate, self.chat_burst)
+            self.__chat_buckets[chat_id] = bucket
+
+        return bucket
+
+    def __send(self, job):
+        if job.future.cancelled():
+            logger.debug('Запрос %s в чат %s отменён',
+                         job.func.__name__, job.chat_id)
+            return
+
+        if job.attempts == 0:
+            SEND_QUEUE_LATENCY.observe(time.monotonic() - job.enqueued_at)
+        job.attempts += 1
+
+        try:
+            result = job.context.run(self.__request, job)
+        except RetryAfter as err:
+            SEND_RETRY_AFTER.inc()
+            logger.warning('Telegram просит подождать %s с (чат %s)',
+                           err.retry_after, job.chat_id)
+
+            if job.future.cancelled():
+                return
+
+            with self.__condition:
+                heapq.heappush(self.__delayed,
+                               (time.monotonic() + err.retry_after,
+                                next(self.__sequence),
+                                job))
+                SEND_QUEUE_DEPTH.inc()
+                self.__condition.notify()
+        except Exception as err:
+            set_future(job.future, job.future.set_exception, err)
+        else:
+            set_future(job.future, job.future.set_result, result)
+
+    @staticmethod
+    def __request(job):
+        with call_timer('telegram', job.func.__name__):
+            return job.func(*job.args, **job.kwargs)
+
+
+class ScheduledBot():
+    """
+    Bot, отправляющий сообщения через SendScheduler.
+
+    Методы, результат которых нужен обработчику, ждут его не дольше
+    дедлайна апдейта; если дождаться не вышло, запрос снимается с очереди,
+    чтобы повтор обработчика не отправил сообщение дважды. Удаление
+    сообщений ставится в очередь с низким приоритетом, не расходует лимит
+    чата и не ждётся. Остальные методы передаются Bot мимо очереди, но
+    их вызовы тоже замеряются.
+
+    У методов есть и имена в camelCase, которые вызывают сокращения
+    python-telegram-bot вроде CallbackQuery.answer(), а апдейты из
+    get_updates() и отправленные сообщения привязываются к ScheduledBot,
+    так что reply_text() и прочие сокращения тоже идут через очередь.
+    """
+
+    def __init__(self, bot, send_scheduler, timeout=30):
+        self.bot = bot
+        self.send_scheduler = send_scheduler
+        self.timeout = timeout
+
+    def __repr__(self):
+        return '<{}>'.format(self.__class__.__name__.upper())
+
+    def __getattr__(self, name):
+        attribute = getattr(self.bot, name)
+        if getattr(attribute, '__name__', None) not in API_METHODS:
+            return attribute
+
+        @functools.wraps(attribute)
+        def timed(*args, **kwargs):
+            with call_timer('telegram', attribute.__name__):
+                return attribute(*args, **kwargs)
+
+        return timed
+
+    def get_updates(self, *args, **kwargs):
+        """Получает апдейты, привязанные к ScheduledBot, а не к Bot."""
+        return [
+            Update.de_json(update.to_dict(), self)
+            for update in self.bot.get_updates(*args, **kwargs)
+        ]
+
+    def send_message(self, *args, **kwargs):
+        """Отправляет сообщение через очередь."""
+        return self.__call(self.bot.send_message, args, kwargs)
+
+    def send_photo(self, *args, **kwargs):
+        """Отправляет фотографию через очередь."""
+        return self.__call(self.bot.send_photo, args, kwargs)
+
+    def send_document(self, *args, **kwargs):
+        """Отправляет файл через очередь."""
+        return self.__call(self.bot.send_document, args, kwargs)
+
+    def edit_message_text(self, *args, **kwargs):
+        """Изменяет текст сообщения через очередь."""
+        return self.__call(self.bot.edit_message_text, args, kwargs)
+
+    def edit_message_media(self, *args, **kwargs):
+        """Заменяет фотографию сообщения через очередь."""
+        return self.__call(self.bot.edit_message_media, args, kwargs)
+
+    def edit_message_reply_markup(self, *args, **kwargs):
+        """Изменяет клавиатуру сообщения через очередь."""
+        return self.__call(self.bot.edit_message_reply_markup, args, kwargs)
+
+    def answer_callback_query(self, *args, **kwargs):
+        """Отвечает на нажатие кнопки вне очереди чата."""
+        return self.__call(self.bot.answer_callback_query, args, kwargs,
+                           priority=PRIORITY_URGENT,
+                           is_limited=False)
+
+    def delete_message(self, *args, **kwargs):
+        """Ставит удаление сообщения в очередь, не дожидаясь его."""
+        future = self.send_scheduler.submit(get_chat_id(args, kwargs),
+                                            self.bot.delete_message,
+                                            args,
+                                            kwargs,
+                                            priority=PRIORITY_CLEANUP,
+                                            is_limited=False)
+        future.add_done_callback(log_failure)
+
+        return True
+
+    # Имена, под которыми методы вызывают сокращения python-telegram-bot.
+    getUpdates = get_updates
+    sendMessage = send_message
+    sendPhoto = send_photo
+    sendDocument = send_document
+    editMessageText = edit_message_text
+    editMessageMedia = edit_message_media
+    editMessageReplyMarkup = edit_message_reply_markup
+    answerCallbackQuery = answer_callback_query
+    deleteMessage = delete_message
+
+    def __call(self, method, args, kwargs, priority=PRIORITY_REPLY,
+               is_limited=True):
+        # В трассе видно и ожидание в очереди, и сами попытки отправки.
+        with trace_span(f'send_queue {method.__name__}'):
+            future = self.send_scheduler.submit(get_chat_id(args, kwargs),
+                                                method,
+                                                args,
+                                                kwargs,
+                                                priority=priority,
+                                                is_limited=is_limited)
+
+            timeout = time_remaining()
+            if timeout is None:
+                timeout = self.timeout
+
+            try:
+                result = future.result(timeout=max(timeout, 0))
+            except TimeoutError:
+                # Запрос, который ещё не ушёл, больше не отправится.
+                future.cancel()
+                raise
+
+        if isinstance(result, Message):
+            # Сокращения вроде message.edit_text() тоже идут через очередь.
+            return Message.de_json(result.to_dict(), self)
+
+        return result
+
+
+def get_chat_id(args, kwargs):
+    """Возвращает id чата из аргументов метода Bot, если он там есть."""
+    chat_id = kwargs.get('chat_id', args[0] if args else None)
+
+    return chat_id if isinstance(chat_id, int) else None
+
+
+def set_future(future, setter, value):
+    """Передаёт результат в Future, если его не отменили."""
+    try:
+        setter(value)
+    except InvalidStateError:
+        # Отменили, пока запрос выполнялся: результат никто не ждёт.
+        pass
+
+
+def log_failure(future):
+    """Пишет в лог ошибку запроса, результат которого никто не ждёт."""
+    if future.cancelled():
+        return
+
+    if err := future.exception():
+        logger.debug('Запрос к Telegram не выполнен: %s', err)
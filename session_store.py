@@ -0,0 +1,152 @@
+from environs import Env
+
+from database import get_database_connection
+
+_session_store = None
+
+
+class Session(dict):
+    """
+    Состояние и небольшой контекст чата.
+
+    Запоминает изменённые поля, чтобы при сохранении писать только их.
+    """
+
+    def __init__(self, chat_id, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.chat_id = chat_id
+        self.changed = set()
+        self.is_legacy = False
+
+    def __setitem__(self, name, value):
+        super().__setitem__(name, value)
+        self.changed.add(name)
+
+    def __delitem__(self, name):
+        super().__delitem__(name)
+        self.changed.add(name)
+
+    @property
+    def state(self):
+        return self.get('state')
+
+    @state.setter
+    def state(self, value):
+        self['state'] = value
+
+
+class SessionStore():
+    """
+    Хранит сессии чатов в Redis, по одному хэшу на чат.
+
+    Чтение и запись выполняются одним конвейером (pipeline) вместе
+    с продлением срока жизни ключа, так что сессия неактивного чата
+    удаляется сама.
+    """
+
+    KEY = 'session:{}'
+    # Короткие имена полей в Redis.
+    FIELDS = {
+        'state': 's',
+        'product_id': 'p',
+        'message_id': 'm',
+        'location': 'l',
+        'menu_page': 'n',
+    }
+
+    def __init__(self, redis_db, ttl=30 * 24 * 60 * 60):
+        self.ttl = ttl
+        self.__redis_db = redis_db
+        self.__names = {field: name for name, field in self.FIELDS.items()}
+
+    def __repr__(self):
+        return '<{}>'.format(self.__class__.__name__.upper())
+
+    def load(self, chat_id):
+        """Читает сессию чата за один запрос к Redis."""
+        key = self.KEY.format(chat_id)
+
+        pipeline = self.__redis_db.pipeline(transaction=False)
+        pipeline.hgetall(key)
+        pipeline.expire(key, self.ttl)
+        # Состояние в старом формате хранилось строкой под id чата.
+        pipeline.get(chat_id)
+        fields, _, legacy_state = pipeline.execute()
+
+        data = {}
+        for field, value in fields.items():
+            if name := self.__names.get(field.decode('utf-8')):
+                data[name] = decode(name, value)
+
+        session = Session(chat_id, data)
+
+        if 'state' not in session and legacy_state:
+            session.state = legacy_state.decode('utf-8')
+            session.is_legacy = True
+
+        return session
+
+    def save(self, session):
+        """Записывает изменённые поля сессии за один запрос к Redis."""
+        key = self.KEY.format(session.chat_id)
+
+        changed = {
+            self.FIELDS[name]: encode(name, session[name])
+            for name in session.changed
+            if name in session and session[name] is not None
+        }
+        removed = [
+            self.FIELDS[name]
+            for name in session.changed
+            if name not in session or session[name] is None
+        ]
+
+        pipeline = self.__redis_db.pipeline(transaction=False)
+        if changed:
+            pipeline.hset(key, mapping=changed)
+        if removed:
+            pipeline.hdel(key, *removed)
+        pipeline.expire(key, self.ttl)
+        if session.is_legacy:
+            pipeline.delete(session.chat_id)
+        pipeline.execute()
+
+        session.is_legacy = False
+
+        session.changed.clear()
+
+
+def get_session_store():
+    """Возвращает хранилище сессий, либо создаёт новое, если оно ещё не создано."""
+    global _session_store
+    if _session_store is None:
+        env = Env()
+        env.read_env()
+
+        _session_store = SessionStore(
+            get_database_connection(),
+            ttl=env.int('SESSION_TTL', 30 * 24 * 60 * 60),
+        )
+
+    return _session_store
+
+
+def encode(name, value):
+    """Кодирует значение поля сессии в строку."""
+    if name == 'location':
+        return '{:.5f},{:.5f}'.format(*value)
+
+    return str(value)
+
+
+def decode(name, value):
+    """Декодирует значение поля сессии."""
+    value = value.decode('utf-8')
+
+    if name == 'location':
+        lat, lon = value.split(',')
+        return float(lat), float(lon)
+    if name in ('message_id', 'menu_page'):
+        return int(value)
+
+    return value
@@ -0,0 +1,51 @@
+import threading
+
+
+class _Call():
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight():
+    """
+    Объединяет одновременные вызовы с одинаковым ключом.
+
+    Первый вызов выполняет функцию, остальные ждут и получают его результат
+    или его исключение.
+    """
+
+    def __init__(self):
+        self.__calls = {}
+        self.__lock = threading.Lock()
+
+    def __repr__(self):
+        return '<{}>'.format(self.__class__.__name__.upper())
+
+    def do(self, key, func):
+        """Выполняет func или дожидается уже идущего вызова с тем же ключом."""
+        with self.__lock:
+            call = self.__calls.get(key)
+            is_leader = call is None
+            if is_leader:
+                call = self.__calls[key] = _Call()
+
+        if not is_leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+
+            return call.result
+
+        try:
+            call.result = func()
+        except Exception as err:
+            call.error = err
+            raise
+        finally:
+            with self.__lock:
+                del self.__calls[key]
+            call.done.set()
+
+        return call.result
@@ -0,0 +1,38 @@
+import time
+
+import fakeredis
+import pytest
+
+from benchmarks.fakes import FakeMoltin
+from moltin_api import Moltin
+
+
+@pytest.fixture
+def redis_db():
+    """Redis в памяти процесса, с поддержкой Lua-скриптов."""
+    return fakeredis.FakeRedis()
+
+
+@pytest.fixture
+def fake_moltin():
+    """Поддельный Moltin с одним товаром."""
+    fake = FakeMoltin().start()
+    fake.add_product('Пицца', 'Описание', 50000, 'RUB')
+
+    yield fake
+
+    fake.stop()
+
+
+@pytest.fixture
+def moltin_api(fake_moltin):
+    """Клиент Moltin, который ходит в поддельный Moltin."""
+    return Moltin('client-id', api_url=fake_moltin.url)
+
+
+def wait_for(condition, timeout=5):
+    """Ждёт, пока condition() не станет истинным."""
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, 'не дождались'
+        time.sleep(0.01)
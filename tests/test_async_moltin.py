@@ -0,0 +1,61 @@
+import asyncio
+import logging
+
+from catalog_cache import CatalogCache
+from moltin_api import AsyncMoltin
+from retry_policy import RetryPolicy
+
+GET_PRODUCTS = 'GET /v2/products'
+
+
+def make_moltin_api(fake_moltin, ttl=300):
+    return AsyncMoltin('client-id',
+                       catalog_cache=CatalogCache(ttl=ttl),
+                       retry_policy=RetryPolicy(max_attempts=1),
+                       api_url=fake_moltin.url)
+
+
+def test_concurrent_cold_reads_load_catalog_once(fake_moltin):
+    async def read_catalog():
+        moltin_api = make_moltin_api(fake_moltin)
+        try:
+            return await asyncio.gather(
+                *(moltin_api.get_products() for _ in range(5)))
+        finally:
+            await moltin_api.close()
+
+    catalogs = asyncio.run(read_catalog())
+
+    assert [len(products) for products in catalogs] == [1] * 5
+    assert fake_moltin.calls[GET_PRODUCTS] == 1
+
+
+def test_failed_background_refresh_is_logged(fake_moltin, caplog):
+    async def read_catalog():
+        moltin_api = make_moltin_api(fake_moltin, ttl=0.05)
+        try:
+            products = await moltin_api.get_products()
+            await asyncio.sleep(0.1)
+
+            fake_moltin.error_rate = 1
+            stale_products = await moltin_api.get_products()
+            # Даём фоновому обновлению завершиться.
+            await asyncio.sleep(0.2)
+
+            fake_moltin.error_rate = 0
+            await moltin_api.get_products()
+            await asyncio.sleep(0.2)
+
+            return (products, stale_products,
+                    moltin_api.catalog_cache.peek('products'))
+        finally:
+            await moltin_api.close()
+
+    with caplog.at_level(logging.WARNING, logger='pizza-shop'):
+        products, stale_products, refreshed = asyncio.run(read_catalog())
+
+    assert stale_products == products
+    assert refreshed == products
+    assert fake_moltin.calls[GET_PRODUCTS] == 3
+    assert [record.getMessage().startswith('Не удалось обновить products')
+            for record in caplog.records] == [True]
@@ -0,0 +1,87 @@
+import json
+
+import pytest
+
+from cart_mirror import CartMirror, get_cart_cost
+
+GET_CART_ITEMS = 'GET /v2/carts/{id}/items'
+
+
+@pytest.fixture
+def cart_mirror(redis_db):
+    return CartMirror(redis_db, reconcile_interval=300)
+
+
+@pytest.fixture
+def product_id(fake_moltin):
+    return next(iter(fake_moltin.products))
+
+
+def test_changes_are_written_through(fake_moltin, moltin_api, cart_mirror,
+                                     product_id):
+    cart_mirror.ensure_cart(moltin_api, 'chat-1')
+    calls = fake_moltin.calls[GET_CART_ITEMS]
+
+    items = cart_mirror.add_item(moltin_api, 'chat-1', product_id, 2)
+    cart = cart_mirror.get_cart(moltin_api, 'chat-1')
+
+    assert cart['items'] == items
+    assert [(item['name'], item['quantity']) for item in items] == [
+        ('Пицца', 2),
+    ]
+    assert get_cart_cost(moltin_api, cart) == '1,000.00 RUB'
+    assert fake_moltin.calls[GET_CART_ITEMS] == calls
+
+    cart_mirror.remove_item(moltin_api, 'chat-1', items[0]['id'])
+
+    assert cart_mirror.get_cart(moltin_api, 'chat-1')['items'] == []
+    assert fake_moltin.carts['chat-1'] == []
+    assert fake_moltin.calls[GET_CART_ITEMS] == calls
+
+
+def test_ensure_cart_creates_cart_once(fake_moltin, moltin_api,
+                                       cart_mirror):
+    cart_mirror.ensure_cart(moltin_api, 'chat-1')
+    cart_mirror.ensure_cart(moltin_api, 'chat-1')
+
+    assert 'chat-1' in fake_moltin.carts
+    assert fake_moltin.calls[GET_CART_ITEMS] == 1
+
+
+def test_missing_or_old_copy_is_reconciled(redis_db, fake_moltin,
+                                           moltin_api, cart_mirror,
+                                           product_id):
+    fake_moltin.carts['chat-1'] = []
+    moltin_api.add_cart_item('chat-1', product_id)
+
+    # Копии нет: корзина читается из Moltin.
+    assert len(cart_mirror.get_cart(moltin_api, 'chat-1')['items']) == 1
+    assert fake_moltin.calls[GET_CART_ITEMS] == 1
+
+    # Копия старше reconcile_interval: корзина перечитывается.
+    cart = json.loads(redis_db.get('cart:chat-1'))
+    cart['synced_at'] -= 301
+    redis_db.set('cart:chat-1', json.dumps(cart))
+    moltin_api.add_cart_item('chat-1', product_id)
+
+    items = cart_mirror.get_cart(moltin_api, 'chat-1')['items']
+
+    assert items[0]['quantity'] == 2
+    assert fake_moltin.calls[GET_CART_ITEMS] == 2
+
+
+def test_cost_without_moltin_total_uses_catalog_prices(fake_moltin,
+                                                       moltin_api,
+                                                       product_id):
+    cart = {
+        'items': [
+            {'product_id': product_id, 'quantity': 2,
+             'unit_price': {'amount': 1, 'currency': 'RUB'}},
+            {'product_id': 'removed', 'quantity': 1,
+             'unit_price': {'amount': 30000, 'currency': 'RUB'}},
+        ],
+        'cost': None,
+    }
+
+    assert get_cart_cost(moltin_api, cart) == '1300.0 RUB'
+    assert fake_moltin.calls['GET /v2/products'] == 1
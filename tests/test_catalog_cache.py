@@ -0,0 +1,103 @@
+import threading
+import time
+
+from catalog_cache import CatalogCache
+from conftest import wait_for
+
+
+class Loader():
+    """Загружает номер вызова и считает вызовы."""
+
+    def __init__(self, delay=0.0):
+        self.delay = delay
+        self.calls = 0
+        self.__lock = threading.Lock()
+
+    def __call__(self):
+        time.sleep(self.delay)
+        with self.__lock:
+            self.calls += 1
+
+            return self.calls
+
+
+def test_cold_miss_loads_once_for_concurrent_callers():
+    catalog_cache = CatalogCache()
+    loader = Loader(delay=0.1)
+    values = []
+
+    threads = [
+        threading.Thread(
+            target=lambda: values.append(catalog_cache.get('products',
+                                                           loader)))
+        for _ in range(8)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert loader.calls == 1
+    assert values == [1] * 8
+
+
+def test_stale_value_is_served_while_refreshing():
+    catalog_cache = CatalogCache(ttl=0.05)
+    loader = Loader(delay=0.1)
+    catalog_cache.get('products', loader)
+    time.sleep(0.06)
+
+    assert catalog_cache.get('products', loader) == 1
+    assert catalog_cache.get('products', loader) == 1
+
+    wait_for(lambda: catalog_cache.peek('products') == 2)
+    assert loader.calls == 2
+
+
+def test_cold_miss_waits_for_background_refresh():
+    catalog_cache = CatalogCache(ttl=0.05)
+    loader = Loader(delay=0.1)
+    catalog_cache.get('products', loader)
+    time.sleep(0.06)
+    catalog_cache.get('products', loader)
+
+    catalog_cache.invalidate('products')
+
+    assert catalog_cache.get('products', loader) == 2
+    assert loader.calls == 2
+
+
+def test_invalidate_drops_entries():
+    catalog_cache = CatalogCache()
+    catalog_cache.set('products', [])
+    catalog_cache.set('product:1', {})
+
+    catalog_cache.invalidate('product:1')
+
+    assert catalog_cache.lookup('product:1') == (False, None, False)
+    assert catalog_cache.lookup('products') == (True, [], False)
+
+    catalog_cache.invalidate()
+
+    assert catalog_cache.lookup('products') == (False, None, False)
+
+
+def test_invalidate_reaches_other_processes(redis_db):
+    loader = Loader()
+    bot_cache = CatalogCache(redis_db=redis_db, version_check_interval=0)
+    loader_cache = CatalogCache(redis_db=redis_db, version_check_interval=0)
+    bot_cache.get('products', loader)
+
+    loader_cache.invalidate()
+
+    assert bot_cache.get('products', loader) == 2
+
+
+def test_unchanged_remote_version_keeps_entries(redis_db):
+    loader = Loader()
+    bot_cache = CatalogCache(redis_db=redis_db, version_check_interval=0)
+    CatalogCache(redis_db=redis_db).invalidate()
+    bot_cache.get('products', loader)
+
+    assert bot_cache.get('products', loader) == 1
+    assert loader.calls == 1
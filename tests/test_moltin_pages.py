@@ -0,0 +1,85 @@
+import time
+
+import pytest
+import requests
+
+from benchmarks.fakes import FakeMoltin
+from moltin_api import Moltin, next_page
+from retry_policy import DeadlineExceeded, deadline
+
+GET_PRODUCTS = 'GET /v2/products'
+
+
+@pytest.fixture
+def slow_moltin():
+    fake = FakeMoltin(latency=0.2).start()
+    for number in range(250):
+        fake.add_product(f'Пицца {number}', 'Описание', 50000)
+
+    yield fake
+
+    fake.stop()
+
+
+@pytest.fixture
+def slow_moltin_api(slow_moltin):
+    moltin_api = Moltin('client-id', api_url=slow_moltin.url)
+    moltin_api.get_access_token()
+
+    return moltin_api
+
+
+def test_pages_follow_next_links(slow_moltin, slow_moltin_api):
+    pages = list(slow_moltin_api.iter_pages('/v2/products', page_size=100))
+
+    assert [len(page) for page in pages] == [100, 100, 50]
+    assert [product['id'] for page in pages for product in page] \
+        == list(slow_moltin.products)
+    assert slow_moltin.calls[GET_PRODUCTS] == 3
+
+
+def test_next_page_is_fetched_while_current_is_processed(slow_moltin_api):
+    started_at = time.monotonic()
+    for _ in slow_moltin_api.iter_pages('/v2/products', page_size=100):
+        time.sleep(0.2)
+    elapsed = time.monotonic() - started_at
+
+    # Без упреждающей загрузки: 3 × (0.2 на запрос + 0.2 на обработку).
+    assert elapsed < 1.05
+
+
+def test_only_one_page_is_fetched_ahead(slow_moltin, slow_moltin_api):
+    pages = slow_moltin_api.iter_pages('/v2/products', page_size=100)
+    next(pages)
+    time.sleep(0.5)
+
+    assert slow_moltin.calls[GET_PRODUCTS] == 2
+
+    pages.close()
+
+
+def test_prefetch_keeps_the_deadline(slow_moltin_api):
+    with deadline(0.3):
+        pages = slow_moltin_api.iter_pages('/v2/products', page_size=100)
+        next(pages)
+
+        with pytest.raises((DeadlineExceeded, requests.Timeout)):
+            next(pages)
+
+
+def test_next_page_without_links_uses_meta():
+    page = {
+        'data': [{}],
+        'meta': {'page': {'current': 1, 'total': 2, 'limit': 10,
+                          'offset': 0}},
+    }
+
+    assert next_page('/v2/files', page) == (
+        '/v2/files', {'page[limit]': 10, 'page[offset]': 10},
+    )
+    assert next_page('/v2/files', {'data': []}) is None
+    assert next_page('/v2/files', {
+        'data': [{}],
+        'links': {'current': '/v2/files?page[offset]=0',
+                  'next': '/v2/files?page[offset]=0'},
+    }) is None
@@ -0,0 +1,198 @@
+import pytest
+
+from benchmarks.fakes import FakeMoltin
+from load_data_to_moltin import get_address_fields
+from moltin_api import Moltin
+from moltin_sync import (AddressSync, Checkpoint, MenuSync, plan_changes,
+                         record_hash)
+
+
+def make_menu_item(name, price, image_url):
+    return {
+        'name': name,
+        'description': f'Описание {name}',
+        'price': price,
+        'product_image': {'url': image_url},
+    }
+
+
+def make_address(alias, lat=55.75, lon=37.62):
+    return {
+        'alias': alias,
+        'address': {'full': f'Москва, {alias}'},
+        'coordinates': {'lat': str(lat), 'lon': str(lon)},
+    }
+
+
+MENU = [
+    make_menu_item('Маргарита', 40000, 'https://example.com/margherita.jpg'),
+    make_menu_item('Пепперони', 50000, 'https://example.com/pepperoni.jpg'),
+]
+
+
+class FlakyMoltin(Moltin):
+    """Moltin, у которого первая привязка изображения к товару падает."""
+
+    failures = 1
+
+    def add_file_to_product(self, product_id, file_id):
+        if self.failures:
+            self.failures -= 1
+            raise ConnectionError('Moltin недоступен')
+
+        return super().add_file_to_product(product_id, file_id)
+
+
+@pytest.fixture
+def empty_moltin():
+    fake = FakeMoltin().start()
+    fake.add_flow('Pizzeria')
+
+    yield fake
+
+    fake.stop()
+
+
+@pytest.fixture
+def checkpoint(tmp_path):
+    return Checkpoint(str(tmp_path / 'sync.json'))
+
+
+def sync_menu(moltin_api, checkpoint, menu_items):
+    menu_sync = MenuSync(moltin_api, checkpoint)
+    for step in menu_sync.plan(menu_items):
+        menu_sync.apply(step)
+
+    return menu_sync
+
+
+def sync_addresses(moltin_api, checkpoint, addresses):
+    address_sync = AddressSync(moltin_api, checkpoint)
+    for step in address_sync.plan(addresses, get_address_fields):
+        address_sync.apply(step)
+
+    return address_sync
+
+
+def test_plan_compares_hashes():
+    local = {'a': {'price': 1}, 'b': {'price': 2}, 'c': {'price': 3}}
+    remote = {
+        'a': {'id': 'id-a', 'record': {'price': 1}},
+        'b': {'id': 'id-b', 'record': {'price': 5}},
+        'd': {'id': 'id-d', 'record': {'price': 4}},
+    }
+
+    assert plan_changes(local, remote, ['id-a2']) == (
+        ['c'], ['b'], ['id-d', 'id-a2'],
+    )
+    assert record_hash({'a': 1, 'b': 2}) == record_hash({'b': 2, 'a': 1})
+
+
+def test_menu_sync_touches_only_changed_products(empty_moltin, checkpoint):
+    moltin_api = Moltin('client-id', api_url=empty_moltin.url)
+
+    created = sync_menu(moltin_api, checkpoint, MENU)
+    product_ids = set(empty_moltin.products)
+
+    assert created.changed
+    assert len(product_ids) == 2
+    assert len(empty_moltin.files) == 2
+
+    unchanged = sync_menu(moltin_api, checkpoint, MENU)
+
+    assert not unchanged.changed
+    assert empty_moltin.calls['PUT /v2/products/{id}'] == 0
+
+    menu = [
+        make_menu_item('Маргарита', 45000,
+                       'https://example.com/margherita.jpg'),
+        make_menu_item('Пепперони', 50000,
+                       'https://example.com/pepperoni-new.jpg'),
+    ]
+    updated = sync_menu(moltin_api, checkpoint, menu)
+    prices = {product['name']: product['price'][0]['amount']
+              for product in empty_moltin.products.values()}
+    pepperoni_id = next(product['id']
+                        for product in empty_moltin.products.values()
+                        if product['name'] == 'Пепперони')
+
+    assert set(empty_moltin.products) == product_ids
+    assert prices == {'Маргарита': 45000, 'Пепперони': 50000}
+    assert empty_moltin.calls['PUT /v2/products/{id}'] == 1
+    assert updated.changed_photos == {pepperoni_id}
+
+
+def test_menu_sync_deletes_removed_and_duplicate_products(empty_moltin,
+                                                         checkpoint):
+    moltin_api = Moltin('client-id', api_url=empty_moltin.url)
+    sync_menu(moltin_api, checkpoint, MENU)
+    duplicate = empty_moltin.add_product('Маргарита', 'Копия', 40000)
+
+    deleted = sync_menu(moltin_api, checkpoint, MENU[:1])
+
+    assert [product['name'] for product in empty_moltin.products.values()] \
+        == ['Маргарита']
+    assert duplicate['id'] not in empty_moltin.products
+    assert len(deleted.changed_photos) == 2
+
+
+def test_interrupted_menu_sync_resumes_from_checkpoint(empty_moltin,
+                                                       tmp_path):
+    path = str(tmp_path / 'sync.json')
+    moltin_api = FlakyMoltin('client-id', api_url=empty_moltin.url)
+
+    with pytest.raises(ConnectionError):
+        sync_menu(moltin_api, Checkpoint(path), MENU[:1])
+
+    # Загруженный файл не загружается повторно после перезапуска.
+    resumed = sync_menu(moltin_api, Checkpoint(path), MENU[:1])
+    product = next(iter(empty_moltin.products.values()))
+
+    assert resumed.changed
+    assert len(empty_moltin.products) == 1
+    assert len(empty_moltin.files) == 1
+    assert product['relationships']['main_image']['data']['id'] \
+        == next(iter(empty_moltin.files))
+
+
+def test_done_steps_are_skipped_after_restart(empty_moltin, tmp_path):
+    path = str(tmp_path / 'sync.json')
+    moltin_api = Moltin('client-id', api_url=empty_moltin.url)
+    menu_sync = MenuSync(moltin_api, Checkpoint(path))
+    steps = menu_sync.plan(MENU)
+    menu_sync.apply(steps[0])
+
+    restarted = MenuSync(moltin_api, Checkpoint(path))
+    restarted.plan(MENU)
+    restarted.apply(steps[0])
+
+    assert len(empty_moltin.products) == 1
+    assert restarted.changed
+
+    Checkpoint(path).remove()
+    assert not tmp_path.joinpath('sync.json').exists()
+
+
+def test_address_sync_creates_updates_and_deletes(empty_moltin,
+                                                  checkpoint):
+    moltin_api = Moltin('client-id', api_url=empty_moltin.url)
+    sync_addresses(moltin_api, checkpoint,
+                   [make_address('center'), make_address('north')])
+    empty_moltin.add_entry('pizzeria', get_address_fields(
+        make_address('center')))
+
+    address_sync = sync_addresses(
+        moltin_api, checkpoint,
+        [make_address('center', lat=55.76), make_address('south')],
+    )
+    entries = empty_moltin.entries['pizzeria'].values()
+
+    assert address_sync.changed
+    assert sorted((entry['alias'], entry['latitude'])
+                  for entry in entries) == [
+        ('center', 55.76), ('south', 55.75),
+    ]
+    assert not sync_addresses(
+        moltin_api, checkpoint,
+        [make_address('center', lat=55.76), make_address('south')],
+    ).changed
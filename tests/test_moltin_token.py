@@ -0,0 +1,104 @@
+import threading
+import time
+
+from conftest import wait_for
+from moltin_api import Moltin
+from moltin_token import TokenManager
+
+
+class TokenSource():
+    """Выдаёт токены с заданным сроком жизни и считает запросы."""
+
+    def __init__(self, expires_in=3600, delay=0.0):
+        self.expires_in = expires_in
+        self.delay = delay
+        self.fetched = 0
+        self.__lock = threading.Lock()
+
+    def __call__(self):
+        time.sleep(self.delay)
+        with self.__lock:
+            self.fetched += 1
+            number = self.fetched
+
+        return {
+            'access_token': f'token-{number}',
+            'expires_in': self.expires_in,
+            'expires': time.time() + self.expires_in,
+        }
+
+
+def test_concurrent_gets_fetch_one_token():
+    source = TokenSource(delay=0.1)
+    token_manager = TokenManager(source)
+    tokens = []
+
+    threads = [
+        threading.Thread(target=lambda: tokens.append(token_manager.get()))
+        for _ in range(10)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert source.fetched == 1
+    assert {token['access_token'] for token in tokens} == {'token-1'}
+
+
+def test_token_is_refreshed_in_background_before_expiry():
+    source = TokenSource(expires_in=1)
+    token_manager = TokenManager(source, refresh_margin=60)
+
+    assert token_manager.get()['access_token'] == 'token-1'
+
+    # Обновление запланировано на середину срока, токен не истекает.
+    wait_for(lambda: source.fetched == 2)
+    assert token_manager.current()['access_token'] == 'token-2'
+
+
+def test_invalidate_keeps_newer_token():
+    source = TokenSource()
+    token_manager = TokenManager(source)
+    old_token = token_manager.get()
+
+    token_manager.invalidate()
+    new_token = token_manager.get()
+    token_manager.invalidate(old_token)
+
+    assert new_token['access_token'] == 'token-2'
+    assert token_manager.current() is new_token
+
+
+def test_processes_share_token_through_redis(redis_db):
+    source = TokenSource()
+    first = TokenManager(source, redis_db=redis_db, namespace='client')
+    second = TokenManager(source, redis_db=redis_db, namespace='client')
+
+    assert first.get()['access_token'] == second.get()['access_token']
+    assert source.fetched == 1
+
+
+def test_invalidate_drops_shared_token(redis_db):
+    source = TokenSource()
+    first = TokenManager(source, redis_db=redis_db, namespace='client')
+    second = TokenManager(source, redis_db=redis_db, namespace='client')
+    first.get()
+
+    first.invalidate()
+
+    assert second.get()['access_token'] == 'token-2'
+
+
+def test_moltin_requests_share_one_token(fake_moltin):
+    moltin_api = Moltin('client-id', api_url=fake_moltin.url)
+    threads = [
+        threading.Thread(target=moltin_api.fetch_products) for _ in range(5)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert fake_moltin.calls['GET /v2/products'] == 5
+    assert fake_moltin.calls['POST /oauth/access_token'] == 1
@@ -0,0 +1,97 @@
+import math
+import random
+
+import pytest
+from geopy.distance import great_circle
+
+from pizzeria_index import PizzeriaIndex, chord_to_km, to_unit_vector
+
+
+def random_pizzerias(count, seed):
+    generator = random.Random(seed)
+    pizzerias = []
+    for number in range(count):
+        if number % 2:
+            # Половина пиццерий — в Москве, где они стоят плотно.
+            latitude = generator.uniform(55.5, 56.0)
+            longitude = generator.uniform(37.3, 37.9)
+        else:
+            latitude = generator.uniform(-90, 90)
+            longitude = generator.uniform(-180, 180)
+        pizzerias.append({'id': str(number),
+                          'latitude': latitude,
+                          'longitude': longitude})
+
+    return pizzerias
+
+
+def distance_km(coords, pizzeria):
+    return chord_to_km(math.dist(
+        to_unit_vector(coords),
+        to_unit_vector((pizzeria['latitude'], pizzeria['longitude'])),
+    ))
+
+
+def brute_force(coords, pizzerias):
+    return sorted((distance_km(coords, pizzeria), pizzeria['id'])
+                  for pizzeria in pizzerias)
+
+
+def as_ids(found):
+    return [pizzeria['id'] for _, pizzeria in found]
+
+
+TARGETS = [
+    (55.75, 37.62),
+    (55.9, 37.4),
+    (0, 0),
+    (89.9, 10),
+    (-33.9, 179.9),
+    (-33.9, -179.9),
+]
+
+
+@pytest.mark.parametrize('seed', range(5))
+@pytest.mark.parametrize('coords', TARGETS)
+def test_nearest_matches_brute_force(seed, coords):
+    pizzerias = random_pizzerias(300, seed)
+    pizzeria_index = PizzeriaIndex(pizzerias)
+    expected = brute_force(coords, pizzerias)
+
+    for k in (1, 5, 300, 400):
+        found = pizzeria_index.nearest(coords, k)
+
+        assert as_ids(found) == [id_ for _, id_ in expected[:k]]
+        assert [distance for distance, _ in found] == [
+            round(distance, 2) for distance, _ in expected[:k]
+        ]
+
+
+@pytest.mark.parametrize('seed', range(5))
+@pytest.mark.parametrize('coords', TARGETS)
+@pytest.mark.parametrize('radius_km', [0, 1, 5, 50, 3000, 25000])
+def test_within_radius_matches_brute_force(seed, coords, radius_km):
+    pizzerias = random_pizzerias(300, seed)
+    pizzeria_index = PizzeriaIndex(pizzerias)
+    expected = [id_ for distance, id_ in brute_force(coords, pizzerias)
+                if distance <= radius_km]
+
+    assert as_ids(pizzeria_index.within_radius(coords, radius_km)) == expected
+
+
+def test_distances_are_great_circle_km():
+    pizzerias = random_pizzerias(50, seed=0)
+    pizzeria_index = PizzeriaIndex(pizzerias)
+    coords = (55.75, 37.62)
+
+    for distance, pizzeria in pizzeria_index.nearest(coords, k=50):
+        expected = great_circle(
+            coords, (pizzeria['latitude'], pizzeria['longitude'])).km
+        assert distance == pytest.approx(expected, abs=0.01)
+
+
+def test_empty_index_finds_nothing():
+    pizzeria_index = PizzeriaIndex([])
+
+    assert pizzeria_index.nearest((55.75, 37.62)) == []
+    assert pizzeria_index.within_radius((55.75, 37.62), 100) == []
@@ -0,0 +1,43 @@
+import os
+import threading
+
+import pytest
+
+from profiling import Profiler
+
+
+@pytest.fixture
+def profiler(tmp_path):
+    profiler = Profiler(output_dir=str(tmp_path))
+
+    yield profiler
+
+    profiler.memory_stop()
+
+
+def test_memory_snapshot_is_taken_in_background(profiler):
+    snapshots = []
+    done = threading.Event()
+
+    def on_done(path, lines):
+        snapshots.append((path, lines, threading.current_thread().name))
+        done.set()
+
+    assert profiler.start_memory_snapshot(on_done=on_done)
+    assert not profiler.start_memory_snapshot(on_done=on_done)
+    assert done.wait(30)
+
+    path, lines, thread_name = snapshots[0]
+    assert os.path.exists(path)
+    assert lines[0].startswith('Отслеживается')
+    assert thread_name == 'memory-snapshot'
+
+
+def test_second_snapshot_is_compared_with_first(profiler):
+    profiler.memory_snapshot()
+    allocated = [bytearray(1024) for _ in range(1000)]
+
+    path, lines = profiler.memory_snapshot(top=5)
+
+    assert allocated
+    assert any('test_profiling.py' in line for line in lines[1:])
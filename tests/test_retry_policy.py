@@ -0,0 +1,167 @@
+import email.utils
+import time
+
+import pytest
+import requests
+
+from benchmarks.fakes import FakeMoltin
+from moltin_api import Moltin
+from retry_policy import (DeadlineExceeded, RetryPolicy, deadline,
+                          endpoint_name, parse_retry_after)
+
+
+def make_response(status_code, retry_after=None):
+    response = requests.Response()
+    response.status_code = status_code
+    if retry_after is not None:
+        response.headers['Retry-After'] = retry_after
+
+    return response
+
+
+def fail_first(fake, route_name, times, status=503):
+    """Первые times запросов маршрута отвечают ошибкой status."""
+    for number, (method, pattern, handler, name) in enumerate(fake.routes):
+        if name != route_name:
+            continue
+
+        failures = [times]
+
+        def failing(request, *groups, handler=handler):
+            if failures[0]:
+                failures[0] -= 1
+                return status, {'errors': [{'status': status}]}
+
+            return handler(request, *groups)
+
+        fake.routes[number] = (method, pattern, failing, name)
+
+
+@pytest.fixture
+def retry_policy():
+    return RetryPolicy(max_attempts=4, backoff_base=0.01, backoff_max=0.05)
+
+
+def test_parse_retry_after():
+    in_two_minutes = email.utils.formatdate(time.time() + 120, usegmt=True)
+
+    assert parse_retry_after('2') == 2
+    assert parse_retry_after('-1') == 0
+    assert 110 < parse_retry_after(in_two_minutes) <= 120
+    assert parse_retry_after('скоро') is None
+    assert parse_retry_after(None) is None
+
+
+def test_retry_after_is_respected_for_any_method(retry_policy):
+    delay = retry_policy.retry_delay('POST', '/v2/carts/1/items', 0,
+                                     response=make_response(429, '1.5'))
+
+    assert delay == 1.5
+
+
+def test_only_idempotent_requests_are_retried_after_failures(retry_policy):
+    error = requests.ConnectionError()
+
+    assert retry_policy.retry_delay(
+        'GET', '/v2/products', 0, response=make_response(503)) <= 0.01
+    assert retry_policy.retry_delay(
+        'POST', '/v2/products', 0, response=make_response(503)) is None
+    assert retry_policy.retry_delay(
+        'GET', '/v2/products', 0, error=error) is not None
+    assert retry_policy.retry_delay(
+        'POST', '/v2/products', 0, error=error) is None
+    assert retry_policy.retry_delay(
+        'POST', '/oauth/access_token', 0, error=error,
+        is_idempotent=True) is not None
+    assert retry_policy.retry_delay(
+        'GET', '/v2/products', 0, response=make_response(404)) is None
+
+
+def test_attempts_are_limited(retry_policy):
+    response = make_response(503)
+
+    assert retry_policy.retry_delay('GET', '/v2/files', 2,
+                                    response=response) is not None
+    assert retry_policy.retry_delay('GET', '/v2/files', 3,
+                                    response=response) is None
+
+
+def test_delay_does_not_pass_the_deadline(retry_policy):
+    with deadline(0.5):
+        assert retry_policy.retry_delay(
+            'GET', '/v2/files', 0, response=make_response(429, '1')) is None
+        assert retry_policy.retry_delay(
+            'GET', '/v2/files', 0, response=make_response(429, '0.1')) == 0.1
+
+
+def test_retry_budget_is_per_endpoint():
+    retry_policy = RetryPolicy(backoff_base=0, retry_rate=0.001,
+                               retry_burst=2)
+    response = make_response(503)
+
+    delays = [retry_policy.retry_delay('GET', f'/v2/products/{number}', 0,
+                                       response=response)
+              for number in range(3)]
+
+    assert delays[:2] == [0, 0]
+    assert delays[2] is None
+    assert retry_policy.retry_delay('GET', '/v2/files', 0,
+                                    response=response) == 0
+    assert endpoint_name('GET', '/v2/products/1?x=1') == 'GET /v2/products'
+
+
+def test_moltin_retries_get_but_not_post(fake_moltin, retry_policy):
+    moltin_api = Moltin('client-id', api_url=fake_moltin.url,
+                        retry_policy=retry_policy)
+    fail_first(fake_moltin, 'GET /v2/products', 2)
+    fail_first(fake_moltin, 'POST /v2/products', 1)
+
+    assert len(moltin_api.fetch_products()) == 1
+    assert fake_moltin.calls['GET /v2/products'] == 3
+
+    with pytest.raises(requests.HTTPError):
+        moltin_api.create_product('Пицца', 'Описание', 50000)
+    assert fake_moltin.calls['POST /v2/products'] == 1
+
+
+def test_token_request_is_retried(fake_moltin, retry_policy):
+    moltin_api = Moltin('client-id', api_url=fake_moltin.url,
+                        retry_policy=retry_policy)
+    fail_first(fake_moltin, 'POST /oauth/access_token', 2)
+
+    assert len(moltin_api.fetch_products()) == 1
+    assert fake_moltin.calls['POST /oauth/access_token'] == 3
+
+
+@pytest.fixture
+def hung_moltin():
+    fake = FakeMoltin(latency=2).start()
+
+    yield fake
+
+    fake.stop()
+
+
+def test_hung_token_request_is_cut_by_attempt_timeout(hung_moltin):
+    moltin_api = Moltin('client-id', api_url=hung_moltin.url,
+                        retry_policy=RetryPolicy(max_attempts=2,
+                                                 backoff_base=0,
+                                                 attempt_timeout=0.2))
+
+    started_at = time.monotonic()
+    with pytest.raises(requests.Timeout):
+        moltin_api.get_access_token()
+
+    assert time.monotonic() - started_at < 1
+    assert hung_moltin.calls['POST /oauth/access_token'] == 2
+
+
+def test_token_request_keeps_the_deadline(hung_moltin):
+    moltin_api = Moltin('client-id', api_url=hung_moltin.url)
+
+    started_at = time.monotonic()
+    with deadline(0.3):
+        with pytest.raises((DeadlineExceeded, requests.Timeout)):
+            moltin_api.fetch_products()
+
+    assert time.monotonic() - started_at < 1
@@ -0,0 +1,150 @@
+import time
+from concurrent.futures import TimeoutError
+
+import pytest
+from telegram import Bot, Message
+from telegram.error import RetryAfter
+
+from benchmarks.fakes import FakeTelegram
+from chat_executor import ChatExecutor
+from send_scheduler import (PRIORITY_CLEANUP, PRIORITY_REPLY,
+                            PRIORITY_URGENT, ScheduledBot, SendScheduler)
+
+SEND_MESSAGE = 'POST /bot{token}/sendMessage'
+
+
+class FloodedRequest():
+    """Первые retries вызовов отвечают RetryAfter, затем возвращают ok."""
+
+    __name__ = 'send_message'
+
+    def __init__(self, retries=1, retry_after=0.2):
+        self.retries = retries
+        self.retry_after = retry_after
+        self.calls = 0
+
+    def __call__(self):
+        self.calls += 1
+        if self.calls <= self.retries:
+            raise RetryAfter(self.retry_after)
+
+        return 'ok'
+
+
+@pytest.fixture
+def send_scheduler():
+    send_scheduler = SendScheduler(global_rate=1000, chat_rate=5,
+                                   chat_burst=1)
+
+    yield send_scheduler
+
+    send_scheduler.stop(wait=False)
+
+
+@pytest.fixture
+def fake_telegram():
+    fake = FakeTelegram().start()
+
+    yield fake
+
+    fake.stop()
+
+
+def test_retry_after_requeues_without_blocking_other_chats(send_scheduler):
+    flooded = FloodedRequest(retry_after=0.3)
+    finished = []
+
+    started_at = time.monotonic()
+    flooded_future = send_scheduler.submit(1, flooded)
+    flooded_future.add_done_callback(lambda _: finished.append(1))
+    other_future = send_scheduler.submit(
+        2, lambda: finished.append(2) or 'other')
+
+    assert other_future.result(timeout=5) == 'other'
+    assert flooded_future.result(timeout=5) == 'ok'
+    assert flooded.calls == 2
+    assert time.monotonic() - started_at >= 0.3
+    assert finished == [2, 1]
+    assert send_scheduler.queue_depth() == 0
+
+
+def test_cancelled_job_is_not_retried(send_scheduler):
+    flooded = FloodedRequest(retry_after=0.2)
+    future = send_scheduler.submit(1, flooded)
+
+    while flooded.calls == 0:
+        time.sleep(0.01)
+    assert future.cancel()
+    time.sleep(0.4)
+
+    assert flooded.calls == 1
+    assert send_scheduler.queue_depth() == 0
+
+
+def test_ready_jobs_go_out_by_priority(send_scheduler):
+    sent = []
+    send_scheduler.submit(1, sent.append, ('first',)).result(timeout=5)
+
+    # Лимит чата исчерпан, поэтому все три запроса успевают встать в очередь.
+    futures = [
+        send_scheduler.submit(1, sent.append, (priority,), priority=priority)
+        for priority in (PRIORITY_CLEANUP, PRIORITY_URGENT, PRIORITY_REPLY)
+    ]
+    for future in futures:
+        future.result(timeout=5)
+
+    assert sent == ['first', PRIORITY_URGENT, PRIORITY_REPLY,
+                    PRIORITY_CLEANUP]
+
+
+def test_scheduled_bot_sends_through_queue(send_scheduler, fake_telegram):
+    bot = ScheduledBot(Bot(FakeTelegram.TOKEN,
+                           base_url=fake_telegram.base_url),
+                       send_scheduler)
+
+    message = bot.sendMessage(chat_id=1, text='Привет')
+
+    assert isinstance(message, Message)
+    assert message.bot is bot
+    assert fake_telegram.last_message(1)['text'] == 'Привет'
+
+
+def test_timed_out_message_is_never_sent(send_scheduler, fake_telegram):
+    bot = ScheduledBot(Bot(FakeTelegram.TOKEN,
+                           base_url=fake_telegram.base_url),
+                       send_scheduler,
+                       timeout=0.05)
+    bot.send_message(chat_id=1, text='Первое')
+
+    # Второе сообщение ждёт лимита чата дольше, чем готов ждать обработчик.
+    with pytest.raises(TimeoutError):
+        bot.send_message(chat_id=1, text='Второе')
+    time.sleep(0.4)
+
+    assert fake_telegram.calls[SEND_MESSAGE] == 1
+    assert fake_telegram.last_message(1)['text'] == 'Первое'
+
+
+def test_chat_over_its_limit_does_not_delay_other_chats(fake_telegram):
+    send_scheduler = SendScheduler(chat_rate=1, chat_burst=3)
+    bot = ScheduledBot(Bot(FakeTelegram.TOKEN,
+                           base_url=fake_telegram.base_url),
+                       send_scheduler)
+    chat_executor = ChatExecutor(workers=2)
+    finished_at = {}
+
+    def handle_update(chat_id, messages):
+        for number in range(messages):
+            bot.send_message(chat_id=chat_id, text=str(number))
+        finished_at[chat_id] = time.monotonic()
+
+    started_at = time.monotonic()
+    # Корзина из нескольких товаров: первому чату лимит не даёт отправить
+    # все сообщения сразу.
+    chat_executor.submit(1, handle_update, 1, 5)
+    chat_executor.submit(2, handle_update, 2, 1)
+    chat_executor.shutdown(wait=True)
+    send_scheduler.stop()
+
+    assert finished_at[2] - started_at < 0.5
+    assert finished_at[1] - started_at >= 1.5
@@ -0,0 +1,102 @@
+import pytest
+
+from session_store import SessionStore
+
+
+class RoundTrips():
+    """Считает обращения к Redis: команды и конвейеры."""
+
+    def __init__(self, redis_db):
+        self.commands = 0
+        self.pipelines = 0
+        execute_command = redis_db.execute_command
+        pipeline = redis_db.pipeline
+
+        def counted_command(*args, **kwargs):
+            self.commands += 1
+            return execute_command(*args, **kwargs)
+
+        def counted_pipeline(*args, **kwargs):
+            self.pipelines += 1
+            return pipeline(*args, **kwargs)
+
+        redis_db.execute_command = counted_command
+        redis_db.pipeline = counted_pipeline
+
+
+@pytest.fixture
+def session_store(redis_db):
+    return SessionStore(redis_db, ttl=60)
+
+
+def test_session_round_trip(redis_db, session_store):
+    session = session_store.load(1)
+    session.state = 'HANDLE_MENU'
+    session['product_id'] = 'pizza-1'
+    session['message_id'] = 42
+    session['location'] = (55.751244, 37.618423)
+    session['menu_page'] = 2
+    session_store.save(session)
+
+    loaded = session_store.load(1)
+
+    assert loaded == {
+        'state': 'HANDLE_MENU',
+        'product_id': 'pizza-1',
+        'message_id': 42,
+        'location': (55.75124, 37.61842),
+        'menu_page': 2,
+    }
+    assert loaded.changed == set()
+    assert 0 < redis_db.ttl('session:1') <= 60
+
+
+def test_save_writes_only_changed_fields(redis_db, session_store):
+    session = session_store.load(1)
+    session.state = 'HANDLE_MENU'
+    session['product_id'] = 'pizza-1'
+    session_store.save(session)
+
+    session = session_store.load(1)
+    # Поле, изменённое в Redis другим апдейтом, сохранение не затирает.
+    redis_db.hset('session:1', 's', 'HANDLE_CART')
+    session['product_id'] = None
+    session_store.save(session)
+
+    assert redis_db.hgetall('session:1') == {b's': b'HANDLE_CART'}
+
+
+def test_load_and_save_take_one_round_trip_each(redis_db, session_store):
+    round_trips = RoundTrips(redis_db)
+
+    session = session_store.load(1)
+    session.state = 'START'
+    session_store.save(session)
+
+    assert round_trips.pipelines == 2
+    assert round_trips.commands == 0
+
+
+def test_legacy_state_is_migrated(redis_db, session_store):
+    redis_db.set(1, 'HANDLE_DESCRIPTION')
+
+    session = session_store.load(1)
+
+    assert session.state == 'HANDLE_DESCRIPTION'
+    assert session.is_legacy
+
+    session_store.save(session)
+
+    assert redis_db.get(1) is None
+    assert redis_db.hget('session:1', 's') == b'HANDLE_DESCRIPTION'
+    assert not session_store.load(1).is_legacy
+
+
+def test_new_state_wins_over_legacy(redis_db, session_store):
+    redis_db.set(1, 'HANDLE_DESCRIPTION')
+    redis_db.hset('session:1', 's', 'HANDLE_MENU')
+
+    session = session_store.load(1)
+
+    assert session.state == 'HANDLE_MENU'
+    assert not session.is_legacy
@@ -0,0 +1,123 @@
+import time
+
+import pytest
+
+from update_stream import StreamWorker, UpdateStream, get_update_chat_id
+
+
+class HeldExecutor():
+    """Копит задачи воркера и выполняет их по команде теста."""
+
+    def __init__(self):
+        self.jobs = []
+
+    def submit(self, chat_id, func, *args):
+        self.jobs.append((func, args))
+
+    def run_all(self):
+        jobs, self.jobs = self.jobs, []
+        for func, args in jobs:
+            func(*args)
+
+    def shutdown(self, wait=True):
+        self.run_all()
+
+
+def make_update(update_id, chat_id=1):
+    return {
+        'update_id': update_id,
+        'message': {'chat': {'id': chat_id}, 'text': str(update_id)},
+    }
+
+
+def make_worker(update_stream, consumer, handled):
+    executor = HeldExecutor()
+    worker = StreamWorker(
+        update_stream,
+        lambda payload: handled.append((consumer, payload['update_id'])),
+        executor,
+        lease_ttl=0.5,
+        handler_deadline=0.5,
+    )
+    worker.consumer = consumer
+
+    return worker, executor
+
+
+def pending_count(redis_db, update_stream, partition=0):
+    return redis_db.xpending(update_stream.stream_key(partition),
+                             update_stream.group)['pending']
+
+
+@pytest.fixture
+def update_stream(redis_db):
+    update_stream = UpdateStream(redis_db, partitions=1)
+    update_stream.ensure_groups()
+
+    return update_stream
+
+
+def test_updates_of_chat_go_to_one_partition(redis_db):
+    update_stream = UpdateStream(redis_db, partitions=4)
+
+    for update_id, chat_id in enumerate((1, 5, 2, 1)):
+        update_stream.publish(make_update(update_id, chat_id))
+
+    lengths = [redis_db.xlen(update_stream.stream_key(partition))
+               for partition in range(4)]
+    assert lengths == [0, 3, 1, 0]
+    assert get_update_chat_id(
+        {'callback_query': {'message': {'chat': {'id': 7}}}}) == 7
+
+
+def test_worker_handles_and_acks_updates(redis_db, update_stream):
+    handled = []
+    worker, executor = make_worker(update_stream, 'A', handled)
+    worker.maintain_leases()
+    for update_id in range(3):
+        update_stream.publish(make_update(update_id))
+
+    worker.read(worker.owned_partitions())
+    executor.run_all()
+
+    assert handled == [('A', 0), ('A', 1), ('A', 2)]
+    assert pending_count(redis_db, update_stream) == 0
+    assert worker.inflight() == 0
+
+
+def test_new_owner_reclaims_updates_of_stalled_worker(redis_db,
+                                                      update_stream):
+    handled = []
+    worker_a, executor_a = make_worker(update_stream, 'A', handled)
+    worker_b, executor_b = make_worker(update_stream, 'B', handled)
+
+    worker_a.maintain_leases()
+    for update_id in range(3):
+        update_stream.publish(make_update(update_id))
+    worker_a.read({0})
+    assert len(executor_a.jobs) == 3
+
+    # A завис и потерял аренду, поток взял B.
+    time.sleep(0.6)
+    worker_b.maintain_leases()
+    assert worker_b.owned_partitions() == [0]
+    # A мог ещё обрабатывать апдейты, поэтому B их пока не забирает.
+    assert executor_b.jobs == []
+
+    update_stream.publish(make_update(3))
+
+    # Очнувшись без аренды, A апдейты не обрабатывает.
+    executor_a.run_all()
+    assert handled == []
+    assert pending_count(redis_db, update_stream) == 3
+
+    time.sleep(1.1)
+    worker_b.maintain_leases()
+    assert len(executor_b.jobs) == 3
+    executor_b.run_all()
+
+    worker_b.read({0})
+    executor_b.run_all()
+
+    assert handled == [('B', 0), ('B', 1), ('B', 2), ('B', 3)]
+    assert pending_count(redis_db, update_stream) == 0
@@ -1,174 +1,136 @@
 import logging
+import os
+import signal
+import threading
 from functools import partial
 from textwrap import dedent
+from urllib.parse import urlsplit
 
-import redis
 from environs import Env
-from telegram import InlineKeyboardButton, InlineKeyboardMarkup, ParseMode
+from telegram import (Bot, InlineKeyboardButton, InlineKeyboardMarkup,
+                      ParseMode, Update)
 from telegram.ext import (CallbackQueryHandler, CommandHandler, Filters,
                           MessageHandler, Updater)
+from telegram.utils.request import Request
 
+from cart_mirror import get_cart_cost, get_cart_mirror
+from catalog_cache import CatalogCache
+from chat_executor import ChatExecutor
+from database import get_database_connection
 from geocode_api import Geocode
-from moltin_api import Moltin
-
-_database = None
+from menu_render import get_menu_renderer
+from metrics import (HANDLER_ERRORS, HANDLER_LATENCY, error_name,
+                     start_metrics_server)
+from navigation import count_calls_saved, show_product_photo, show_text
+from moltin_api import MOLTIN_API_URL, Moltin
+from pizzeria_index import get_pizzeria_index
+from profiling import get_profiler, install_signal_handlers
+from retry_policy import RetryPolicy, deadline
+from send_scheduler import ScheduledBot, SendScheduler
+from session_store import get_session_store
+from tracing import (create_exporter, enable_tracing, set_trace_attribute,
+                     trace_span, traced)
+from traffic_capture import capture_update, enable_traffic_capture
+from update_stream import StreamWorker, UpdateStream
+from webhook_server import WebhookServer
 
 logger = logging.getLogger('fish-shop')
 
 
-def start(bot, update, moltin_api, geocode_api):
+def start(bot, update, moltin_api, geocode_api, session):
     """
     Хэндлер для состояния START.
 
     Бот отвечает пользователю фразой "Привет!" и переводит его в состояние ECHO.
     Теперь в ответ на его команды будет запускается хэндлер echo.
     """
-    moltin_api.get_or_create_cart(update.effective_user.id)
+    get_cart_mirror().ensure_cart(moltin_api, update.effective_user.id)
 
-    products = moltin_api.get_products()
+    return show_menu(bot, update, moltin_api, session,
+                     session.get('menu_page', 0))
 
-    keyboard = [
-        [InlineKeyboardButton(
-            product.get('name'),
-            callback_data=product.get('id')
-        )
-        ] for product in products]
 
-    keyboard.append(
-        [InlineKeyboardButton(
-            '🛒 Корзина',
-            callback_data='SHOW_CART'
-        )]
+def show_menu(bot, update, moltin_api, session, page=0):
+    """Отображение страницы меню."""
+    message_text, reply_markup, page = get_menu_renderer().menu_page(
+        moltin_api.get_products(),
+        page
     )
 
-    reply_markup = InlineKeyboardMarkup(keyboard)
-
     if update.message:
-        update.message.reply_text('Please choose:', reply_markup=reply_markup)
+        message = bot.send_message(chat_id=update.effective_chat.id,
+                                   text=message_text,
+                                   reply_markup=reply_markup)
     else:
-        chat_id = update.effective_chat.id
-        bot.send_message(chat_id=chat_id,
-                         text='Please choose:',
-                         reply_markup=reply_markup)
+        message = show_text(bot, update, message_text, reply_markup)
 
-        bot.delete_message(chat_id=chat_id,
-                           message_id=update.effective_message.message_id)
+    session['message_id'] = message.message_id
+    session['menu_page'] = page
 
     return 'HANDLE_MENU'
 
 
-def get_image_url(product, moltin_api):
-    """Получает ссылку на URL изображения."""
-    if file_id := (product.get('relationships')
-                   .get('main_image')
-                   .get('data')
-                   .get('id')):
-
-        if file_url := (moltin_api.get_file_url(file_id)
-                        .get('data')
-                        .get('link')
-                        .get('href')):
-
-            return file_url
-
-
-def handle_menu(bot, update, moltin_api, geocode_api):
+def handle_menu(bot, update, moltin_api, geocode_api, session):
     """Обработка кнопок меню."""
-    chat_id = update.effective_chat.id
-    message_id = update.effective_message.message_id
     query = update.callback_query
 
     if query.data == 'SHOW_CART':
-        return show_cart(bot, update, moltin_api, geocode_api)
+        return show_cart(bot, update, moltin_api, geocode_api, session)
+    elif query.data.startswith('PAGE#'):
+        return show_menu(bot, update, moltin_api, session,
+                         int(query.data.split('#')[1]))
 
     item_id = query.data
     product = moltin_api.get_product(item_id)
 
-    try:
-        image_url = get_image_url(product, moltin_api)
-    except AttributeError:
-        image_url = open('no_image.jpg', 'rb')
-
-    price = product.get('price')[0]
-    price = f'{float(price["amount"])} {price["currency"]}'
-
-    message_text = dedent(
-        f'''
-            *{product.get('name')}*
-
-            *Цена:*:
-            `{price}`
+    message_text, reply_markup = get_menu_renderer().product_card(product)
 
-            Описание:
-            `{product.get('description')}`
+    message = show_product_photo(bot,
+                                 update,
+                                 product,
+                                 moltin_api,
+                                 caption=message_text,
+                                 reply_markup=reply_markup,
+                                 parse_mode=ParseMode.MARKDOWN)
 
-        '''
-    )
-
-    quantity_button = []
-
-    for quantity in [1]:
-        quantity_button.append(
-            InlineKeyboardButton(
-                f'Добавить в корзину',
-                callback_data=f'{item_id}#{quantity}',
-            )
-        )
-
-    keyboard = [
-        quantity_button,
-        [InlineKeyboardButton('🛒 Корзина', callback_data='SHOW_CART')],
-        [InlineKeyboardButton('В меню', callback_data='BACK')]
-    ]
-
-    reply_markup = InlineKeyboardMarkup(keyboard)
-
-    bot.send_photo(
-        chat_id=chat_id,
-        photo=image_url,
-        caption=message_text,
-        parse_mode=ParseMode.MARKDOWN,
-        reply_markup=reply_markup)
-
-    bot.delete_message(chat_id=chat_id,
-                       message_id=message_id)
+    session['product_id'] = item_id
+    session['message_id'] = message.message_id
 
     return 'HANDLE_DESCRIPTION'
 
 
-def handle_description(bot, update, moltin_api, geocode_api):
+def handle_description(bot, update, moltin_api, geocode_api, session):
     """Обработка вывода описания."""
     user_id = update.effective_user.id
     query = update.callback_query
 
     if query.data == 'SHOW_CART':
-        return show_cart(bot, update, moltin_api, geocode_api)
+        return show_cart(bot, update, moltin_api, geocode_api, session)
     elif query.data == 'BACK':
-        return start(bot, update, moltin_api, geocode_api)
+        return start(bot, update, moltin_api, geocode_api, session)
 
     item_id, quantity = query.data.split('#')
 
-    moltin_api.add_cart_item(user_id, item_id=item_id, quantity=quantity)
+    get_cart_mirror().add_item(moltin_api,
+                               user_id,
+                               item_id=item_id,
+                               quantity=quantity)
 
-    query.answer(text='Товар добавлен в корзину.', show_alert=True)
+    bot.answer_callback_query(query.id,
+                              text='Товар добавлен в корзину.',
+                              show_alert=True)
 
     return 'HANDLE_DESCRIPTION'
 
 
-def show_cart(bot, update, moltin_api, geocode_api):
+def show_cart(bot, update, moltin_api, geocode_api, session):
     """Отображение корзины."""
-    chat_id = update.effective_chat.id
-    message_id = update.effective_message.message_id
     user_id = update.effective_user.id
 
-    cart = moltin_api.get_cart(user_id)
-    cart_items = moltin_api.get_cart_items(user_id).get('data', [])
+    cart = get_cart_mirror().get_cart(moltin_api, user_id)
+    cart_items = cart['items']
 
-    cost = (cart.get('data')
-                .get('meta')
-                .get('display_price')
-                .get('with_tax')
-                .get('formatted'))
+    cost = get_cart_cost(moltin_api, cart)
 
     keyboard = []
     description_items = []
@@ -224,38 +186,37 @@ def show_cart(bot, update, moltin_api, geocode_api):
 
     reply_markup = InlineKeyboardMarkup(keyboard)
 
-    bot.send_message(chat_id=chat_id,
-                     text=message_text,
-                     reply_markup=reply_markup,
-                     parse_mode=ParseMode.MARKDOWN)
+    message = show_text(bot,
+                        update,
+                        message_text,
+                        reply_markup=reply_markup,
+                        parse_mode=ParseMode.MARKDOWN)
 
-    bot.delete_message(chat_id=chat_id,
-                       message_id=message_id)
+    session['message_id'] = message.message_id
 
     return 'HANDLE_CART'
 
 
-def handle_cart(bot, update, moltin_api, geocode_api):
+def handle_cart(bot, update, moltin_api, geocode_api, session):
     """Обработка кнопок корзины."""
     user_id = update.effective_user.id
     query = update.callback_query
 
     if query.data == 'HANDLE_WAITING':
-        return handle_waiting(bot, update, moltin_api, geocode_api)
+        return handle_waiting(bot, update, moltin_api, geocode_api, session)
     elif query.data == 'BACK':
-        return start(bot, update, moltin_api, geocode_api)
+        return start(bot, update, moltin_api, geocode_api, session)
 
     item_id = query.data
 
-    moltin_api.remove_cart_item(user_id, item_id)
+    get_cart_mirror().remove_item(moltin_api, user_id, item_id)
 
-    return show_cart(bot, update, moltin_api, geocode_api)
+    return show_cart(bot, update, moltin_api, geocode_api, session)
 
 
-def handle_waiting(bot, update, moltin_api, geocode_api):
+def handle_waiting(bot, update, moltin_api, geocode_api, session):
     """Обработчик получения оплаты."""
     chat_id = update.effective_chat.id
-    message_id = update.effective_message.message_id
     user_id = update.effective_user.id
 
     if update.message:
@@ -273,43 +234,37 @@ def handle_waiting(bot, update, moltin_api, geocode_api):
 
             return 'HANDLE_WAITING'
         else:
-            pizzeria_addresses = moltin_api.get_entries('Pizzeria')
-
-            for address in pizzeria_addresses:
-                coords_from = (address.get('latitude'),
-                               address.get('longitude'))
-                distance = geocode_api.calculate_distance(
-                    coords_from,
-                    current_pos
-                )
-
-                address['distance'] = distance
-
-            # TODO #3 Удалить принт.
-            # print(pizzerias_addresses)
-
-            pizzeria = min(pizzeria_addresses,
-                           key=lambda address: address['distance'])
+            session['location'] = current_pos
+            pizzerias = get_pizzeria_index(moltin_api).nearest(current_pos)
 
-            print(pizzeria)
+            logger.debug(pizzerias)
 
-        update.message.reply_text(f'{current_pos}')
+        bot.send_message(chat_id=chat_id, text=f'{current_pos}')
 
         # TODO #2 временно закомментировали
         # moltin_api.create_customer(user_id, email)
 
-        return show_cart(bot, update, moltin_api, geocode_api)
+        return show_cart(bot, update, moltin_api, geocode_api, session)
     else:
-        bot.send_message(chat_id=chat_id,
-                         text='Пришлите, пожалуйста, Ваш адрес текстом или геолокацию:')
+        # Перед оформлением заказа сверяем корзину с Moltin.
+        get_cart_mirror().reconcile(moltin_api, user_id)
 
-        bot.delete_message(chat_id=chat_id,
-                           message_id=message_id)
+        message = show_text(
+            bot,
+            update,
+            'Пришлите, пожалуйста, Ваш адрес текстом или геолокацию:')
+
+        session['message_id'] = message.message_id
 
         return 'HANDLE_WAITING'
 
 
-def handle_users_reply(bot, update, moltin_api, geocode_api):
+@traced('update')
+def handle_users_reply(bot,
+                       update,
+                       moltin_api,
+                       geocode_api,
+                       update_deadline=10):
     """
     Функция, которая запускается при любом сообщении от пользователя и решает как его обработать.
 
@@ -322,8 +277,11 @@ def handle_users_reply(bot, update, moltin_api, geocode_api):
     Если пользователь только начал пользоваться ботом, Telegram форсит его написать "/start",
     поэтому по этой фразе выставляется стартовое состояние.
     Если пользователь захочет начать общение с ботом заново, он также может воспользоваться этой командой.
+    На все запросы к API при обработке апдейта отводится update_deadline секунд.
+    Если включена запись трафика (TRAFFIC_CAPTURE_PATH), апдейт с его вызовами API пишется в файл.
+    Доля TRACING_SAMPLE_RATE апдейтов трассируется: каждый вызов API, обращение к кэшу и отправка в Telegram попадают в span.
     """
-    db = get_database_connection()
+    session_store = get_session_store()
     if update.message:
         user_reply = update.message.text
         chat_id = update.message.chat_id
@@ -332,10 +290,11 @@ def handle_users_reply(bot, update, moltin_api, geocode_api):
         chat_id = update.callback_query.message.chat_id
     else:
         return
+    session = session_store.load(chat_id)
     if user_reply == '/start':
         user_state = 'START'
     else:
-        user_state = db.get(chat_id).decode('utf-8')
+        user_state = session.state or 'START'
 
     states_functions = {
         'START': start,
@@ -345,38 +304,140 @@ def handle_users_reply(bot, update, moltin_api, geocode_api):
         'HANDLE_WAITING': handle_waiting
     }
     state_handler = states_functions[user_state]
+    set_trace_attribute('chat_id', chat_id)
+    set_trace_attribute('state', user_state)
     # Если вы вдруг не заметите, что python-telegram-bot перехватывает ошибки.
     # Оставляю этот try...except, чтобы код не падал молча.
     # Этот фрагмент можно переписать.
     try:
-        next_state = state_handler(bot, update, moltin_api, geocode_api)
-        db.set(chat_id, next_state)
+        with deadline(update_deadline), count_calls_saved() as calls_saved, \
+                capture_update(update, user_state) as captured, \
+                HANDLER_LATENCY.labels(user_state).time(), \
+                trace_span(user_state):
+            session.state = state_handler(bot,
+                                          update,
+                                          moltin_api,
+                                          geocode_api,
+                                          session)
+            captured['next_state'] = session.state
+        set_trace_attribute('next_state', session.state)
+        session_store.save(session)
+        logger.debug('Сэкономлено запросов к Telegram: %s', calls_saved[0])
+    except Exception as err:
+        HANDLER_ERRORS.labels(user_state, error_name(err)).inc()
+        logger.exception('Ошибка в состоянии %s: %s', user_state, err)
+        send_error_message(bot, chat_id)
+
+
+def send_error_message(bot, chat_id):
+    """Сообщает пользователю, что запрос не удалось выполнить."""
+    try:
+        bot.send_message(
+            chat_id=chat_id,
+            text='Что-то пошло не так. Попробуйте ещё раз чуть позже.'
+        )
     except Exception as err:
         logger.error(err)
 
 
-def get_database_connection():
+def handle_profile_command(bot, update, args, admin_ids, profile_seconds=30):
     """
-    Возвращает конекшн с базой данных Redis, либо создаёт новый, если он ещё не создан.
+    Команда /profile для администраторов из TELEGRAM_ADMIN_IDS.
+
+    /profile cpu [секунд] — профиль CPU, присылается файлом по готовности;
+    /profile mem — снимок памяти и отличия от предыдущего снимка;
+    /profile mem stop — остановить tracemalloc.
     """
-    global _database
-    if _database is None:
-        env = Env()
-        env.read_env()
-
-        database_host = env.str('REDIS_HOST', 'localhost')
-        database_port = env.str('REDIS_PORT', 6379)
-        database_username = env.str('REDIS_USERNAME', '')
-        database_password = env.str('REDIS_PASSWORD', '')
-
-        _database = redis.Redis(
-            host=database_host,
-            port=database_port,
-            username=database_username,
-            password=database_password
-        )
+    if update.effective_user.id not in admin_ids:
+        return
+
+    chat_id = update.effective_chat.id
+    profiler = get_profiler()
+    command = args[0] if args else 'cpu'
+
+    if command == 'cpu':
+        seconds = profile_seconds
+        if len(args) > 1 and args[1].isdigit():
+            seconds = min(int(args[1]), 600)
+
+        def send_profile(path):
+            with open(path, 'rb') as profile:
+                bot.send_document(chat_id=chat_id,
+                                  document=profile,
+                                  filename=os.path.basename(path))
+
+        if profiler.start_cpu(seconds, on_done=send_profile) is None:
+            text = 'Профилирование CPU уже идёт.'
+        else:
+            text = f'Профилирую CPU {seconds} с, пришлю профиль файлом.'
+    elif command == 'mem' and args[1:] == ['stop']:
+        profiler.memory_stop()
+        text = 'tracemalloc остановлен.'
+    elif command == 'mem':
+        def send_snapshot(path, lines):
+            bot.send_message(
+                chat_id=chat_id,
+                text='`{}`\n```\n{}\n```'.format(path,
+                                                 '\n'.join(lines)[:3500]),
+                parse_mode=ParseMode.MARKDOWN,
+            )
+
+        if profiler.start_memory_snapshot(on_done=send_snapshot):
+            text = 'Снимаю снимок памяти, пришлю по готовности.'
+        else:
+            text = 'Снимок памяти уже снимается.'
+    else:
+        text = 'Использование: /profile cpu [секунд] | mem | mem stop'
+
+    bot.send_message(chat_id=chat_id, text=text)
+
+
+def submit_users_reply(bot,
+                       update,
+                       chat_executor,
+                       moltin_api,
+                       geocode_api,
+                       update_deadline=10):
+    """Ставит апдейт в очередь его чата, чтобы апдейты чата шли по порядку."""
+    chat_id = update.effective_chat.id if update.effective_chat else None
+
+    chat_executor.submit(chat_id,
+                         handle_users_reply,
+                         bot,
+                         update,
+                         moltin_api,
+                         geocode_api,
+                         update_deadline)
+
 
-    return _database
+def publish_update(bot, update, update_stream):
+    """Кладёт апдейт в Redis Stream, откуда его заберёт воркер."""
+    update_stream.publish(update.to_dict())
+
+
+def run_stream_worker(bot,
+                      update_stream,
+                      chat_executor,
+                      moltin_api,
+                      geocode_api,
+                      update_deadline=10):
+    """Обрабатывает апдейты из Redis Stream до сигнала SIGTERM или SIGINT."""
+    def handle_update(payload):
+        handle_users_reply(bot,
+                           Update.de_json(payload, bot),
+                           moltin_api,
+                           geocode_api,
+                           update_deadline)
+
+    stream_worker = StreamWorker(update_stream,
+                                 handle_update,
+                                 chat_executor,
+                                 handler_deadline=update_deadline)
+
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(signum, lambda *args: stream_worker.stop())
+
+    stream_worker.run()
 
 
 def main():
@@ -391,24 +452,160 @@ def main():
     token = env.str('TELEGRAM_TOKEN')
     moltin_client_id = env.str('MOLTIN_CLIENT_ID')
     yandex_api_key = env.str('YANDEX_API_KEY', '')
+    moltin_pool_size = env.int('MOLTIN_POOL_SIZE', 10)
+    moltin_http2 = env.bool('MOLTIN_HTTP2', False)
+    catalog_cache_ttl = env.int('CATALOG_CACHE_TTL', 300)
+    update_deadline = env.float('UPDATE_DEADLINE', 10)
+
+    catalog_cache = CatalogCache(ttl=catalog_cache_ttl,
+                                 redis_db=get_database_connection())
+    moltin_api = Moltin(moltin_client_id,
+                        pool_size=moltin_pool_size,
+                        http2=moltin_http2,
+                        catalog_cache=catalog_cache,
+                        redis_db=get_database_connection(),
+                        retry_policy=RetryPolicy(
+                            max_attempts=env.int('MOLTIN_MAX_ATTEMPTS', 4),
+                            retry_rate=env.float('MOLTIN_RETRY_RATE', 1),
+                        ),
+                        api_url=env.str('MOLTIN_API_URL', '') or MOLTIN_API_URL)
+    geocode_api = Geocode(
+        yandex_api_key,
+        redis_db=get_database_connection(),
+        cache_size=env.int('GEOCODE_CACHE_SIZE', 1024),
+        hit_ttl=env.int('GEOCODE_HIT_TTL', 30 * 24 * 60 * 60),
+        miss_ttl=env.int('GEOCODE_MISS_TTL', 60 * 60),
+        base_url=env.str('YANDEX_GEOCODER_URL', '') or None,
+    )
 
-    moltin_api = Moltin(moltin_client_id)
-    geocode_api = Geocode(yandex_api_key)
+    start_metrics_server(env.int('METRICS_PORT', 0),
+                         addr=env.str('METRICS_ADDR', '') or '127.0.0.1')
 
-    handle_users_reply_partial = partial(
-        handle_users_reply,
-        moltin_api=moltin_api,
-        geocode_api=geocode_api
+    profile_seconds = env.int('PROFILE_SECONDS', 30)
+    install_signal_handlers(get_profiler(), profile_seconds)
+
+    if tracing_sample_rate := env.float('TRACING_SAMPLE_RATE', 0):
+        enable_tracing(create_exporter(env), tracing_sample_rate)
+
+    if traffic_capture_path := env.str('TRAFFIC_CAPTURE_PATH', ''):
+        enable_traffic_capture(traffic_capture_path,
+                               salt=env.str('TRAFFIC_CAPTURE_SALT', ''))
+
+    send_workers = env.int('TELEGRAM_SEND_WORKERS', 8)
+    send_scheduler = SendScheduler(
+        global_rate=env.float('TELEGRAM_GLOBAL_RATE', 30),
+        chat_rate=env.float('TELEGRAM_CHAT_RATE', 1),
+        group_rate=env.float('TELEGRAM_GROUP_RATE', 20) / 60,
+        workers=send_workers,
+    )
+    # Соединений хватает на потоки отправки, диспетчер и polling.
+    bot = ScheduledBot(
+        Bot(token,
+            base_url=env.str('TELEGRAM_API_URL', '') or None,
+            request=Request(con_pool_size=send_workers + 8)),
+        send_scheduler,
     )
 
-    updater = Updater(token)
+    # single — один процесс принимает и обрабатывает апдейты;
+    # ingest — только принимает апдейты и кладёт их в Redis Stream;
+    # worker — только обрабатывает апдейты из Redis Stream.
+    bot_mode = env.str('BOT_MODE', 'single')
+    # Обработчики ждут отправки сообщений из очереди, поэтому апдейты
+    # обрабатываются в пуле: чат, упёршийся в лимит Telegram, не
+    # задерживает остальные чаты.
+    bot_workers = env.int('BOT_WORKERS', 0) or 8
+    update_stream = UpdateStream(
+        get_database_connection(),
+        partitions=env.int('UPDATE_STREAM_PARTITIONS', 8),
+        maxlen=env.int('UPDATE_STREAM_MAXLEN', 100000),
+    )
+
+    if bot_mode == 'worker':
+        run_stream_worker(bot,
+                          update_stream,
+                          ChatExecutor(bot_workers),
+                          moltin_api,
+                          geocode_api,
+                          update_deadline)
+        return
+
+    if bot_mode == 'ingest':
+        handle_users_reply_partial = partial(publish_update,
+                                             update_stream=update_stream)
+    else:
+        handle_users_reply_partial = partial(
+            submit_users_reply,
+            chat_executor=ChatExecutor(bot_workers),
+            moltin_api=moltin_api,
+            geocode_api=geocode_api,
+            update_deadline=update_deadline
+        )
+
+    updater = Updater(bot=bot)
     dispatcher = updater.dispatcher
     dispatcher.add_handler(CallbackQueryHandler(handle_users_reply_partial))
     dispatcher.add_handler(MessageHandler(
         (Filters.text | Filters.location) & ~Filters.command,
         handle_users_reply_partial))
     dispatcher.add_handler(CommandHandler('start', handle_users_reply_partial))
-    updater.start_polling()
+    if admin_ids := env.list('TELEGRAM_ADMIN_IDS', [], subcast=int):
+        dispatcher.add_handler(CommandHandler(
+            'profile',
+            partial(handle_profile_command,
+                    admin_ids=admin_ids,
+                    profile_seconds=profile_seconds),
+            pass_args=True,
+        ))
+
+    if webhook_url := env.str('TELEGRAM_WEBHOOK_URL', ''):
+        start_webhook(
+            updater,
+            webhook_url,
+            secret_token=env.str('TELEGRAM_WEBHOOK_SECRET', ''),
+            listen=env.str('TELEGRAM_WEBHOOK_LISTEN', '0.0.0.0'),
+            port=env.int('TELEGRAM_WEBHOOK_PORT', 8443),
+        )
+    else:
+        updater.start_polling()
+
+
+def start_webhook(updater, webhook_url, secret_token='', listen='0.0.0.0',
+                  port=8443):
+    """
+    Принимает апдейты через вебхук вместо long polling.
+
+    Встроенный HTTP-сервер проверяет секрет, сразу отвечает Telegram и
+    кладёт апдейт в очередь диспетчера.
+    """
+    bot = updater.bot
+    dispatcher = updater.dispatcher
+
+    if not secret_token:
+        logger.warning('TELEGRAM_WEBHOOK_SECRET не задан, '
+                       'вебхук принимает апдейты от кого угодно')
+
+    def on_update(payload):
+        dispatcher.update_queue.put(Update.de_json(payload, bot))
+
+    webhook_server = WebhookServer(on_update,
+                                   listen=listen,
+                                   port=port,
+                                   url_path=urlsplit(webhook_url).path,
+                                   secret_token=secret_token)
+
+    threading.Thread(target=dispatcher.start,
+                     name='dispatcher',
+                     daemon=True).start()
+
+    webhook_kwargs = {'secret_token': secret_token} if secret_token else {}
+    bot.set_webhook(url=webhook_url, **webhook_kwargs)
+    logger.info('Вебхук %s, слушаем %s:%s', webhook_url, listen, port)
+
+    try:
+        webhook_server.serve_forever()
+    finally:
+        dispatcher.stop()
+        webhook_server.server_close()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,485 @@
+import argparse
+import contextvars
+import glob
+import json
+import logging
+import os
+import queue
+import random
+import threading
+import time
+from contextlib import nullcontext
+from functools import wraps
+from logging.handlers import RotatingFileHandler
+
+import requests
+from environs import Env
+
+from instrumentation import (add_cache_listener, remove_cache_listener,
+                             set_span_starter)
+
+logger = logging.getLogger('pizza-shop')
+
+_tracer = None
+
+# Открытый span текущего апдейта.
+_current_span = contextvars.ContextVar('current_span', default=None)
+
+_NO_SPAN = nullcontext()
+
+
+class Trace():
+    """Спаны одного апдейта; отдаются экспортёру, когда закрыт корневой."""
+
+    def __init__(self, exporter):
+        self.trace_id = os.urandom(16).hex()
+        self.exporter = exporter
+        self.spans = []
+        self.is_finished = False
+        self.lock = threading.Lock()
+
+    def __repr__(self):
+        return '<{} {}>'.format(self.__class__.__name__.upper(), self.trace_id)
+
+    def finish_span(self, span):
+        with self.lock:
+            if self.is_finished:
+                # Span, закрытый после ответа, например удаление сообщения.
+                late_spans = [span]
+            else:
+                self.spans.append(span)
+                late_spans = None
+
+                if span.parent_id is None:
+                    self.is_finished = True
+                    late_spans = self.spans
+
+        if late_spans:
+            self.exporter.export(late_spans)
+
+
+class Span():
+    """Отрезок обработки апдейта: вызов сервиса, хэндлер или весь апдейт."""
+
+    __slots__ = ('trace', 'span_id', 'parent_id', 'name', 'attributes',
+                 'events', 'start_time', 'duration', 'error', 'thread',
+                 '_started_at', '_token')
+
+    def __init__(self, trace, name, parent_id=None, attributes=None):
+        self.trace = trace
+        self.span_id = os.urandom(8).hex()
+        self.parent_id = parent_id
+        self.name = name
+        self.attributes = attributes or {}
+        self.events = []
+        self.start_time = None
+        self.duration = None
+        self.error = None
+        self.thread = None
+
+    def __repr__(self):
+        return '<{} {}>'.format(self.__class__.__name__.upper(), self.name)
+
+    def __enter__(self):
+        self.start_time = time.time()
+        self.thread = threading.current_thread().name
+        self._started_at = time.perf_counter()
+        self._token = _current_span.set(self)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.duration = time.perf_counter() - self._started_at
+        _current_span.reset(self._token)
+        if exc_value is not None:
+            self.error = exc_value.__class__.__name__
+
+        self.trace.finish_span(self)
+
+    def set_attribute(self, name, value):
+        self.attributes[name] = value
+
+    def add_event(self, name, **attributes):
+        self.events.append({
+            'name': name,
+            'time': round(time.time(), 6),
+            'attributes': attributes,
+        })
+
+    def to_dict(self):
+        return {
+            'trace_id': self.trace.trace_id,
+            'span_id': self.span_id,
+            'parent_id': self.parent_id,
+            'name': self.name,
+            'start': round(self.start_time, 6),
+            'duration': round(self.duration, 6),
+            'attributes': self.attributes,
+            'events': self.events,
+            'error': self.error,
+            'thread': self.thread,
+        }
+
+
+class Tracer():
+    """
+    Открывает трассы для доли sample_rate апдейтов.
+
+    Пока трасса апдейта не открыта, спаны вызовов не создаются, так что
+    неотобранные апдейты обходятся одной проверкой ContextVar на вызов.
+    """
+
+    def __init__(self, exporter, sample_rate=0.01):
+        self.exporter = exporter
+        self.sample_rate = sample_rate
+
+    def __repr__(self):
+        return '<{} sample_rate={}>'.format(self.__class__.__name__.upper(),
+                                            self.sample_rate)
+
+    def start_trace(self, name, **attributes):
+        """Открывает трассу, если апдейт попал в выборку."""
+        if random.random() >= self.sample_rate:
+            return _NO_SPAN
+
+        return Span(Trace(self.exporter), name, attributes=attributes)
+
+    def start_call_span(self, service, operation):
+        """Открывает span вызова сервиса внутри текущей трассы."""
+        if (parent := _current_span.get()) is None:
+            return None
+
+        return Span(parent.trace, f'{service} {operation}', parent.span_id,
+                    {'service': service, 'operation': operation})
+
+    def on_cache_lookup(self, cache, result):
+        """Отмечает обращение к кэшу событием текущего спана."""
+        if (span := _current_span.get()) is not None:
+            span.add_event('cache', cache=cache, result=result)
+
+
+class JsonlExporter():
+    """Пишет спаны в файл JSONL, ротируя его по размеру."""
+
+    def __init__(self, path, max_bytes=50 * 1024 * 1024, backup_count=5):
+        self.path = path
+        self.__logger = logging.Logger('pizza-shop.spans')
+        self.__logger.addHandler(RotatingFileHandler(path,
+                                                     maxBytes=max_bytes,
+                                                     backupCount=backup_count,
+                                                     encoding='utf-8'))
+
+    def __repr__(self):
+        return '<{} {}>'.format(self.__class__.__name__.upper(), self.path)
+
+    def export(self, spans):
+        for span in spans:
+            self.__logger.info(json.dumps(span.to_dict(), ensure_ascii=False))
+
+    def shutdown(self):
+        for handler in self.__logger.handlers:
+            handler.close()
+
+
+class OtlpExporter():
+    """
+    Отправляет спаны в коллектор по OTLP/HTTP в формате JSON.
+
+    Спаны копятся в очереди и уходят пачками из фонового потока, раз
+    в flush_interval секунд или по batch_size штук. Если коллектор не
+    успевает, лишние спаны отбрасываются, а не задерживают апдейты.
+    """
+
+    def __init__(self,
+                 endpoint,
+                 service_name='pizza-bot',
+                 batch_size=512,
+                 flush_interval=2,
+                 max_queue_size=10000,
+                 timeout=5):
+        self.endpoint = endpoint.rstrip('/') + '/v1/traces'
+        self.service_name = service_name
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.timeout = timeout
+        self.__queue = queue.Queue(max_queue_size)
+        self.__session = requests.Session()
+        self.__stopped = threading.Event()
+        self.__thread = threading.Thread(target=self.__run,
+                                         name='otlp-exporter',
+                                         daemon=True)
+        self.__thread.start()
+
+    def __repr__(self):
+        return '<{} {}>'.format(self.__class__.__name__.upper(), self.endpoint)
+
+    def export(self, spans):
+        for span in spans:
+            try:
+                self.__queue.put_nowait(span)
+            except queue.Full:
+                logger.debug('Очередь спанов переполнена, span отброшен')
+
+    def shutdown(self):
+        self.__stopped.set()
+        self.__thread.join()
+
+    def __run(self):
+        while not self.__stopped.is_set():
+            batch = self.__take_batch()
+            if batch:
+                self.send(batch)
+
+        if batch := self.__take_batch(wait=False):
+            self.send(batch)
+
+    def __take_batch(self, wait=True):
+        batch = []
+        deadline = time.monotonic() + self.flush_interval
+
+        while len(batch) < self.batch_size:
+            timeout = deadline - time.monotonic()
+            try:
+                if wait and timeout > 0:
+                    batch.append(self.__queue.get(timeout=timeout))
+                else:
+                    batch.append(self.__queue.get_nowait())
+            except queue.Empty:
+                break
+
+        return batch
+
+    def send(self, spans):
+        """Отправляет пачку спанов в коллектор."""
+        try:
+            response = self.__session.post(self.endpoint,
+                                           json=self.to_otlp(spans),
+                                           timeout=self.timeout)
+            response.raise_for_status()
+        except requests.RequestException as err:
+            logger.warning('Не удалось отправить спаны: %s', err)
+
+    def to_otlp(self, spans):
+        return {
+            'resourceSpans': [{
+                'resource': {
+                    'attributes': otlp_attributes(
+                        {'service.name': self.service_name}),
+                },
+                'scopeSpans': [{
+                    'scope': {'name': 'pizza-bot'},
+                    'spans': [otlp_span(span) for span in spans],
+                }],
+            }],
+        }
+
+
+def otlp_attributes(attributes):
+    """Переводит атрибуты в формат OTLP."""
+    converted = []
+    for name, value in attributes.items():
+        if isinstance(value, bool):
+            converted_value = {'boolValue': value}
+        elif isinstance(value, int):
+            converted_value = {'intValue': str(value)}
+        elif isinstance(value, float):
+            converted_value = {'doubleValue': value}
+        else:
+            converted_value = {'stringValue': str(value)}
+
+        converted.append({'key': name, 'value': converted_value})
+
+    return converted
+
+
+def otlp_span(span):
+    """Переводит span в формат OTLP."""
+    start = int(span.start_time * 1e9)
+
+    converted = {
+        'traceId': span.trace.trace_id,
+        'spanId': span.span_id,
+        'name': span.name,
+        'kind': 3 if 'service' in span.attributes else 2,
+        'startTimeUnixNano': str(start),
+        'endTimeUnixNano': str(start + int(span.duration * 1e9)),
+        'attributes': otlp_attributes(dict(span.attributes,
+                                           thread=span.thread)),
+        'events': [
+            {
+                'name': event['name'],
+                'timeUnixNano': str(int(event['time'] * 1e9)),
+                'attributes': otlp_attributes(event['attributes']),
+            }
+            for event in span.events
+        ],
+        'status': ({'code': 2, 'message': span.error} if span.error
+                   else {'code': 1}),
+    }
+    if span.parent_id:
+        converted['parentSpanId'] = span.parent_id
+
+    return converted
+
+
+def enable_tracing(exporter, sample_rate=0.01):
+    """Включает трассировку доли sample_rate апдейтов."""
+    global _tracer
+    disable_tracing()
+
+    _tracer = Tracer(exporter, sample_rate)
+    set_span_starter(_tracer.start_call_span)
+    add_cache_listener(_tracer.on_cache_lookup)
+    logger.info('Трассируется %s апдейтов, экспорт в %s',
+                sample_rate, exporter)
+
+    return _tracer
+
+
+def disable_tracing():
+    """Выключает трассировку."""
+    global _tracer
+    if _tracer is not None:
+        set_span_starter(None)
+        remove_cache_listener(_tracer.on_cache_lookup)
+        _tracer.exporter.shutdown()
+        _tracer = None
+
+
+def create_exporter(env):
+    """Создаёт экспортёр спанов по настройкам окружения."""
+    if otlp_endpoint := env.str('TRACING_OTLP_ENDPOINT', ''):
+        return OtlpExporter(otlp_endpoint,
+                            service_name=env.str('TRACING_SERVICE_NAME',
+                                                 'pizza-bot'))
+
+    return JsonlExporter(env.str('TRACING_PATH', 'spans.jsonl'),
+                         max_bytes=env.int('TRACING_MAX_BYTES',
+                                           50 * 1024 * 1024),
+                         backup_count=env.int('TRACING_BACKUP_COUNT', 5))
+
+
+def traced(name):
+    """Декоратор: открывает трассу апдейта на время вызова функции."""
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if _tracer is None:
+                return func(*args, **kwargs)
+
+            with _tracer.start_trace(name):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def trace_span(name, **attributes):
+    """Открывает дочерний span текущей трассы, если она открыта."""
+    if (parent := _current_span.get()) is None:
+        return _NO_SPAN
+
+    return Span(parent.trace, name, parent.span_id, attributes)
+
+
+def set_trace_attribute(name, value):
+    """Добавляет атрибут к текущему спану, если трасса открыта."""
+    if (span := _current_span.get()) is not None:
+        span.set_attribute(name, value)
+
+
+def read_traces(paths):
+    """Читает спаны из файлов JSONL и группирует их по трассам."""
+    traces = {}
+    for path in paths:
+        with open(path, 'r', encoding='utf-8') as file:
+            for line in file:
+                if line.strip():
+                    span = json.loads(line)
+                    traces.setdefault(span['trace_id'], []).append(span)
+
+    return traces
+
+
+def critical_path(span, children):
+    """
+    Возвращает критический путь трассы: спаны, которые задержали ответ.
+
+    Начиная с конца спана, берётся дочерний span, закончившийся последним,
+    затем тот, что закончился последним до его начала, и так далее; для
+    каждого рекурсивно то же самое. Каждый элемент пути — пара
+    (span, собственное время, глубина).
+    """
+    path = []
+    own_time = span['duration']
+    cursor = span['start'] + span['duration']
+
+    for child in sorted(children.get(span['span_id'], []),
+                        key=lambda child: child['start'] + child['duration'],
+                        reverse=True):
+        if child['start'] + child['duration'] > cursor + 1e-6:
+            continue
+
+        path = critical_path(child, children) + path
+        own_time -= child['duration']
+        cursor = child['start']
+
+    return [(span, max(own_time, 0), 0)] + [
+        (path_span, path_own_time, depth + 1)
+        for path_span, path_own_time, depth in path
+    ]
+
+
+def print_slowest(traces, limit=10):
+    """Печатает самые долгие трассы и их критический путь."""
+    roots = []
+    for spans in traces.values():
+        for span in spans:
+            if span['parent_id'] is None:
+                roots.append((span, spans))
+
+    roots.sort(key=lambda root: root[0]['duration'], reverse=True)
+
+    for root, spans in roots[:limit]:
+        children = {}
+        for span in spans:
+            children.setdefault(span['parent_id'], []).append(span)
+
+        attributes = ' '.join(f'{name}={value}'
+                              for name, value in root['attributes'].items())
+        started_at = time.strftime('%Y-%m-%d %H:%M:%S',
+                                   time.localtime(root['start']))
+        print(f'{root["duration"] * 1000:.1f} мс  {started_at}  '
+              f'{root["trace_id"]}  {attributes}'
+              f'{"  ошибка: " + root["error"] if root["error"] else ""}')
+
+        for span, own_time, depth in critical_path(root, children):
+            print(f'    {"  " * depth}{span["name"]:<{50 - 2 * depth}}'
+                  f'{span["duration"] * 1000:>9.1f} мс'
+                  f'{own_time * 1000:>9.1f} мс своих'
+                  f'{"  " + span["error"] if span["error"] else ""}')
+        print()
+
+
+def main():
+    env = Env()
+    env.read_env()
+
+    parser = argparse.ArgumentParser(
+        description='Самые долгие трассы апдейтов и их критический путь'
+    )
+    parser.add_argument('paths', nargs='*',
+                        help='Файлы спанов, по умолчанию TRACING_PATH '
+                             'и его ротированные копии')
+    parser.add_argument('--limit', type=int, default=10,
+                        help='Сколько трасс показать')
+    args = parser.parse_args()
+
+    tracing_path = env.str('TRACING_PATH', 'spans.jsonl')
+    paths = args.paths or sorted(glob.glob(f'{tracing_path}*'))
+
+    print_slowest(read_traces(paths), args.limit)
+
+
+if __name__ == '__main__':
+    main()
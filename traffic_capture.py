@@ -0,0 +1,204 @@
+import contextvars
+import hashlib
+import hmac
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from instrumentation import add_listener, remove_listener
+
+logger = logging.getLogger('pizza-shop')
+
+_traffic_recorder = None
+
+# Вызовы внешних сервисов, сделанные при обработке текущего апдейта.
+_calls = contextvars.ContextVar('captured_calls', default=None)
+
+# Поля, которые попадают в запись; имена, контакты и прочее отбрасываются.
+MESSAGE_FIELDS = ('message_id', 'date', 'chat', 'from', 'text', 'location')
+USER_FIELDS = ('id', 'type', 'is_bot')
+
+
+class TrafficRecorder():
+    """
+    Записывает обработанные апдейты в файл JSONL для повторного прогона.
+
+    Каждая строка — апдейт без персональных данных, время его получения и
+    обработки, состояние до и после, а также вызовы Moltin, геокодера,
+    Redis и Telegram с их длительностью. Id пользователей и чатов
+    заменяются псевдонимами, текст сообщений — хэшем, геопозиция
+    округляется до километра, так что одинаковые значения в записи
+    остаются одинаковыми.
+    """
+
+    def __init__(self, path, salt=''):
+        self.path = path
+        self.__salt = salt.encode('utf-8') if salt else os.urandom(16)
+        self.__lock = threading.Lock()
+        self.__file = open(path, 'a', encoding='utf-8')
+        add_listener(self.on_call)
+
+    def __repr__(self):
+        return '<{} {}>'.format(self.__class__.__name__.upper(), self.path)
+
+    @contextmanager
+    def capture(self, update, state):
+        """Записывает апдейт, обработанный внутри блока with."""
+        entry = {
+            'ts': round(time.time(), 3),
+            'state': state,
+            'next_state': None,
+            'error': None,
+        }
+        calls = []
+        token = _calls.set(calls)
+        started_at = time.perf_counter()
+
+        try:
+            yield entry
+        except Exception as err:
+            entry['error'] = err.__class__.__name__
+            raise
+        finally:
+            _calls.reset(token)
+            entry['duration'] = round(time.perf_counter() - started_at, 6)
+            entry['calls'] = calls
+            entry['update'] = self.anonymize(update.to_dict())
+            self.write(entry)
+
+    def on_call(self, service, operation, duration, error):
+        """Добавляет вызов внешнего сервиса к записи текущего апдейта."""
+        if (calls := _calls.get()) is not None:
+            calls.append({
+                'service': service,
+                'operation': operation,
+                'duration': round(duration, 6),
+                'error': error.__class__.__name__ if error else None,
+            })
+
+    def write(self, entry):
+        line = json.dumps(entry, ensure_ascii=False)
+
+        with self.__lock:
+            self.__file.write(line + '\n')
+            self.__file.flush()
+
+    def close(self):
+        """Закрывает файл записи."""
+        remove_listener(self.on_call)
+
+        with self.__lock:
+            self.__file.close()
+
+    def anonymize(self, payload):
+        """Возвращает апдейт без персональных данных."""
+        update = {'update_id': payload.get('update_id')}
+
+        if message := payload.get('message'):
+            update['message'] = self.anonymize_message(message)
+
+        if query := payload.get('callback_query'):
+            update['callback_query'] = {
+                'id': query.get('id'),
+                'from': self.anonymize_user(query.get('from')),
+                'chat_instance': self.digest(
+                    str(query.get('chat_instance')))[:16],
+                'data': query.get('data'),
+            }
+            if message := query.get('message'):
+                # От сообщения бота нужно только, где нажата кнопка.
+                update['callback_query']['message'] = {
+                    'message_id': message.get('message_id'),
+                    'date': message.get('date'),
+                    'chat': self.anonymize_user(message.get('chat')),
+                }
+
+        return update
+
+    def anonymize_message(self, message):
+        anonymized = {
+            name: message[name]
+            for name in MESSAGE_FIELDS
+            if name in message
+        }
+        anonymized['chat'] = self.anonymize_user(message.get('chat'))
+        anonymized['from'] = self.anonymize_user(message.get('from'))
+
+        if text := message.get('text'):
+            anonymized['text'] = (text if text.startswith('/')
+                                  else 'text-{}'.format(self.digest(text)[:12]))
+
+        if location := message.get('location'):
+            anonymized['location'] = {
+                'latitude': round(location['latitude'], 2),
+                'longitude': round(location['longitude'], 2),
+            }
+
+        return anonymized
+
+    def anonymize_user(self, user):
+        """Оставляет от пользователя или чата псевдоним id и тип."""
+        if not user:
+            return user
+
+        anonymized = {
+            name: user[name]
+            for name in USER_FIELDS
+            if name in user
+        }
+        anonymized['id'] = self.pseudonym(user['id'])
+        if 'first_name' in user:
+            # Без имени python-telegram-bot не разберёт пользователя.
+            anonymized['first_name'] = 'Anonymous'
+
+        return anonymized
+
+    def pseudonym(self, user_id):
+        """Заменяет id постоянным псевдонимом с тем же знаком."""
+        pseudonym = int(self.digest(str(abs(user_id)))[:10], 16) + 1
+
+        return -pseudonym if user_id < 0 else pseudonym
+
+    def digest(self, value):
+        return hmac.new(self.__salt,
+                        value.encode('utf-8'),
+                        hashlib.sha256).hexdigest()
+
+
+def enable_traffic_capture(path, salt=''):
+    """Включает запись апдейтов в файл path."""
+    global _traffic_recorder
+    if _traffic_recorder is not None:
+        _traffic_recorder.close()
+
+    _traffic_recorder = TrafficRecorder(path, salt)
+    logger.info('Апдейты записываются в %s', path)
+
+    return _traffic_recorder
+
+
+def disable_traffic_capture():
+    """Выключает запись апдейтов."""
+    global _traffic_recorder
+    if _traffic_recorder is not None:
+        _traffic_recorder.close()
+        _traffic_recorder = None
+
+
+@contextmanager
+def capture_update(update, state):
+    """
+    Записывает апдейт, если запись включена.
+
+    Внутри блока в поле next_state выданного словаря кладётся новое
+    состояние чата.
+    """
+    if _traffic_recorder is None:
+        yield {}
+        return
+
+    with _traffic_recorder.capture(update, state) as entry:
+        yield entry
@@ -0,0 +1,379 @@
+import json
+import logging
+import math
+import os
+import random
+import socket
+import threading
+import time
+
+import redis
+
+logger = logging.getLogger('pizza-shop')
+
+# Продлевает аренду, только если ею всё ещё владеет этот воркер.
+RENEW_LEASE_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('pexpire', KEYS[1], ARGV[2])
+end
+return 0
+"""
+RELEASE_LEASE_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+# Перед обработкой апдейта проверяет аренду и забирает апдейт себе,
+# обнуляя его время простоя: новый владелец потока не заберёт его, пока
+# идёт обработка. Апдейт, которого уже нет среди неподтверждённых,
+# обрабатывать не нужно.
+START_PROCESSING_SCRIPT = """
+if redis.call('get', KEYS[1]) ~= ARGV[1] then
+    return 0
+end
+return #redis.call('xclaim', KEYS[2], ARGV[2], ARGV[1], 0, ARGV[3], 'JUSTID')
+"""
+# Подтверждает апдейт, только если его не забрал другой воркер.
+ACK_SCRIPT = """
+local pending = redis.call('xpending', KEYS[1], ARGV[1], ARGV[3], ARGV[3], 1,
+                           ARGV[2])
+if #pending == 0 then
+    return 0
+end
+return redis.call('xack', KEYS[1], ARGV[1], ARGV[3])
+"""
+
+
+def get_update_chat_id(payload):
+    """Возвращает id чата из апдейта Telegram в виде словаря."""
+    for kind in ('message', 'edited_message', 'callback_query'):
+        if item := payload.get(kind):
+            message = item.get('message', item)
+            return message.get('chat', {}).get('id', 0)
+
+    return 0
+
+
+class UpdateStream():
+    """
+    Очередь апдейтов Telegram в Redis Streams.
+
+    Апдейты раскладываются по partitions потокам по id чата, так что все
+    апдейты одного чата попадают в один поток и читаются по порядку.
+    """
+
+    STREAM_KEY = 'updates:{}'
+    LEASE_KEY = 'updates:{}:lease'
+    WORKERS_KEY = 'updates:workers'
+
+    def __init__(self, redis_db, partitions=8, group='workers', maxlen=100000):
+        self.redis_db = redis_db
+        self.partitions = partitions
+        self.group = group
+        self.maxlen = maxlen
+
+    def __repr__(self):
+        return '<{} partitions={}>'.format(self.__class__.__name__.upper(),
+                                           self.partitions)
+
+    def partition(self, chat_id):
+        """Возвращает номер потока для чата."""
+        return int(chat_id) % self.partitions
+
+    def stream_key(self, partition):
+        """Возвращает ключ потока."""
+        return self.STREAM_KEY.format(partition)
+
+    def publish(self, payload):
+        """Добавляет апдейт в поток его чата."""
+        partition = self.partition(get_update_chat_id(payload))
+
+        return self.redis_db.xadd(
+            self.stream_key(partition),
+            {'update': json.dumps(payload, ensure_ascii=False)},
+            maxlen=self.maxlen,
+            approximate=True,
+        )
+
+    def ensure_groups(self):
+        """Создаёт группу потребителей во всех потоках."""
+        for partition in range(self.partitions):
+            try:
+                self.redis_db.xgroup_create(self.stream_key(partition),
+                                            self.group,
+                                            id='0',
+                                            mkstream=True)
+            except redis.ResponseError as err:
+                if 'BUSYGROUP' not in str(err):
+                    raise
+
+
+class StreamWorker():
+    """
+    Воркер, обрабатывающий апдейты из UpdateStream.
+
+    Каждый поток в один момент читает только один воркер: он берёт аренду
+    потока (SET NX PX) и продлевает её, пока жив. Потоки делятся между
+    живыми воркерами поровну.
+
+    Взяв поток, воркер забирает себе (XAUTOCLAIM) апдейты, которые
+    прочитал, но не подтвердил прежний владелец, и читает новые, только
+    когда таких не осталось. Забираются апдейты, простоявшие дольше
+    аренды и дедлайна обработки вместе: прежний владелец мог потерять
+    аренду посреди обработки и ещё её заканчивать. Перед обработкой
+    воркер проверяет, что аренда всё ещё его, и обнуляет время простоя
+    апдейта, а подтверждает (XACK) после того, как handle_update записал
+    состояние чата, и только если апдейт не забрал другой воркер.
+    """
+
+    def __init__(self,
+                 update_stream,
+                 handle_update,
+                 chat_executor,
+                 lease_ttl=10,
+                 handler_deadline=10,
+                 batch_size=50,
+                 max_inflight=200):
+        self.update_stream = update_stream
+        self.handle_update = handle_update
+        self.chat_executor = chat_executor
+        self.lease_ttl = lease_ttl
+        self.handler_deadline = handler_deadline
+        self.batch_size = batch_size
+        self.max_inflight = max_inflight
+        self.consumer = f'{socket.gethostname()}-{os.getpid()}'
+        self.__redis_db = update_stream.redis_db
+        self.__renew_lease = self.__redis_db.register_script(
+            RENEW_LEASE_SCRIPT)
+        self.__release_lease = self.__redis_db.register_script(
+            RELEASE_LEASE_SCRIPT)
+        self.__start_processing = self.__redis_db.register_script(
+            START_PROCESSING_SCRIPT)
+        self.__ack = self.__redis_db.register_script(ACK_SCRIPT)
+        self.__owned = set()
+        self.__draining = set()
+        # Потоки, где остались апдейты прежнего владельца.
+        self.__recovering = set()
+        self.__inflight = {}
+        self.__lock = threading.Lock()
+        self.__stopped = threading.Event()
+
+    def __repr__(self):
+        return '<{} {}>'.format(self.__class__.__name__.upper(),
+                                self.consumer)
+
+    def owned_partitions(self):
+        """Возвращает номера потоков, которые читает воркер."""
+        return sorted(self.__owned)
+
+    def run(self):
+        """Читает и обрабатывает апдейты, пока не вызван stop."""
+        self.update_stream.ensure_groups()
+        logger.info('Воркер %s запущен', self.consumer)
+
+        next_maintenance = 0
+        while not self.__stopped.is_set():
+            if time.monotonic() >= next_maintenance:
+                self.maintain_leases()
+                next_maintenance = time.monotonic() + self.lease_ttl / 3
+
+            readable = self.__owned - self.__draining - self.__recovering
+            if not readable or self.inflight() >= self.max_inflight:
+                self.__stopped.wait(0.1)
+                continue
+
+            self.read(readable)
+
+        self.chat_executor.shutdown(wait=True)
+        self.release_all()
+        logger.info('Воркер %s остановлен', self.consumer)
+
+    def stop(self):
+        """Останавливает воркер после обработки уже прочитанных апдейтов."""
+        self.__stopped.set()
+
+    def inflight(self):
+        """Возвращает число прочитанных, но ещё не подтверждённых апдейтов."""
+        with self.__lock:
+            return sum(self.__inflight.values())
+
+    def read(self, partitions):
+        """Читает новые апдейты из потоков и ставит их в очереди чатов."""
+        streams = {
+            self.update_stream.stream_key(partition): '>'
+            for partition in partitions
+        }
+        response = self.__redis_db.xreadgroup(self.update_stream.group,
+                                              self.consumer,
+                                              streams,
+                                              count=self.batch_size,
+                                              block=1000)
+
+        for stream_key, entries in response or []:
+            partition = int(stream_key.decode('utf-8').split(':')[1])
+            self.dispatch(partition, entries)
+
+    def dispatch(self, partition, entries):
+        """Ставит апдейты в очереди их чатов."""
+        for entry_id, fields in entries:
+            if not fields:
+                # Запись уже удалена из потока по maxlen.
+                self.ack(partition, entry_id)
+                continue
+
+            payload = json.loads(fields[b'update'])
+            with self.__lock:
+                self.__inflight[partition] = (
+                    self.__inflight.get(partition, 0) + 1
+                )
+
+            self.chat_executor.submit(get_update_chat_id(payload),
+                                      self.process,
+                                      partition,
+                                      entry_id,
+                                      payload)
+
+    def process(self, partition, entry_id, payload):
+        """Обрабатывает апдейт и подтверждает его."""
+        try:
+            if not self.__start_processing(
+                    keys=[self.__lease_key(partition),
+                          self.update_stream.stream_key(partition)],
+                    args=[self.consumer, self.update_stream.group, entry_id]):
+                # Апдейт обработает новый владелец потока.
+                logger.warning('Поток %s уже не наш, апдейт %s пропущен',
+                               partition, entry_id)
+                return
+
+            try:
+                self.handle_update(payload)
+            finally:
+                self.ack(partition, entry_id)
+        finally:
+            with self.__lock:
+                self.__inflight[partition] -= 1
+
+    def ack(self, partition, entry_id):
+        """Подтверждает обработку апдейта, если его не забрал другой воркер."""
+        if not self.__ack(keys=[self.update_stream.stream_key(partition)],
+                          args=[self.update_stream.group,
+                                self.consumer,
+                                entry_id]):
+            logger.warning('Апдейт %s потока %s забрал другой воркер',
+                           entry_id, partition)
+
+    def maintain_leases(self):
+        """
+        Продлевает аренду своих потоков и делит потоки между воркерами.
+
+        Лишние потоки сначала перестают читаться и отдаются, только когда
+        все их прочитанные апдейты обработаны, иначе новый владелец мог бы
+        обработать апдейты чата не по порядку.
+        """
+        now = time.time()
+        workers_key = self.update_stream.WORKERS_KEY
+
+        pipeline = self.__redis_db.pipeline(transaction=False)
+        pipeline.zadd(workers_key, {self.consumer: now})
+        pipeline.zremrangebyscore(workers_key, 0, now - 3 * self.lease_ttl)
+        pipeline.zcard(workers_key)
+        _, _, workers_count = pipeline.execute()
+
+        for partition in list(self.__owned):
+            if not self.__renew_lease(
+                    keys=[self.__lease_key(partition)],
+                    args=[self.consumer, int(self.lease_ttl * 1000)]):
+                logger.warning('Потеряна аренда потока %s', partition)
+                self.__owned.discard(partition)
+                self.__draining.discard(partition)
+                self.__recovering.discard(partition)
+
+        for partition in list(self.__recovering):
+            self.claim_pending(partition)
+
+        target = math.ceil(self.update_stream.partitions
+                           / max(workers_count, 1))
+
+        extra = len(self.__owned) - target
+        for partition in sorted(self.__owned, reverse=True)[:max(extra, 0)]:
+            self.__draining.add(partition)
+
+        for partition in list(self.__draining):
+            with self.__lock:
+                is_idle = not self.__inflight.get(partition)
+            if is_idle:
+                self.release(partition)
+
+        partitions = list(range(self.update_stream.partitions))
+        random.shuffle(partitions)
+        for partition in partitions:
+            if len(self.__owned) >= target:
+                break
+            if partition not in self.__owned:
+                self.acquire(partition)
+
+    def acquire(self, partition):
+        """Берёт аренду потока и забирает его неподтверждённые апдейты."""
+        if not self.__redis_db.set(self.__lease_key(partition),
+                                   self.consumer,
+                                   nx=True,
+                                   px=int(self.lease_ttl * 1000)):
+            return False
+
+        self.__owned.add(partition)
+        self.__recovering.add(partition)
+        logger.info('Воркер %s взял поток %s', self.consumer, partition)
+        self.claim_pending(partition)
+
+        return True
+
+    def claim_pending(self, partition):
+        """
+        Забирает неподтверждённые апдейты прежнего владельца потока.
+
+        Пока у других воркеров остаются апдейты потока, новые апдейты
+        из него не читаются, чтобы апдейты чата шли по порядку.
+        """
+        stream_key = self.update_stream.stream_key(partition)
+        min_idle_time = int((self.lease_ttl + self.handler_deadline) * 1000)
+        start_id = '0-0'
+        while True:
+            response = self.__redis_db.xautoclaim(stream_key,
+                                                  self.update_stream.group,
+                                                  self.consumer,
+                                                  min_idle_time=min_idle_time,
+                                                  start_id=start_id,
+                                                  count=self.batch_size)
+            start_id, entries = response[0], response[1]
+            if entries:
+                logger.info('Поток %s: забрано %s апдейтов', partition,
+                            len(entries))
+                self.dispatch(partition, entries)
+            if start_id in (b'0-0', '0-0'):
+                break
+
+        pending = self.__redis_db.xpending(stream_key,
+                                           self.update_stream.group)
+        if all(consumer['name'] in (self.consumer, self.consumer.encode())
+               for consumer in pending['consumers']):
+            self.__recovering.discard(partition)
+
+    def release(self, partition):
+        """Отдаёт аренду потока."""
+        self.__release_lease(keys=[self.__lease_key(partition)],
+                             args=[self.consumer])
+        self.__owned.discard(partition)
+        self.__draining.discard(partition)
+        self.__recovering.discard(partition)
+        logger.info('Воркер %s отдал поток %s', self.consumer, partition)
+
+    def release_all(self):
+        """Отдаёт аренду всех потоков и уходит из списка воркеров."""
+        for partition in list(self.__owned):
+            self.release(partition)
+
+        self.__redis_db.zrem(self.update_stream.WORKERS_KEY, self.consumer)
+
+    def __lease_key(self, partition):
+        return self.update_stream.LEASE_KEY.format(partition)
@@ -0,0 +1,167 @@
+import argparse
+import hmac
+import json
+import logging
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+logger = logging.getLogger('pizza-shop')
+
+SECRET_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+# Telegram не присылает апдейты больше нескольких десятков килобайт.
+MAX_BODY_SIZE = 1024 * 1024
+
+
+class WebhookHandler(BaseHTTPRequestHandler):
+    """Принимает апдейты Telegram, отвечает сразу и передаёт их дальше."""
+
+    server_version = 'PizzaBotWebhook/1.0'
+
+    def do_POST(self):
+        server = self.server
+
+        if self.path.split('?')[0] != server.url_path:
+            return self.__reply(404)
+
+        if server.secret_token and not hmac.compare_digest(
+                self.headers.get(SECRET_HEADER, ''), server.secret_token):
+            return self.__reply(403)
+
+        length = int(self.headers.get('Content-Length') or 0)
+        if length > MAX_BODY_SIZE:
+            return self.__reply(413)
+
+        try:
+            payload = json.loads(self.rfile.read(length))
+        except ValueError:
+            return self.__reply(400)
+
+        # Отвечаем до обработки, чтобы Telegram не ждал и не слал повторы.
+        self.__reply(200)
+
+        try:
+            server.on_update(payload)
+        except Exception as err:
+            logger.error('Не удалось передать апдейт: %s', err)
+
+    def do_GET(self):
+        self.__reply(405)
+
+    def log_message(self, format, *args):
+        logger.debug(format, *args)
+
+    def __reply(self, status):
+        self.send_response(status)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+        self.wfile.flush()
+
+
+class WebhookServer(ThreadingHTTPServer):
+    """
+    HTTP-сервер для приёма апдейтов Telegram через вебхук.
+
+    Проверяет секрет из заголовка X-Telegram-Bot-Api-Secret-Token и
+    передаёт каждый апдейт в on_update уже после ответа Telegram.
+    """
+
+    daemon_threads = True
+
+    def __init__(self,
+                 on_update,
+                 listen='0.0.0.0',
+                 port=8443,
+                 url_path='/',
+                 secret_token=''):
+        super().__init__((listen, port), WebhookHandler)
+        self.on_update = on_update
+        self.url_path = url_path or '/'
+        self.secret_token = secret_token
+
+    def __repr__(self):
+        return '<{} {}:{}>'.format(self.__class__.__name__.upper(),
+                                   *self.server_address)
+
+    def start(self):
+        """Запускает сервер в фоновом потоке."""
+        thread = threading.Thread(target=self.serve_forever,
+                                  name='webhook-server',
+                                  daemon=True)
+        thread.start()
+
+        return thread
+
+    def stop(self):
+        """Останавливает сервер."""
+        self.shutdown()
+        self.server_close()
+
+
+def send_update(url, update, secret_token='', timeout=5):
+    """Отправляет апдейт на вебхук так же, как это делает Telegram."""
+    response = requests.post(
+        url,
+        json=update,
+        headers={SECRET_HEADER: secret_token} if secret_token else {},
+        timeout=timeout,
+    )
+
+    return response.status_code
+
+
+def make_text_update(update_id, chat_id, text):
+    """Возвращает апдейт с текстовым сообщением от пользователя."""
+    user = {'id': chat_id, 'is_bot': False, 'first_name': 'Test'}
+
+    return {
+        'update_id': update_id,
+        'message': {
+            'message_id': update_id,
+            'from': user,
+            'chat': {'id': chat_id, 'type': 'private', 'first_name': 'Test'},
+            'date': int(time.time()),
+            'text': text,
+        },
+    }
+
+
+def main():
+    """Шлёт на вебхук поддельные апдейты, как это делал бы Telegram."""
+    logging.basicConfig(
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+        level=logging.INFO,
+    )
+
+    parser = argparse.ArgumentParser(
+        description='Отправляет тестовые апдейты на вебхук бота.'
+    )
+    parser.add_argument('url', help='адрес вебхука')
+    parser.add_argument('--secret', default='',
+                        help='секрет вебхука')
+    parser.add_argument('--chat-id', type=int, default=1,
+                        help='id чата отправителя')
+    parser.add_argument('--text', default='/start',
+                        help='текст сообщения')
+    parser.add_argument('--count', type=int, default=1,
+                        help='сколько апдейтов отправить')
+    args = parser.parse_args()
+
+    started_at = time.monotonic()
+    for update_id in range(1, args.count + 1):
+        status = send_update(
+            args.url,
+            make_text_update(update_id, args.chat_id, args.text),
+            args.secret,
+        )
+        if status != 200:
+            logger.error('Вебхук ответил %s', status)
+
+    elapsed = time.monotonic() - started_at
+    logger.info('Отправлено %s апдейтов за %.2f с', args.count, elapsed)
+
+
+if __name__ == '__main__':
+    main()